@@ -1,5 +1,8 @@
-﻿import os
+﻿import hashlib
+import json
+import os
 import sys
+import tempfile
 
 import maya.cmds as cmds
 import sgtk
@@ -8,54 +11,178 @@ import sgtk
 CONDUCTOR_CLIENT_TOOLS_PATH = '/opt/conductor'
 
 sys.path.append(CONDUCTOR_CLIENT_TOOLS_PATH)
-sys.path.append(os.path.join(CONDUCTOR_CLIENT_TOOLS_PATH, "python", "lib", "python2.7", "site-packages") 
+sys.path.append(os.path.join(CONDUCTOR_CLIENT_TOOLS_PATH, "python", "lib", "python2.7", "site-packages"))
 
 import conductor.lib
 import conductor.lib.maya_utils
 
 HookBaseClass = sgtk.get_hook_baseclass()
 
+# The dependencies scraped from every scene are cached here, by scene path and modification time
+SCRAPE_CACHE_DIR = os.path.join(tempfile.gettempdir(), "conductor_collector")
+
 
 class MayaConductorSessionCollector(HookBaseClass):
     """
     Inherits from MayaSessionCollector. Leverages Conductor's scene dependency scraping.
-    
-    *WARNING*: The base class (MayaSessionCollector) searches for Alembic caches inside the current
-    project's cache folder. Conductor's scraping searches the scene for alembic references. It's 
-    possible that the same alembic can be found twice and will appear in the publisher app twice.
+
+    Dependencies already collected by the base class (i.e. Alembic caches found in the project's
+    cache folder) aren't collected again. Frame and UDIM sequences are collected as a single item.
     """
-    
+
     def process_current_session(self, settings, parent_item):
         """
         Analyzes the current session open in Maya and parents a subtree of
         items under the parent_item passed in.
-        
+
         Leverages Conductor's dependency scraping.
 
         :param dict settings: Configured settings for this collector
         :param parent_item: Root item instance
         """
-        
+
         super(MayaConductorSessionCollector, self).process_current_session(settings, parent_item)
 
-        
+
         # Get the session item found in the base class so that we can create a proper publishing
         # tree
         session_item = None
-        
+
         for child_item in parent_item._children:
             if child_item._type_display == "Maya Session":
                 session_item = child_item
-                
+
         if session_item is None:
             raise Exception("Unable to find the MayaSession Publish Item")
 
         resources = conductor.lib.common.load_resources_file()
         dependency_attrs = resources.get("maya_dependency_attrs") or {}
-         
-        deps = conductor.lib.maya_utils.collect_dependencies(dependency_attrs)
+
         scene_path = cmds.file(query=True, sn=True)
-         
-        for dep in deps:
-            if dep and dep != scene_path:
-                super(MayaConductorSessionCollector, self)._collect_file(session_item, dep)
+        deps = self._get_dependencies(scene_path, dependency_attrs)
+
+        collected_paths = self._get_collected_paths(parent_item)
+
+        for path, frame_sequence in self._group_sequences(deps):
+
+            if self._normalize_path(path) in collected_paths or path == scene_path:
+                continue
+
+            item = super(MayaConductorSessionCollector, self)._collect_file(session_item, path, frame_sequence=frame_sequence)
+
+            if item is not None:
+                collected_paths.update(self._get_item_paths(item))
+
+    def _get_dependencies(self, scene_path, dependency_attrs):
+        """
+        Scrape the scene's dependencies. Unless the scene has unsaved changes the result is cached
+        by scene path and modification time, so that publishing an unchanged scene again doesn't
+        scrape it.
+
+        :param str scene_path: The path of the scene
+        :param dict dependency_attrs: The node attributes to scrape, by node type
+        :returns: The paths of the dependencies
+        :rtype: list of str
+        """
+
+        if not scene_path or not os.path.exists(scene_path) or cmds.file(query=True, modified=True):
+            return conductor.lib.maya_utils.collect_dependencies(dependency_attrs)
+
+        cache_key = json.dumps([scene_path, os.path.getmtime(scene_path), dependency_attrs], sort_keys=True)
+        cache_path = os.path.join(SCRAPE_CACHE_DIR, "{}.json".format(hashlib.md5(scene_path.encode("utf-8")).hexdigest()))
+
+        try:
+            with open(cache_path) as fh:
+                cached = json.load(fh)
+
+            if cached["key"] == cache_key:
+                self.logger.debug("Using the cached dependencies of %s" % scene_path)
+                return cached["dependencies"]
+
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+        deps = conductor.lib.maya_utils.collect_dependencies(dependency_attrs)
+
+        try:
+            if not os.path.exists(SCRAPE_CACHE_DIR):
+                os.makedirs(SCRAPE_CACHE_DIR)
+
+            with open(cache_path, "w") as fh:
+                json.dump({"key": cache_key, "dependencies": list(deps)}, fh)
+
+        except (IOError, OSError) as err:
+            self.logger.debug("Unable to cache the dependencies of %s (%s)" % (scene_path, err))
+
+        return deps
+
+    def _group_sequences(self, paths):
+        """
+        Group the frames of the same sequence (or the tiles of the same UDIM texture)
+
+        :param list paths: The paths of the dependencies
+        :returns: (path, frame_sequence) for every item to collect. For sequences, path is one of
+                  its files.
+        :rtype: list of tuple
+        """
+
+        publisher = self.parent
+        sequences = {}
+        grouped = []
+
+        for path in paths:
+
+            if not path:
+                continue
+
+            sequence_path = publisher.util.get_frame_sequence_path(path)
+
+            if sequence_path is None:
+                grouped.append([path])
+                continue
+
+            key = self._normalize_path(sequence_path)
+
+            if key not in sequences:
+                sequences[key] = []
+                grouped.append(sequences[key])
+
+            sequences[key].append(path)
+
+        return [ (group[0], len(group) > 1) for group in grouped ]
+
+    def _get_collected_paths(self, parent_item):
+        """
+        :param parent_item: Root item instance
+        :returns: The normalized paths of every item collected under parent_item
+        :rtype: set
+        """
+
+        collected_paths = set()
+        items = list(parent_item._children)
+
+        while items:
+            item = items.pop()
+            collected_paths.update(self._get_item_paths(item))
+            items.extend(item._children)
+
+        return collected_paths
+
+    def _get_item_paths(self, item):
+        """
+        :returns: The normalized paths of the item, including the files of its sequence
+        :rtype: list of str
+        """
+
+        paths = [item.properties.get("path")] + list(item.properties.get("sequence_paths") or [])
+
+        return [ self._normalize_path(path) for path in paths if path ]
+
+    @staticmethod
+    def _normalize_path(path):
+        """
+        :returns: The path in a form that can be compared with others
+        :rtype: str
+        """
+
+        return os.path.normcase(os.path.normpath(path))
@@ -0,0 +1,483 @@
+'''
+Local stand-ins for the services the daemon plugins talk to, so that the plugins can be benchmarked
+without a Shotgun site, an AWS account or a Conductor account.
+
+* FakeShotgun replaces shotgun_api3.Shotgun with an in-memory database
+* install_conductor_stub() replaces the Conductor client tools
+* S3 is provided by moto (see run_benchmark.py)
+
+All the stand-ins can add a fixed latency to every request to mimic the round-trip to the real
+service.
+'''
+
+import collections
+import copy
+import itertools
+import sys
+import threading
+import time
+import types
+
+
+class ServiceStats(object):
+    '''
+    Thread-safe counters of the requests made to a stand-in
+    '''
+
+    def __init__(self):
+
+        self._lock = threading.Lock()
+        self.calls = collections.Counter()
+
+    def record(self, name):
+
+        with self._lock:
+            self.calls[name] += 1
+
+    def as_dict(self):
+
+        with self._lock:
+            return dict(self.calls)
+
+
+class FakeShotgunDatabase(object):
+    '''
+    The entities shared by all the FakeShotgun connections. Entities are stored flat, linked
+    fields (i.e. 'entity.Shot.sg_cut_in') are stored as-is next to the entity's own fields.
+    '''
+
+    def __init__(self, latency=0.0):
+        '''
+        :param latency: The time (in seconds) every request takes
+        :type latency: float
+        '''
+
+        self.latency = latency
+        self.stats = ServiceStats()
+
+        self._lock = threading.Lock()
+        self._entities = collections.defaultdict(dict)
+        self._ids = itertools.count(1)
+
+    def add(self, entity_type, data):
+        '''
+        Add an entity to the database
+
+        :returns: The new entity
+        :rtype: dict
+        '''
+
+        with self._lock:
+            entity = dict(data, type=entity_type, id=data.get('id') or next(self._ids))
+            self._entities[entity_type][entity['id']] = entity
+
+        return entity
+
+    def get(self, entity_type, entity_id):
+
+        with self._lock:
+            return self._entities[entity_type].get(entity_id)
+
+    def query(self, entity_type, filters):
+
+        with self._lock:
+            entities = list(self._entities[entity_type].values())
+
+        return [ entity for entity in entities if all(self.match(entity, f) for f in filters or []) ]
+
+    @staticmethod
+    def match(entity, filter_):
+
+        field, operator, value = filter_
+        entity_value = entity.get(field)
+
+        if operator == 'is':
+            return entity_value == value
+
+        if operator == 'in':
+            return entity_value in value
+
+        if operator == 'ends_with':
+            return entity_value is not None and str(entity_value).endswith(value)
+
+        raise Exception("Unsupported filter operator '{}'".format(operator))
+
+
+class FakeShotgun(object):
+    '''
+    A drop-in replacement for the parts of shotgun_api3.Shotgun used by the daemon
+    '''
+
+    def __init__(self, database, *args, **kwargs):
+
+        self.database = database
+
+    def _request(self, name):
+
+        self.database.stats.record(name)
+
+        if self.database.latency:
+            time.sleep(self.database.latency)
+
+    @staticmethod
+    def _project(entity, fields):
+
+        result = {'type': entity['type'], 'id': entity['id']}
+
+        for field in fields or []:
+            result[field] = copy.deepcopy(entity.get(field))
+
+        return result
+
+    def find(self, entity_type, filters, fields=None, *args, **kwargs):
+
+        self._request('find')
+
+        return [ self._project(entity, fields) for entity in self.database.query(entity_type, filters) ]
+
+    def find_one(self, entity_type, filters, fields=None, *args, **kwargs):
+
+        self._request('find_one')
+
+        entities = self.database.query(entity_type, filters)
+
+        return self._project(entities[0], fields) if entities else None
+
+    def create(self, entity_type, data, return_fields=None):
+
+        self._request('create')
+
+        return self._project(self.database.add(entity_type, data), data.keys())
+
+    def update(self, entity_type, entity_id, data):
+
+        self._request('update')
+
+        entity = self.database.get(entity_type, entity_id)
+        entity.update(data)
+
+        return self._project(entity, data.keys())
+
+    def batch(self, requests):
+
+        self._request('batch')
+
+        results = []
+
+        for request in requests:
+            if request['request_type'] == 'create':
+                results.append(self._project(self.database.add(request['entity_type'], request['data']), request['data'].keys()))
+
+            elif request['request_type'] == 'update':
+                entity = self.database.get(request['entity_type'], request['entity_id'])
+                entity.update(request['data'])
+                results.append(self._project(entity, request['data'].keys()))
+
+            else:
+                raise Exception("Unsupported batch request '{}'".format(request['request_type']))
+
+        return results
+
+    def upload(self, entity_type, entity_id, path, field_name=None, *args, **kwargs):
+
+        self._request('upload')
+
+        return entity_id
+
+
+def install_shotgun_stub(database):
+    '''
+    Replace the shotgun_api3 module with one whose Shotgun connections use the given database.
+    Must be called before the plugins are imported.
+    '''
+
+    module = types.ModuleType('shotgun_api3')
+    module.Shotgun = lambda *args, **kwargs: FakeShotgun(database, *args, **kwargs)
+    sys.modules['shotgun_api3'] = module
+
+    return module
+
+
+class ConductorStub(object):
+    '''
+    The state of the Conductor stand-in: the jobs that were submitted and the latency of requests
+    '''
+
+    INSTANCE_TYPES = {'2 core, 13GB Mem': {'name': 'n1-highmem-2', 'cores': 2, 'memory': 13}}
+
+    def __init__(self, latency=0.0, timer=None):
+        '''
+        :param latency: The time (in seconds) every request takes
+        :type latency: float
+
+        :param timer: Called with the phase name and duration of every job submission
+        :type timer: callable
+        '''
+
+        self.latency = latency
+        self.timer = timer
+        self.stats = ServiceStats()
+        self.jobs = []
+
+        self._lock = threading.Lock()
+        self._job_ids = itertools.count(1)
+
+    def request(self, name):
+
+        self.stats.record(name)
+
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get_host_package(self, product, version, strict=True):
+
+        self.request('get_host_package')
+
+        return {'package': "{}-{}".format(product, version),
+                'v-ray-maya': {'3.60.04': "v-ray-maya-3.60.04"}}
+
+    def request_instance_types(self, as_dict=False):
+
+        self.request('request_instance_types')
+
+        return copy.deepcopy(self.INSTANCE_TYPES)
+
+    def submit(self, job):
+
+        start_time = time.time()
+        self.request('submit_job')
+
+        with self._lock:
+            job_id = "{:05d}".format(next(self._job_ids))
+            self.jobs.append({'jobid': job_id,
+                              'title': job.job_title,
+                              'upload_paths': len(job.upload_paths),
+                              'upload_files': len(job.upload_files or {})})
+
+        if self.timer is not None:
+            self.timer('submit', time.time() - start_time)
+
+        return {'jobid': job_id, 'status': 'success'}
+
+
+def install_conductor_stub(stub):
+    '''
+    Replace the Conductor client tools with modules that record the submitted jobs on the given
+    stub. Must be called before the plugins are imported.
+    '''
+
+    class RenderJob(object):
+
+        def __init__(self, scene_path=None):
+
+            self.scene_path = scene_path
+            self.upload_paths = []
+            self.upload_files = None
+            self.environment = {}
+            self.job_title = None
+            self.post_job_cmd = None
+            self.frames = None
+
+        def _get_environment(self):
+            return self.environment
+
+        def submit_job(self):
+            return stub.submit(self)
+
+    class ApiClient(object):
+
+        def make_request(self, uri_path, verb="GET", *args, **kwargs):
+            stub.request(verb)
+            return '{}', 200
+
+    modules = {}
+
+    for name in ('conductor', 'conductor.lib', 'conductor.lib.package_utils', 'conductor.lib.api_client',
+                 'conductor.__beta__', 'conductor.__beta__.job', 'conductor.__beta__.job.maya',
+                 'conductor.__beta__.job.nuke'):
+        modules[name] = sys.modules[name] = types.ModuleType(name)
+
+        if '.' in name:
+            parent, child = name.rsplit('.', 1)
+            setattr(modules[parent], child, modules[name])
+
+    modules['conductor.lib.package_utils'].get_host_package = stub.get_host_package
+    modules['conductor.lib.api_client'].request_instance_types = stub.request_instance_types
+    modules['conductor.lib.api_client'].ApiClient = ApiClient
+    modules['conductor.__beta__.job.maya'].MayaRenderJob = type('MayaRenderJob', (RenderJob,), {})
+    modules['conductor.__beta__.job.nuke'].NukeRenderJob = type('NukeRenderJob', (RenderJob,), {})
+
+    return modules['conductor']
+
+
+class SyntheticProject(object):
+    '''
+    Populates a FakeShotgunDatabase and an S3 bucket with Shots, PublishedFiles and their files.
+
+    Every Maya scene depends on a graph of PublishedFiles with `depth` levels of `width` files.
+    Every file depends on `fanout` files of the next level so most files are shared by several
+    parents, as textures and caches usually are.
+    '''
+
+    def __init__(self, database, s3_client, bucket, root, frame_count=24, frame_size=64*1024,
+                 file_size=256*1024, depth=3, width=10, fanout=3):
+        '''
+        :param database: The Shotgun database to populate
+        :type database: FakeShotgunDatabase
+
+        :param s3_client: The client used to populate the bucket
+        :type s3_client: botocore.client.S3
+
+        :param bucket: The name of the bucket
+        :type bucket: str
+
+        :param root: The local directory that mirrors the bucket. Every key is under it.
+        :type root: str
+        '''
+
+        self.database = database
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.root = root.rstrip("/")
+
+        self.frame_count = frame_count
+        self.frame_size = frame_size
+        self.file_size = file_size
+        self.depth = depth
+        self.width = width
+        self.fanout = fanout
+
+        self.event_ids = itertools.count(1)
+
+        self.project = database.add('Project', {'name': 'benchmark'})
+        self.user = database.add('HumanUser', {'login': 'benchmark'})
+        self.image_type = database.add('PublishedFileType', {'code': 'Image'})
+        self.file_count = 0
+        self.byte_count = 0
+
+    def put_file(self, path, size):
+        '''
+        Upload a file of the given size to the key matching path
+        '''
+
+        self.s3_client.put_object(Bucket=self.bucket, Key=path[1:], Body=b'\0' * size)
+        self.file_count += 1
+        self.byte_count += size
+
+    def put_sequence(self, pattern, start_frame, end_frame, size):
+        '''
+        Upload the frames of a sequence, plus frames outside the range and an unrelated file
+        sharing the prefix of the sequence
+        '''
+
+        for frame in range(start_frame - 2, end_frame + 3):
+            self.put_file(pattern % frame, size)
+
+        self.put_file("{}.tmp".format(pattern % start_frame), size)
+
+    def add_shot(self, index):
+
+        return self.database.add('Shot', {'code': "sh{:04d}".format(index),
+                                          'sg_cut_in': 1001,
+                                          'sg_cut_out': 1000 + self.frame_count})
+
+    def add_published_file(self, shot, code, path, type_code, step_code, downstream_published_files=None):
+
+        task = {'type': 'Task', 'id': shot['id']}
+        published_file = {'code': code,
+                          'name': code,
+                          'project': {'type': 'Project', 'id': self.project['id']},
+                          'entity': {'type': 'Shot', 'id': shot['id']},
+                          'task': task,
+                          'created_by': {'type': 'HumanUser', 'id': self.user['id']},
+                          'path': {'local_path': path, 'local_path_linux': path},
+                          'path_cache': path[1:],
+                          'downstream_published_files': downstream_published_files or [],
+                          'upstream_published_files': [],
+                          'sg_category': None,
+                          'project.Project.name': self.project['name'],
+                          'created_by.HumanUser.login': self.user['login'],
+                          'entity.Shot.sg_cut_in': shot['sg_cut_in'],
+                          'entity.Shot.sg_cut_out': shot['sg_cut_out'],
+                          'published_file_type.PublishedFileType.code': type_code,
+                          'task.Task.step.Step.code': step_code}
+
+        return self.database.add('PublishedFile', published_file)
+
+    def add_dependency_graph(self, shot):
+        '''
+        :returns: The PublishedFiles of the first level of the graph
+        :rtype: list of dict
+        '''
+
+        level = []
+
+        # The graph is built from the leaves up so that every file can link to the next level
+        for depth in reversed(range(self.depth)):
+
+            next_level = level
+            level = []
+
+            for index in range(self.width):
+
+                path = "{}/projects/{}/deps/level{}/file{:03d}.bin".format(self.root, shot['code'], depth, index)
+                self.put_file(path, self.file_size)
+
+                links = [ {'type': 'PublishedFile', 'id': next_level[(index + offset) % len(next_level)]['id']}
+                          for offset in range(min(self.fanout, len(next_level))) ]
+
+                level.append(self.add_published_file(shot, "{}_dep{}_{}".format(shot['code'], depth, index), path, 'Dependency', 'Asset', links))
+
+        return level
+
+    def make_event(self, published_file):
+
+        return {'id': next(self.event_ids),
+                'event_type': 'Shotgun_PublishedFile_New',
+                'entity': {'type': 'PublishedFile', 'id': published_file['id']},
+                'project': {'type': 'Project', 'id': self.project['id']},
+                'meta': {},
+                'user': {'type': 'HumanUser', 'id': self.user['id']}}
+
+    def add_scene_event(self, index):
+        '''
+        A lighting scene publish, processed by the Maya plugin
+
+        :returns: The event
+        :rtype: dict
+        '''
+
+        shot = self.add_shot(index)
+        dependencies = self.add_dependency_graph(shot)
+
+        path = "{}/projects/{}/light/{}_light_v001.ma".format(self.root, shot['code'], shot['code'])
+        self.put_file(path, self.file_size)
+
+        published_file = self.add_published_file(shot, "{}_light_v001".format(shot['code']), path, 'Maya Scene', 'Light',
+                                                  [ {'type': 'PublishedFile', 'id': dependency['id']} for dependency in dependencies ])
+
+        return self.make_event(published_file)
+
+    def add_render_event(self, index):
+        '''
+        A render publish, processed by the Nuke and CreateVersion plugins
+
+        :returns: The event
+        :rtype: dict
+        '''
+
+        shot = self.add_shot(index)
+
+        path = "{}/projects/renders/{}/{}_light_v001.%05d.exr".format(self.root, shot['code'], shot['code'])
+        self.put_sequence(path, shot['sg_cut_in'], shot['sg_cut_out'], self.frame_size)
+
+        published_file = self.add_published_file(shot, "{}_light_v001_render".format(shot['code']), path, 'Image', 'Light')
+
+        return self.make_event(published_file)
+
+    def add_plate(self, pattern):
+        '''
+        Upload the generic plate used by the Nuke plugin
+        '''
+
+        self.put_sequence(pattern, 1001, 1000 + self.frame_count, self.frame_size)
@@ -0,0 +1,446 @@
+'''
+Benchmark the daemon plugins against local stand-ins for Shotgun, S3 and Conductor.
+
+Synthetic lighting scene publishes (with a dependency graph) and render publishes are created,
+then every event is processed by SubmitMayaToConductorPlugin, SubmitNukeToConductorPlugin and
+CreateVersionPlugin as the daemon would. The report gives the events processed per second, the
+latency of each phase and the peak memory and disk usage.
+
+S3 is provided by moto and FFmpeg is replaced by a copy of its input, so this only needs boto3,
+moto and futures to be installed:
+
+    python run_benchmark.py --scene-events 20 --render-events 20 --depth 4 --width 25 --json results.json
+
+The SG_DAEMON_* environment variables (i.e. SG_DAEMON_DOWNLOAD_CONCURRENCY) are honoured, except
+for the paths of the caches and workspaces which are always in a temporary directory.
+'''
+
+import argparse
+import collections
+import inspect
+import json
+import logging
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import concurrent.futures
+
+import fake_services
+
+DAEMON_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The methods timed on the plugins, by phase. Phases can nest: job_build includes the dependency
+# resolution it triggers and encode includes the download of the frames. Generators are timed
+# while they run, not while their items are consumed.
+PHASES = [('entity_fetch', 'fetch_event_entity'),
+          ('dependency_resolution', 'iter_dependency_levels'),
+          ('download', 'copy_from_s3'),
+          ('download', 'stream_frames'),
+          ('job_build', 'build_conductor_job'),
+          ('encode', 'run_ffmpeg'),
+          ('version_create', 'create_version'),
+          ('version_upload', 'upload_movie')]
+
+# Stands in for FFmpeg, the frames are random data
+FFMPEG_STUB = "import shutil, sys; shutil.copyfileobj(sys.stdin, open(sys.argv[1], 'wb'))"
+
+
+def percentile(values, fraction):
+
+    if not values:
+        return None
+
+    values = sorted(values)
+
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+class PhaseTimer(object):
+    '''
+    Thread-safe record of the duration of every call, by phase
+    '''
+
+    def __init__(self):
+
+        self._lock = threading.Lock()
+        self.durations = collections.defaultdict(list)
+
+    def record(self, phase, duration):
+
+        with self._lock:
+            self.durations[phase].append(duration)
+
+    def timed(self, phase, func):
+        '''
+        :returns: func, recording the duration of every call to phase
+        :rtype: callable
+        '''
+
+        def wrapper(*args, **kwargs):
+
+            start_time = time.time()
+
+            try:
+                return func(*args, **kwargs)
+
+            finally:
+                self.record(phase, time.time() - start_time)
+
+        def generator_wrapper(*args, **kwargs):
+
+            duration = 0.0
+            iterator = func(*args, **kwargs)
+
+            try:
+                while True:
+                    start_time = time.time()
+
+                    try:
+                        item = next(iterator)
+
+                    finally:
+                        duration += time.time() - start_time
+
+                    yield item
+
+            except StopIteration:
+                pass
+
+            finally:
+                self.record(phase, duration)
+
+        if inspect.isgeneratorfunction(func):
+            wrapper = generator_wrapper
+
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+
+        return wrapper
+
+    def summary(self):
+
+        with self._lock:
+            durations = dict(self.durations)
+
+        return dict( (phase, {'count': len(values),
+                              'total': sum(values),
+                              'mean': sum(values) / len(values),
+                              'p50': percentile(values, 0.5),
+                              'p95': percentile(values, 0.95),
+                              'max': max(values)})
+                     for phase, values in durations.items() if values )
+
+
+class ResourceMonitor(threading.Thread):
+    '''
+    Samples the disk usage of a directory until stopped and keeps the peak
+    '''
+
+    def __init__(self, path, interval=0.1):
+
+        super(ResourceMonitor, self).__init__()
+
+        self.daemon = True
+        self.path = path
+        self.interval = interval
+        self.peak_disk_bytes = 0
+
+        self._stop_event = threading.Event()
+
+    def run(self):
+
+        while not self._stop_event.is_set():
+            self.peak_disk_bytes = max(self.peak_disk_bytes, self.get_disk_usage())
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+
+        self._stop_event.set()
+        self.join()
+
+    def get_disk_usage(self):
+
+        total = 0
+
+        for root, dir_list, file_list in os.walk(self.path):
+            for filename in file_list:
+                try:
+                    total += os.path.getsize(os.path.join(root, filename))
+
+                # Files come and go while the plugins run
+                except OSError:
+                    pass
+
+        return total
+
+    @staticmethod
+    def get_peak_rss():
+        '''
+        :returns: The peak resident memory (in bytes) of this process and of its children
+        :rtype: tuple (int, int)
+        '''
+
+        # ru_maxrss is in kilobytes on Linux
+        return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024)
+
+
+def instrument(plugin_cls, timer, attributes=None):
+    '''
+    Subclass plugin_cls so that the methods in PHASES are timed
+
+    :param plugin_cls: The plugin to instrument
+    :type plugin_cls: class
+
+    :param timer: The timer recording the phases
+    :type timer: PhaseTimer
+
+    :param attributes: Extra attributes of the subclass
+    :type attributes: dict
+
+    :rtype: class
+    '''
+
+    attributes = dict(attributes or {})
+
+    for phase, method_name in PHASES:
+
+        if not hasattr(plugin_cls, method_name):
+            continue
+
+        is_classmethod = any( isinstance(vars(klass).get(method_name), classmethod) for klass in plugin_cls.__mro__ )
+        func = timer.timed(phase, getattr(plugin_cls, method_name).__func__)
+
+        attributes[method_name] = classmethod(func) if is_classmethod else func
+
+    return type(plugin_cls.__name__, (plugin_cls,), attributes)
+
+
+def setup_environment(root):
+    '''
+    Configure the plugins through the environment. Must be called before they're imported.
+    '''
+
+    for name, value in [('SHOTGUN_SERVER', 'https://benchmark.shotgunstudio.com'),
+                        ('SHOTGUN_SCRIPT_NAME', 'benchmark'),
+                        ('SHOTGUN_SCRIPT_KEY', 'benchmark'),
+                        ('AWS_PROJECT_BUCKET', 'sg-daemon-benchmark'),
+                        ('AWS_ACCESS_KEY_ID', 'benchmark'),
+                        ('AWS_SECRET_ACCESS_KEY', 'benchmark'),
+                        ('AWS_DEFAULT_REGION', 'us-east-1'),
+                        ('SG_DAEMON_METRICS_FORMAT', 'none')]:
+        os.environ.setdefault(name, value)
+
+    # Nothing must be re-used from a previous run
+    os.environ['SG_DAEMON_FILE_CACHE_INDEX'] = os.path.join(root, 'cache', 'file_cache.json')
+    os.environ['SG_DAEMON_CATALOGUE_CACHE_SNAPSHOT'] = os.path.join(root, 'cache', 'catalogue.json')
+    os.environ['SG_DAEMON_UPLOAD_INDEX'] = os.path.join(root, 'cache', 'upload_index.db')
+    os.environ['SG_DAEMON_EVENT_WATERMARK_DIR'] = os.path.join(root, 'cache')
+    os.environ['SG_DAEMON_WORKSPACE_ROOT'] = os.path.join(root, 'workspaces')
+
+    for path in (DAEMON_DIR + '/src', DAEMON_DIR + '/plugins'):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+
+def parse_args(argv=None):
+
+    parser = argparse.ArgumentParser(description="Benchmark the Shotgun daemon plugins against local stand-ins")
+
+    parser.add_argument('--scene-events', type=int, default=10, help="Number of lighting scene publishes (Maya plugin)")
+    parser.add_argument('--render-events', type=int, default=10, help="Number of render publishes (Nuke and CreateVersion plugins)")
+    parser.add_argument('--workers', type=int, default=1, help="Number of events processed concurrently")
+
+    parser.add_argument('--depth', type=int, default=3, help="Number of levels of the dependency graph of a scene")
+    parser.add_argument('--width', type=int, default=10, help="Number of files per level of the dependency graph")
+    parser.add_argument('--fanout', type=int, default=3, help="Number of dependencies of every file in the graph")
+    parser.add_argument('--file-size', type=int, default=256*1024, help="Size (in bytes) of the scene and dependency files")
+    parser.add_argument('--frames', type=int, default=24, help="Number of frames of every Shot")
+    parser.add_argument('--frame-size', type=int, default=64*1024, help="Size (in bytes) of every frame")
+
+    parser.add_argument('--sg-latency', type=float, default=0.0, help="Latency (in seconds) of every Shotgun request")
+    parser.add_argument('--conductor-latency', type=float, default=0.0, help="Latency (in seconds) of every Conductor request")
+
+    parser.add_argument('--json', help="Write the results to this file")
+    parser.add_argument('--keep', action='store_true', help="Keep the temporary directory")
+    parser.add_argument('--verbose', action='store_true', help="Log what the plugins do")
+
+    return parser.parse_args(argv)
+
+
+def run(args):
+    '''
+    Run the benchmark
+
+    :returns: The results
+    :rtype: dict
+    '''
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+    logger = logging.getLogger('sg_daemon_benchmark')
+
+    root = tempfile.mkdtemp(prefix="sg_daemon_benchmark_")
+    setup_environment(root)
+
+    timer = PhaseTimer()
+    database = fake_services.FakeShotgunDatabase(latency=args.sg_latency)
+    conductor_stub = fake_services.ConductorStub(latency=args.conductor_latency, timer=timer.record)
+
+    fake_services.install_shotgun_stub(database)
+    fake_services.install_conductor_stub(conductor_stub)
+
+    # moto is only needed by the benchmark
+    try:
+        from moto import mock_s3
+    except ImportError:
+        from moto import mock_aws as mock_s3
+
+    s3_mock = mock_s3()
+    s3_mock.start()
+
+    try:
+        import boto3
+
+        import create_version
+        import submit_maya_render_to_conductor
+        import submit_nuke_template_to_conductor
+
+        bucket = os.environ['AWS_PROJECT_BUCKET']
+        s3_client = boto3.client('s3')
+        s3_client.create_bucket(Bucket=bucket)
+
+        project = fake_services.SyntheticProject(database, s3_client, bucket, os.path.join(root, 's3'),
+                                                 frame_count=args.frames,
+                                                 frame_size=args.frame_size,
+                                                 file_size=args.file_size,
+                                                 depth=args.depth,
+                                                 width=args.width,
+                                                 fanout=args.fanout)
+
+        shot_plate = "{}/projects/generic_plate.%05d.exr".format(project.root)
+        project.add_plate(shot_plate)
+
+        plugins = [instrument(submit_maya_render_to_conductor.SubmitMayaToConductorPlugin, timer),
+                   instrument(submit_nuke_template_to_conductor.SubmitNukeToConductorPlugin, timer,
+                              {'SHOT_PLATE': shot_plate}),
+                   instrument(create_version.CreateVersionPlugin, timer,
+                              {'get_ffmpeg_cmd': lambda self, profile_name, output_path: [sys.executable, "-c", FFMPEG_STUB, output_path]})]
+
+        events = []
+
+        for index in range(max(args.scene_events, args.render_events)):
+            if index < args.scene_events:
+                events.append(project.add_scene_event(len(events)))
+
+            if index < args.render_events:
+                events.append(project.add_render_event(len(events)))
+
+        logger.warning("Created {} events, {} files ({} bytes) on S3".format(len(events), project.file_count, project.byte_count))
+
+        # Only the processing of the events is measured
+        setup_calls = database.stats.as_dict()
+        database.stats = fake_services.ServiceStats()
+
+        event_latencies = []
+        failures = []
+
+        def process(event):
+
+            start_time = time.time()
+
+            for plugin_cls in plugins:
+                try:
+                    plugin_cls().main(plugin_cls.get_sg_instance(), logger, event)
+
+                except Exception as err:
+                    logger.exception("{} failed to process event {}".format(plugin_cls.__name__, event['id']))
+                    failures.append({'plugin': plugin_cls.__name__, 'event': event['id'], 'error': str(err)})
+
+            event_latencies.append(time.time() - start_time)
+
+        monitor = ResourceMonitor(root)
+        monitor.start()
+        start_time = time.time()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+            list(executor.map(process, events))
+
+        # Wait for the background encodes (SG_DAEMON_PROXY_FIRST)
+        if create_version.CreateVersionPlugin._background_executor is not None:
+            create_version.CreateVersionPlugin._background_executor.shutdown(wait=True)
+
+        duration = time.time() - start_time
+        monitor.stop()
+
+        peak_rss, peak_children_rss = monitor.get_peak_rss()
+
+        return {'events': len(events),
+                'failures': failures,
+                'duration': duration,
+                'events_per_second': len(events) / duration if duration else None,
+                'event_latency': {'mean': sum(event_latencies) / len(event_latencies) if event_latencies else None,
+                                  'p50': percentile(event_latencies, 0.5),
+                                  'p95': percentile(event_latencies, 0.95),
+                                  'max': max(event_latencies) if event_latencies else None},
+                'phases': timer.summary(),
+                'shotgun_calls': database.stats.as_dict(),
+                'shotgun_setup_calls': setup_calls,
+                'conductor_calls': conductor_stub.stats.as_dict(),
+                'conductor_jobs': len(conductor_stub.jobs),
+                'peak_rss_bytes': peak_rss,
+                'peak_children_rss_bytes': peak_children_rss,
+                'peak_disk_bytes': monitor.peak_disk_bytes,
+                'parameters': vars(args)}
+
+    finally:
+        s3_mock.stop()
+
+        if args.keep:
+            logger.warning("Kept {}".format(root))
+
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+def print_report(results):
+
+    print "Processed {} events in {:.2f}s: {:.2f} events/s ({} failures)".format(results['events'],
+                                                                              results['duration'],
+                                                                              results['events_per_second'] or 0,
+                                                                              len(results['failures']))
+    print "Event latency: mean {mean:.3f}s, p50 {p50:.3f}s, p95 {p95:.3f}s, max {max:.3f}s".format(**results['event_latency'])
+    print
+    print "{:<24}{:>8}{:>12}{:>10}{:>10}{:>10}{:>10}".format("Phase", "Calls", "Total (s)", "Mean", "p50", "p95", "Max")
+
+    for phase, stats in sorted(results['phases'].items()):
+        print "{:<24}{count:>8}{total:>12.3f}{mean:>10.3f}{p50:>10.3f}{p95:>10.3f}{max:>10.3f}".format(phase, **stats)
+
+    print
+    print "Shotgun calls: {}".format(results['shotgun_calls'])
+    print "Conductor calls: {} ({} jobs)".format(results['conductor_calls'], results['conductor_jobs'])
+    print "Peak RSS: {:.1f} MB (children {:.1f} MB)".format(results['peak_rss_bytes'] / 1024.0**2, results['peak_children_rss_bytes'] / 1024.0**2)
+    print "Peak disk: {:.1f} MB".format(results['peak_disk_bytes'] / 1024.0**2)
+
+
+def main(argv=None):
+
+    args = parse_args(argv)
+    results = run(args)
+
+    print_report(results)
+
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump(results, fh, indent=4, sort_keys=True)
+
+    # Fail CI if any event failed
+    return 1 if results['failures'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,11 +1,18 @@
+import collections
+import itertools
 import os
+import shutil
 import subprocess
 import sys
+import time
 
 import boto3
+import concurrent.futures
 
 import shotgun_api3
 
+import metrics
+import sg_batch
 import submit_to_conductor_base
 
     
@@ -18,85 +25,366 @@ class CreateVersionPlugin(submit_to_conductor_base.SubmitToConductorSGDaemonPlug
     '''
     
     EVENT = {"Shotgun_PublishedFile_New": None}
+    
+    PUBLISHED_FILE_FIELDS = submit_to_conductor_base.SubmitToConductorSGDaemonPlugin.PUBLISHED_FILE_FIELDS + [
+                                'project.Project.name',
+                                'upstream_published_files',
+                                'created_by.HumanUser.login',
+                                'entity.Shot.sg_cut_in',
+                                'entity.Shot.sg_cut_out']
+    
+    # Named FFmpeg settings for the review movies. max_width caps the resolution (None keeps the
+    # resolution of the frames) and threads=0 lets FFmpeg use every core.
+    ENCODE_PROFILES = {'proxy': {'max_width': 960, 'preset': 'ultrafast', 'crf': 30, 'threads': 1, 'fps': 24},
+                       'review': {'max_width': 1920, 'preset': 'veryfast', 'crf': 23, 'threads': 0, 'fps': 24},
+                       'full': {'max_width': None, 'preset': 'medium', 'crf': 18, 'threads': 0, 'fps': 24}}
+    
+    # The profile to use, by Project name and by Pipeline Step code. The project takes precedence.
+    PROJECT_ENCODE_PROFILES = {}
+    STEP_ENCODE_PROFILES = {}
+    DEFAULT_ENCODE_PROFILE = os.environ.get('SG_DAEMON_ENCODE_PROFILE', 'review')
+    
+    # Upload a proxy movie first and replace it with the selected profile in the background
+    PROXY_FIRST = os.environ.get('SG_DAEMON_PROXY_FIRST', '0') == '1'
+    PROXY_ENCODE_PROFILE = 'proxy'
+    
+    # The status the Task of the Version is set to, in the same request as the Version's creation.
+    # Empty to leave the Task as it is.
+    VERSION_TASK_STATUS = os.environ.get('SG_DAEMON_VERSION_TASK_STATUS', '')
+    
+    _background_executor = None
 
-    def main(self, sg, logger, event, args=None):
-        
-        self.sg = sg
-        self.logger = logger
-        
-        published_file_fields = [ 'code', 
-                                  'created_by',
-                                  'id',
-                                  'name',
-                                  'entity',
-                                  'path', 
-                                  'project',
-                                  'task',
-                                  'upstream_published_files',                               
-                                  'created_by.HumanUser.login', 
-                                  'entity.Shot.sg_cut_in', 
-                                  'entity.Shot.sg_cut_out',
-                                  'published_file_type.PublishedFileType.code',
-                                  'task.Task.step.Step.code',]
+    @classmethod
+    def accepts(cls, entity):
+        '''
+        Only exr images get a Version
+        '''
         
-        logger.info("Processing event {}: {}".format(event['id'], event))
+        return ( entity['published_file_type.PublishedFileType.code'] == 'Image' and
+                 cls.get_extension(entity) == "exr")
+
+    def handle_event(self, event):
         
-        self.event_entity = self.sg.find_one( event['entity']['type'],
-                                              [[ 'id', 'is', int(event['entity']['id']) ]],
-                                              published_file_fields)
+        self.logger.info("Processing event {}: {}".format(event['id'], event))
         
-        logger.debug("Event entity: {}".format(self.event_entity))
+        self.event_entity = self.get_event_entity(event)
         
-        file_path = self.event_entity['path']['local_path_linux']
-        extension = os.path.splitext(file_path)[-1][1:]
+        self.logger.debug("Event entity: {}".format(self.event_entity))
         
         # Publish any rendered images
-        if ( self.event_entity['published_file_type.PublishedFileType.code'] == 'Image' and 
-             extension == "exr"):
+        if self.accepts(self.event_entity):
+            
+            file_path = self.event_entity['path']['local_path_linux']
+            profile_name = self.get_encode_profile_name()
             
-            self.copy_from_s3(file_path)
-            self.create_mp4(file_path)
-            self.create_version()
+            replace_movie = self.PROXY_FIRST and profile_name != self.PROXY_ENCODE_PROFILE
+            encode_profile_name = self.PROXY_ENCODE_PROFILE if replace_movie else profile_name
+            
+            # The Version doesn't need the movie, it's created while the movie is encoded in 
+            # ASYNC_IO mode
+            version = self.run_concurrently(lambda: self.create_mp4(file_path, encode_profile_name),
+                                            self.create_version)[1]
+            self.complete_phase('encoded')
+            self.upload_movie(version)
+            
+            if replace_movie:
+                self.replace_movie_in_background(version, profile_name)
              
         else:
-            logger.info("Skipping. Extension is {}".format(extension))
+            self.logger.info("Skipping. Extension is {}".format(self.get_extension(self.event_entity)))
             
-    def create_mp4(self, input_file_seq):
+    def get_encode_profile_name(self):
         '''
-        Generate an MP4 from the given file sequence
+        Get the name of the encode profile for the event's Project and Pipeline Step
         
-        :param input_file_seq: The path to the file sequence. Must use FFMEG compatible sequence
-                               notation.
-        :type input_file_seq: 
+        :rtype: str
         '''
         
-        filename = os.path.basename(self.event_entity['path']['local_path'])
-        basename = ".".join(filename.split(".")[0:-2])
-        self.movie_output_path = "/tmp/{}.mp4".format(basename)
+        profile_name = ( self.PROJECT_ENCODE_PROFILES.get(self.event_entity.get('project.Project.name')) or
+                         self.STEP_ENCODE_PROFILES.get(self.event_entity.get('task.Task.step.Step.code')) or
+                         self.DEFAULT_ENCODE_PROFILE )
+        
+        if profile_name not in self.ENCODE_PROFILES:
+            raise Exception("Unknown encode profile '{}'".format(profile_name))
+        
+        return profile_name
+    
+    def get_ffmpeg_cmd(self, profile_name, output_path):
+        '''
+        Build the FFmpeg command to encode frames piped through stdin
+        
+        :param profile_name: The name of the encode profile
+        :type profile_name: str
+        
+        :param output_path: The path of the movie
+        :type output_path: str
+        
+        :rtype: list of str
+        '''
+        
+        profile = self.ENCODE_PROFILES[profile_name]
         
         cmd = [ "ffmpeg",
                 "-y", # Force overwrite
-                "-start_number", str(self.event_entity['entity.Shot.sg_cut_in']),                
-                "-i",
-                input_file_seq,
+                "-threads", str(profile['threads']),
+                "-f", "image2pipe",
+                "-c:v", self.render_extension,
+                "-framerate", str(profile['fps']),
+                "-i", "-",
                 "-c:v", "libx264",
-                "-vf", "fps=24",
-                self.movie_output_path]
+                "-preset", profile['preset'],
+                "-crf", str(profile['crf']),
+                "-threads", str(profile['threads']),
+                "-pix_fmt", "yuv420p"]
         
-        self.logger.debug("Executing '{}'".format(cmd))
-        ps = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        if profile['max_width']:
+            # Only ever scale down, keeping the height even for yuv420p
+            cmd.extend(["-vf", "scale='min({},iw)':-2".format(profile['max_width'])])
+            
+        cmd.append(output_path)
         
-        if ps.returncode != 0:
-            raise Exception("FFmpeg failed with a return code of {}".format(ps.returncode))
+        return cmd
+            
+    def create_mp4(self, input_file_seq, profile_name):
+        '''
+        Generate an MP4 from the given file sequence on S3.
+        
+        The frames are downloaded in order and piped to FFmpeg as soon as they arrive, so the
+        encode runs while the rest of the sequence is downloading. Every frame is deleted once it's
+        been fed to FFmpeg so only a window of frames is ever on disk.
+        
+        :param input_file_seq: The path to the file sequence on S3. Must use '%0[0-9]d' notation.
+        :type input_file_seq: str
+        
+        :param profile_name: The name of the encode profile to use
+        :type profile_name: str
+        '''
+        
+        filename = os.path.basename(self.event_entity['path']['local_path'])
+        basename = ".".join(filename.split(".")[0:-2])
+        self.movie_output_path = self.workspace.get_path("{}_{}.mp4".format(basename, profile_name))
         
-        if not os.path.exists(self.movie_output_path) or os.path.getsize(self.movie_output_path) == 0:
-            raise Exception("FFmpeg failed to create {}".format(self.movie_output_path))
+        # Only encode the frames of the cut, other frames sharing the render prefix are ignored
+        start_frame = self.event_entity.get('entity.Shot.sg_cut_in')
+        end_frame = self.event_entity.get('entity.Shot.sg_cut_out')
+        
+        s3_objects = self.get_s3_objects(input_file_seq, start_frame, end_frame, list_objects=not self.BUILD_SEQUENCE_KEYS)
+        
+        if not s3_objects:
+            raise Exception("Unable to find any frames for {}".format(input_file_seq))
+        
+        # Kept for the encode that replaces the movie (see PROXY_FIRST)
+        self.frame_objects = s3_objects
+        
+        cmd = self.get_ffmpeg_cmd(profile_name, self.movie_output_path)
+        self.run_ffmpeg(cmd, lambda stream: self.stream_frames(s3_objects, stream, self.workspace, self.logger, self.metrics), self.logger, self.metrics)
+        
+        self.workspace.check_quota()
 
-        self.logger.info("Created {} from {}".format(self.movie_output_path, input_file_seq))
+        self.logger.info("Created {} from {} frames of {} ({})".format(self.movie_output_path, len(s3_objects), input_file_seq, profile_name))
+        
+    def run_ffmpeg(self, cmd, write_frames, logger, metrics=None):
+        '''
+        Run FFmpeg, feeding it frames through stdin, and wait for it to complete. Also runs on the
+        background thread, after the event has ended, so it doesn't use the event's attributes.
+        
+        :param cmd: The FFmpeg command
+        :type cmd: list of str
+        
+        :param write_frames: Called with FFmpeg's stdin to write the frames to it
+        :type write_frames: callable
+        
+        :param logger: The logger of the event the encode is for
+        :type logger: logging.Logger
+        
+        :param metrics: The metrics of the event the encode is for. None to not record the encode.
+        :type metrics: metrics.EventMetrics
+        
+        :returns: The value returned by write_frames
+        '''
+        
+        output_path = cmd[-1]
+        log_path = "{}.log".format(output_path)
+        result = None
+        
+        logger.debug("Executing '{}'".format(cmd))
+        
+        with open(log_path, 'w') as log_fh:
+            start_time = time.time()
+            ps = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=log_fh, stderr=subprocess.STDOUT)
+            
+            try:
+                result = write_frames(ps.stdin)
+                
+            except IOError:
+                # FFmpeg exited early, its return code is checked below
+                logger.warning("FFmpeg stopped reading frames")
+                
+            finally:
+                ps.stdin.close()
+                ps.wait()
+                
+                # Includes the time spent waiting for the frames to download
+                if metrics is not None:
+                    metrics.add_time('encode', time.time() - start_time)
+        
+        if ps.returncode != 0:
+            with open(log_path) as log_fh:
+                ffmpeg_log = log_fh.read()[-2000:]
+                
+            raise Exception("FFmpeg failed with a return code of {}:\n{}".format(ps.returncode, ffmpeg_log))
+        
+        if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
+            raise Exception("FFmpeg failed to create {}".format(output_path))
+        
+        return result
+        
+    def stream_frames(self, s3_objects, stream, workspace, logger, metrics):
+        '''
+        Download the frames into the workspace and write them to stream, in order. Up to 
+        DOWNLOAD_CONCURRENCY frames are downloaded ahead of the one being written, by the threads
+        of the shared downloader. Every frame is deleted once it's been written. Like run_ffmpeg it
+        also runs on the background thread so it doesn't use the event's attributes.
+        
+        :param s3_objects: The frames to download
+        :type s3_objects: list of dict (S3 objects)
+        
+        :param stream: The file object the frames are written to
+        :type stream: file
+        
+        :param workspace: The workspace of the event the frames are for
+        :type workspace: submit_to_conductor_base.EventWorkspace
+        
+        :param logger: The logger of the event the frames are for
+        :type logger: logging.Logger
+        
+        :param metrics: The metrics the downloads are recorded in
+        :type metrics: metrics.EventMetrics
+        '''
+        
+        downloader = self.get_downloader()
+        frames_dir = workspace.get_path("frames")
+        
+        if not os.path.exists(frames_dir):
+            os.makedirs(frames_dir)
+        
+        def download(s3_object):
+            try:
+                # Keys built from the frame range have no known size, it's reserved once downloaded
+                with workspace.reserve(s3_object.get('Size', 0)):
+                    frame_path = downloader.download_file(s3_object['Key'], os.path.join(frames_dir, os.path.basename(s3_object['Key'])))
+                    
+                if 'Size' not in s3_object:
+                    with workspace.reserve(os.path.getsize(frame_path)):
+                        pass
+                    
+                return frame_path
+            
+            except Exception as err:
+                # Keys built from the frame range may not exist
+                if not downloader.is_missing(err):
+                    raise
+                
+                logger.warning("Skipping missing frame {}".format(s3_object['Key']))
+                return None
+        
+        pending = collections.deque()
+        s3_objects = iter(s3_objects)
+        
+        try:
+            for s3_object in itertools.islice(s3_objects, self.DOWNLOAD_CONCURRENCY):
+                pending.append(downloader.executor.submit(download, s3_object))
             
+            while pending:
+                frame_path = pending.popleft().result()
+                
+                for s3_object in itertools.islice(s3_objects, 1):
+                    pending.append(downloader.executor.submit(download, s3_object))
+                    
+                if frame_path is None:
+                    continue
+                
+                frame_size = os.path.getsize(frame_path)
+                
+                metrics.add('files_downloaded')
+                metrics.add('bytes_downloaded', frame_size)
+                
+                with open(frame_path, 'rb') as fh:
+                    shutil.copyfileobj(fh, stream)
+                
+                os.remove(frame_path)
+                workspace.free(frame_size)
+                
+        # The frames being downloaded are waited for, the workspace may be removed once this returns
+        finally:
+            for future in pending:
+                future.cancel()
+            
+            concurrent.futures.wait(pending)
+    
+    def replace_movie_in_background(self, version, profile_name):
+        '''
+        Encode the frames with the given profile and replace the movie of the Version with it. The
+        encode runs on a background thread after the event has completed, the workspace is kept 
+        until it's done. The frames are streamed from S3 again, so only a window of frames is on
+        disk at any time, and the encode's metrics are emitted separately from the event's.
+        
+        :param version: The Version to update
+        :type version: dict (Version entity)
+        
+        :param profile_name: The name of the encode profile to use
+        :type profile_name: str
+        '''
+        
+        cls = CreateVersionPlugin
+        
+        with cls._lock:
+            if cls._background_executor is None:
+                cls._background_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        
+        # Everything the background encode needs is captured here as the plugin's attributes will
+        # be reset by the next event
+        workspace = self.workspace
+        frame_objects = self.frame_objects
+        logger = self.logger
+        movie_output_path = self.movie_output_path.replace("_{}.mp4".format(self.PROXY_ENCODE_PROFILE),
+                                                           "_{}.mp4".format(profile_name))
+        cmd = self.get_ffmpeg_cmd(profile_name, movie_output_path)
+        encode_metrics = metrics.EventMetrics("{}.replace_movie".format(type(self).__name__), self.event_id)
+        
+        def replace_movie():
+            status = 'failure'
+            
+            try:
+                self.run_ffmpeg(cmd, lambda stream: self.stream_frames(frame_objects, stream, workspace, logger, encode_metrics), logger, encode_metrics)
+                
+                with encode_metrics.timed('version_upload'):
+                    self.get_sg_instance().upload("Version", version['id'], movie_output_path, 'sg_uploaded_movie')
+                    
+                encode_metrics.add('bytes_uploaded', os.path.getsize(movie_output_path))
+                logger.info("Replaced the movie of Version {} with {}".format(version['id'], movie_output_path))
+                status = 'success'
+                
+            except Exception:
+                logger.exception("Failed to replace the movie of Version {}".format(version['id']))
+                
+            finally:
+                workspace.release()
+                encode_metrics.stop(status)
+                self.emit_metrics(encode_metrics)
+        
+        workspace.retain()
+        cls._background_executor.submit(replace_movie)
+                    
     def create_version(self):
         '''
-        Create a Shotgun Version and upload the generated mp4
+        Create a Shotgun Version for the event's PublishedFile. A resumed event re-uses the Version
+        created by its previous attempts.
+        
+        The Version is created and its Task updated (see VERSION_TASK_STATUS) in a single batch.
+        
+        :returns: The new Version
+        :rtype: dict (Version entity)
         '''
         
         version_data = {'code':self.event_entity['code'],
@@ -108,9 +396,37 @@ class CreateVersionPlugin(submit_to_conductor_base.SubmitToConductorSGDaemonPlug
                         'sg_path_to_frames': self.event_entity['path']['local_path'],
                         'published_files': [self.event_entity]}
 
-        new_version = self.sg.create("Version", data=version_data)
-      
-        self.sg.upload("Version", new_version['id'], self.movie_output_path, 'sg_uploaded_movie')
+        new_version = self.job_data.get('version')
+        
+        with self.metrics.timed('version_create'):
+            
+            if new_version is None:
+                batch = sg_batch.ShotgunBatch(self.sg, logger=self.logger)
+                batch.create("Version", version_data)
+                
+                if self.VERSION_TASK_STATUS and self.event_entity['task']:
+                    batch.update("Task", self.event_entity['task']['id'], {'sg_status_list': self.VERSION_TASK_STATUS})
+                    
+                new_version = batch.commit()[0]
+                self.complete_phase('version_created', version={'type': 'Version', 'id': new_version['id']})
+                
+            else:
+                self.logger.info("Re-using Version {} created by a previous attempt".format(new_version['id']))
+        
+        return new_version
+    
+    def upload_movie(self, version):
+        '''
+        Upload the generated mp4 to the Version
+        
+        :param version: The Version
+        :type version: dict (Version entity)
+        '''
+        
+        with self.metrics.timed('version_upload'):
+            self.sg.upload("Version", version['id'], self.movie_output_path, 'sg_uploaded_movie')
+            
+        self.metrics.add('bytes_uploaded', os.path.getsize(self.movie_output_path))
 
  
 def registerCallbacks(reg):
@@ -12,41 +12,37 @@ class SubmitMayaToConductorPlugin(submit_to_conductor_base.SubmitToConductorSGDa
     Shotgun daemon plugin to submit a Maya render whenever a lighting sceme is published    
     '''
 
-    def main(self, sg, logger, event, args=None):
-        
-        self.sg = sg
-        self.logger = logger
-        
-        published_file_fields = [ 'code',
-                                  'created_by',
-                                  'entity', 
-                                  'id',                                  
-                                  'name',
-                                  'path', 
-                                  'project',
-                                  'sg_category',
-                                  'task', 
-                                  'downstream_published_files',                               
-                                  'created_by.HumanUser.login', 
-                                  'entity.Shot.sg_cut_in', 
-                                  'entity.Shot.sg_cut_out',
-                                  'published_file_type.PublishedFileType.code',
-                                  'task.Task.step.Step.code',]
-        
-        logger.debug("Processing event {}: {}".format(event['id'], event))
-        
-        self.event_entity = self.sg.find_one( event['entity']['type'],
-                                              [[ 'id', 'is', int(event['entity']['id']) ]],
-                                              published_file_fields)
-                
-        # Get the extension, stripping out the leading period
-        file_path = self.event_entity['path']['local_path_linux'] 
-        extension = os.path.splitext(file_path)[-1][1:]
+    PUBLISHED_FILE_FIELDS = submit_to_conductor_base.SubmitToConductorSGDaemonPlugin.PUBLISHED_FILE_FIELDS + [
+                                'sg_category',
+                                'downstream_published_files',
+                                'created_by.HumanUser.login',
+                                'entity.Shot.sg_cut_in',
+                                'entity.Shot.sg_cut_out']
+
+    @classmethod
+    def accepts(cls, entity):
+        '''
+        Only Maya scenes published by Lighting are rendered
+        '''
+        
+        return ( entity['published_file_type.PublishedFileType.code'] == 'Maya Scene' and
+                 cls.get_extension(entity) in ("ma", "mb") and
+                 entity['task.Task.step.Step.code'] == 'Light')
 
+    def handle_event(self, event):
+        
+        self.logger.debug("Processing event {}: {}".format(event['id'], event))
+        
+        self.event_entity = self.get_event_entity(event)
+        
+        # The scene has the fields needed to walk its dependencies, it doesn't need to be fetched
+        # again when they're gathered for the upload
+        self.published_file_cache[self.event_entity['id']] = self.event_entity
+        
+        self.logger.debug("Event entity: {}".format(self.event_entity))
+        
         # Maya Lighting files - submit to conductor
-        if ( self.event_entity['published_file_type.PublishedFileType.code'] == 'Maya Scene' and
-             extension in ("ma", "mb") and
-             self.event_entity['task.Task.step.Step.code'] == 'Light'):            
+        if self.accepts(self.event_entity):
         
             start_frame = self.event_entity['entity.Shot.sg_cut_in']
             end_frame = self.event_entity['entity.Shot.sg_cut_out']
@@ -58,14 +54,28 @@ class SubmitMayaToConductorPlugin(submit_to_conductor_base.SubmitToConductorSGDa
             # The job title - as it would appear in Conductor
             self.job_title = self.event_entity['code']         
             
-            self.s3_dest_path = "projects/renders/{}_{}_{}".format(self.job_title, self.event_entity['id'], datetime.datetime.now().strftime("%Y%m%d-%H%M%S"))
+            # A resumed event renders to the same location as its previous attempts
+            self.s3_dest_path = ( self.job_data.get('s3_dest_path') or
+                                  "projects/renders/{}_{}_{}".format(self.job_title, self.event_entity['id'], datetime.datetime.now().strftime("%Y%m%d-%H%M%S")) )
+            self.save_job_data(s3_dest_path=self.s3_dest_path)
             self.file_pattern = self.get_file_pattern()
                                 
-            logger.info("Submitting published file: {}".format(self.event_entity.keys()))            
+            self.logger.info("Submitting published file: {}".format(self.event_entity.keys()))            
             self.submit_to_conductor(start_frame, end_frame)      
         
         else:
-            logger.info("Skipping. Extension is {}".format(extension))
+            self.logger.info("Skipping. Extension is {}".format(self.get_extension(self.event_entity)))
+            
+    @classmethod
+    def get_coalesce_key(cls, entity):
+        '''
+        Successive publishes of a scene for the same Shot and Task supersede each other
+        '''
+        
+        if entity['published_file_type.PublishedFileType.code'] != 'Maya Scene' or not entity['entity'] or not entity['task']:
+            return None
+        
+        return (entity['entity']['type'], entity['entity']['id'], entity['task']['id'])
             
     def get_file_pattern(self):
         '''
@@ -91,12 +101,10 @@ class SubmitMayaToConductorPlugin(submit_to_conductor_base.SubmitToConductorSGDa
         file_path = self.event_entity['path']['local_path_linux']
         self.copy_from_s3(file_path)
         
-        # Gather all the dependencies and copy them from cloud storage
-        dependency_entities = self.get_dependency_entities(self.event_entity['downstream_published_files'])        
-        self.logger.info("Found {} dependencies".format(len(dependency_entities)))
-
-        for dependency in dependency_entities:
-            self.copy_from_s3(dependency['path']['local_path_linux']) 
+        # Gather all the dependencies and copy them from cloud storage. Every level of the graph
+        # downloads while the next one is queried.
+        dependency_entities = self.copy_dependencies_from_s3(self.event_entity['downstream_published_files'])
+        self.logger.info("Copied {} dependencies".format(len(dependency_entities)))
     
     def build_conductor_job(self, start_frame, end_frame):
         '''
@@ -145,6 +153,7 @@ class SubmitMayaToConductorPlugin(submit_to_conductor_base.SubmitToConductorSGDa
         conductor_job.environment = { 'CONDUCTOR_OUTPUT_PATH': conductor_job.output_path,
                                       'CONDUCTOR_S3_BUCKET': self.S3_BUCKET,
                                       'CONDUCTOR_S3_PATH': self.file_pattern[1:],
+                                      'PUBLISH_DATA_PATH': self.publish_data_path,
                                       'PYTHONPATH': '/shotgun',
                                       'MAYA_ENABLE_LEGACY_RENDER_LAYERS': 1 }
         
@@ -154,12 +163,18 @@ class SubmitMayaToConductorPlugin(submit_to_conductor_base.SubmitToConductorSGDa
         
         # Ensure that post/pre render scripts get uploaded
         conductor_job.upload_paths.append(self.POST_RENDER_SCRIPT_PATH)
+        conductor_job.upload_paths.append(self.RENDER_UPLOADER_SCRIPT_PATH)
         conductor_job.upload_paths.append(self.REGISTER_PUBLISH_SCRIPT_PATH)
-        conductor_job.upload_paths.append("/tmp/published_file.json")
+        conductor_job.upload_paths.append(self.publish_data_path)
 
+        # Frames are uploaded in the background while the task renders
+        conductor_job.pre_task_cmd = "python {} start".format(self.RENDER_UPLOADER_SCRIPT_PATH)
         conductor_job.post_task_cmd = "python {}".format(self.POST_RENDER_SCRIPT_PATH)
         conductor_job.post_job_cmd = "python {}".format(self.REGISTER_PUBLISH_SCRIPT_PATH)
 
+        # Split the job into frame chunks and share the upload paths between them
+        self.apply_frame_chunk(conductor_job)
+        
         conductor_job._get_environment()
         
         return conductor_job
@@ -179,7 +194,7 @@ class SubmitMayaToConductorPlugin(submit_to_conductor_base.SubmitToConductorSGDa
         # This can stay hard-coded, be queried from a CustomEntity in Shotgun or perhaps
         # be in the metadata of the scene file publish        
 
-        host_package = conductor.lib.package_utils.get_host_package("maya-io", "Autodesk Maya 2018.1", strict=False)
+        host_package = self.get_host_package("maya-io", "Autodesk Maya 2018.1")
         package_ids.append(host_package['package'])
         package_ids.append(host_package['v-ray-maya']['3.60.04'])     
 
@@ -18,40 +18,32 @@ class SubmitNukeToConductorPlugin(submit_to_conductor_base.SubmitToConductorSGDa
     NUKE_TEMPLATE_PATH = "/usr/local/shotgun/support_files/nuke_template.nk"    
     SHOT_PLATE = "/projects/generic_plate.%05d.exr"   
     
-    def main(self, sg, logger, event, args=None):
-        
-        self.sg = sg
-        self.logger = logger
-        
-        published_file_fields = [ 'code',
-                                  'created_by',
-                                  'entity', 
-                                  'id',                                  
-                                  'name',
-                                  'path', 
-                                  'project',
-                                  'task', 
-                                  'downstream_published_files',                               
-                                  'created_by.HumanUser.login', 
-                                  'entity.Shot.sg_cut_in', 
-                                  'entity.Shot.sg_cut_out',
-                                  'published_file_type.PublishedFileType.code',
-                                  'task.Task.step.Step.code',]
-        
-        logger.info("Processing event {}: {}".format(event['id'], event))
-        
-        self.event_entity = self.sg.find_one( event['entity']['type'],
-                                              [[ 'id', 'is', int(event['entity']['id']) ]],
-                                              published_file_fields)
-        
-        # Get the extension, stripping out the leading period
-        file_path = self.event_entity['path']['local_path_linux'] 
-        extension = os.path.splitext(file_path)[-1][1:]
+    PUBLISHED_FILE_FIELDS = submit_to_conductor_base.SubmitToConductorSGDaemonPlugin.PUBLISHED_FILE_FIELDS + [
+                                'downstream_published_files',
+                                'created_by.HumanUser.login',
+                                'entity.Shot.sg_cut_in',
+                                'entity.Shot.sg_cut_out']
 
+    @classmethod
+    def accepts(cls, entity):
+        '''
+        Only the exr renders of Lighting are pre-comped
+        '''
+        
+        return ( entity['published_file_type.PublishedFileType.code'] == 'Image' and
+                 entity['task.Task.step.Step.code'] == 'Light' and
+                 cls.get_extension(entity) == "exr")
+
+    def handle_event(self, event):
+        
+        self.logger.info("Processing event {}: {}".format(event['id'], event))
+        
+        self.event_entity = self.get_event_entity(event)
+        
+        self.logger.debug("Event entity: {}".format(self.event_entity))
+        
         # Maya Renders files - submit precomp to conductor
-        if ( self.event_entity['published_file_type.PublishedFileType.code'] == 'Image' and 
-             self.event_entity['task.Task.step.Step.code'] == 'Light' and 
-             extension == "exr"):
+        if self.accepts(self.event_entity):
             
             start_frame = self.event_entity['entity.Shot.sg_cut_in']
             end_frame = self.event_entity['entity.Shot.sg_cut_out']
@@ -63,14 +55,17 @@ class SubmitNukeToConductorPlugin(submit_to_conductor_base.SubmitToConductorSGDa
             # The job title - as it would appear in Conductor
             self.job_title = self.event_entity['code']         
             
-            self.s3_dest_path = "projects/renders/{}_{}_{}".format(self.job_title, self.event_entity['id'], datetime.datetime.now().strftime("%Y%m%d-%H%M%S"))
+            # A resumed event renders to the same location as its previous attempts
+            self.s3_dest_path = ( self.job_data.get('s3_dest_path') or
+                                  "projects/renders/{}_{}_{}".format(self.job_title, self.event_entity['id'], datetime.datetime.now().strftime("%Y%m%d-%H%M%S")) )
+            self.save_job_data(s3_dest_path=self.s3_dest_path)
             self.file_pattern = self.get_file_pattern()
                  
-            logger.info("Submitting published file: {}".format(self.event_entity))
+            self.logger.info("Submitting published file: {}".format(self.event_entity))
             self.submit_to_conductor(start_frame, end_frame)        
         
         else:
-            logger.info("Skipping. Extension is {}".format(extension))
+            self.logger.info("Skipping. Extension is {}".format(self.get_extension(self.event_entity)))
             
     def get_file_pattern(self):
         '''
@@ -95,9 +90,12 @@ class SubmitNukeToConductorPlugin(submit_to_conductor_base.SubmitToConductorSGDa
         '''
         
         file_path = self.event_entity['path']['local_path_linux']
-        self.copy_from_s3(file_path)
+        start_frame = self.event_entity['entity.Shot.sg_cut_in']
+        end_frame = self.event_entity['entity.Shot.sg_cut_out']
         
-        self.copy_from_s3(self.SHOT_PLATE)
+        # Only the frames of the cut are needed from the render and the plate
+        self.run_concurrently(lambda: self.copy_from_s3(file_path, start_frame, end_frame),
+                              lambda: self.copy_from_s3(self.SHOT_PLATE, start_frame, end_frame))
         
     def build_conductor_job(self, start_frame, end_frame):
         '''
@@ -143,22 +141,28 @@ class SubmitNukeToConductorPlugin(submit_to_conductor_base.SubmitToConductorSGDa
         conductor_job.environment = { 'CONDUCTOR_OUTPUT_PATH': conductor_job.output_path,
                                       'CONDUCTOR_S3_BUCKET': self.S3_BUCKET,
                                       'CONDUCTOR_S3_PATH': self.file_pattern[1:],
+                                      'PUBLISH_DATA_PATH': self.publish_data_path,
                                       'PYTHONPATH': '/shotgun'}
 
         # Ensure that post/pre render scripts get uploaded
         conductor_job.upload_paths.append(self.SHOT_PLATE)
         conductor_job.upload_paths.append(self.event_entity['path']['local_path'])       
         conductor_job.upload_paths.append(self.POST_RENDER_SCRIPT_PATH)
+        conductor_job.upload_paths.append(self.RENDER_UPLOADER_SCRIPT_PATH)
         conductor_job.upload_paths.append(self.REGISTER_PUBLISH_SCRIPT_PATH)
-        conductor_job.upload_paths.append("/tmp/published_file.json")
+        conductor_job.upload_paths.append(self.publish_data_path)
 
-        conductor_job.pre_task_cmd = "mkdir -p {}".format(conductor_job.output_path)
+        # Frames are uploaded in the background while the task renders
+        conductor_job.pre_task_cmd = "mkdir -p {} && python {} start".format(conductor_job.output_path, self.RENDER_UPLOADER_SCRIPT_PATH)
         conductor_job.post_task_cmd = "python {}".format(self.POST_RENDER_SCRIPT_PATH)
         conductor_job.post_job_cmd = "python {}".format(self.REGISTER_PUBLISH_SCRIPT_PATH)
         conductor_job.argv = "{plate_path} {render_path} {output_path}".format( plate_path=self.SHOT_PLATE,
                                                                                 render_path=self.event_entity['path']['local_path'],
                                                                                 output_path=self.file_pattern)        
 
+        # Split the job into frame chunks and share the upload paths between them
+        self.apply_frame_chunk(conductor_job)
+        
         conductor_job._get_environment()
         
         return conductor_job
@@ -177,7 +181,7 @@ class SubmitNukeToConductorPlugin(submit_to_conductor_base.SubmitToConductorSGDa
         # We're hard-coding the Conductor job to use Nuke 11.3v5
         # This can stay hard-coded, be queried from a CustomEntity in Shotgun or perhaps
         # be in the metadata of the scene file publish        
-        host_package = conductor.lib.package_utils.get_host_package("nuke", "11.3v5", strict=False)
+        host_package = self.get_host_package("nuke", "11.3v5")
         package_ids.append(host_package['package'])  
 
         return package_ids        
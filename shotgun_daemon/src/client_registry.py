@@ -0,0 +1,86 @@
+'''
+Long-lived clients shared by all the plugins running in the daemon process.
+
+Creating a client means a new connection (and TLS handshake) for the first request it makes, so
+the clients are created once and re-used for every event.
+'''
+
+import threading
+
+import boto3
+import botocore.config
+import shotgun_api3
+
+
+_lock = threading.Lock()
+_thread_data = threading.local()
+
+_boto3_session = None
+_s3_clients = {}
+
+
+def get_shotgun(server, script_name, script_key):
+    '''
+    Get a Shotgun connection for the current thread.
+
+    shotgun_api3.Shotgun instances are not thread-safe so one connection is kept per thread and
+    per set of credentials.
+
+    :returns: The Shotgun connection
+    :rtype: shotgun_api3.Shotgun
+    '''
+
+    connections = getattr(_thread_data, 'shotgun_connections', None)
+
+    if connections is None:
+        connections = _thread_data.shotgun_connections = {}
+
+    key = (server, script_name, script_key)
+
+    if key not in connections:
+        connections[key] = shotgun_api3.Shotgun(server, script_name, script_key)
+
+    return connections[key]
+
+
+def get_boto3_session():
+    '''
+    Get the boto3 session used to create all the clients. Sessions are not thread-safe, they must
+    only be used while holding the lock.
+
+    :rtype: boto3.session.Session
+    '''
+
+    global _boto3_session
+
+    with _lock:
+        if _boto3_session is None:
+            _boto3_session = boto3.session.Session()
+
+    return _boto3_session
+
+
+def get_s3_client(region_name=None, max_pool_connections=32):
+    '''
+    Get the S3 client for the given region. Unlike sessions, clients are thread-safe so a single
+    client (and its connection pool) is shared by every thread.
+
+    :param region_name: The AWS region. None for the default region.
+    :type region_name: str
+
+    :param max_pool_connections: The size of the connection pool. Only used when the client is
+                                 first created.
+    :type max_pool_connections: int
+
+    :rtype: botocore.client.S3
+    '''
+
+    session = get_boto3_session()
+
+    with _lock:
+
+        if region_name not in _s3_clients:
+            config = botocore.config.Config(max_pool_connections=max_pool_connections)
+            _s3_clients[region_name] = session.client('s3', region_name=region_name, config=config)
+
+        return _s3_clients[region_name]
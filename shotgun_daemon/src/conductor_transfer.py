@@ -0,0 +1,209 @@
+import base64
+import binascii
+import hashlib
+import json
+import logging
+import time
+
+import concurrent.futures
+import requests
+
+import conductor.lib.api_client
+
+
+class S3ObjectReader(object):
+    '''
+    A file-like view of the body of an S3 object with a known length, so that it can be streamed
+    as the body of an HTTP request
+    '''
+
+    def __init__(self, body, size, chunk_size=1024*1024):
+
+        self.body = body
+        self.size = size
+        self.chunk_size = chunk_size
+
+    def read(self, amount=None):
+        return self.body.read(amount)
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+
+        while True:
+            chunk = self.body.read(self.chunk_size)
+
+            if not chunk:
+                break
+
+            yield chunk
+
+
+class S3ToConductorUploader(object):
+    '''
+    Uploads objects from an S3 bucket to Conductor's storage without staging them on local disk.
+    Each object body is streamed from S3 straight into the upload URL Conductor gives for it.
+
+    Conductor identifies files by the base64 encoded md5 of their content. The md5 is taken from
+    the object's ETag when it's a plain md5, otherwise (multipart uploads) the object is streamed
+    through md5 once and the result is kept in the upload index.
+    '''
+
+    def __init__(self, bucket, s3_client, index, max_workers=8, max_retries=3, retry_delay=1.0, logger=None):
+        '''
+        :param bucket: The bucket the objects are in
+        :type bucket: str
+
+        :param s3_client: The S3 client to use. Its connection pool should be able to hold
+                          max_workers connections.
+        :type s3_client: botocore.client.S3
+
+        :param index: Keeps the md5 of the objects whose ETag isn't their md5
+        :type index: upload_index.UploadIndex
+
+        :param max_workers: The number of objects hashed or uploaded concurrently
+        :type max_workers: int
+
+        :param max_retries: The number of times a failed upload is retried
+        :type max_retries: int
+
+        :param retry_delay: The delay (in seconds) before the first retry. Doubled on every retry.
+        :type retry_delay: float
+        '''
+
+        self.bucket = bucket
+        self.s3_client = s3_client
+        self.index = index
+        self.max_workers = max(1, int(max_workers))
+        self.max_retries = max(0, int(max_retries))
+        self.retry_delay = retry_delay
+        self.logger = logger or logging.getLogger(__name__)
+
+        self.http_session = requests.Session()
+
+    def get_md5(self, s3_object):
+        '''
+        :param s3_object: The object, as listed by list_objects_v2 (Key, ETag, Size)
+        :type s3_object: dict
+
+        :returns: The base64 encoded md5 of the object
+        :rtype: str
+        '''
+
+        etag = s3_object['ETag'].strip('"')
+
+        # Multipart ETags are the md5 of the md5 of the parts, followed by the number of parts
+        if '-' not in etag:
+            return base64.b64encode(binascii.unhexlify(etag))
+
+        md5 = self.index.get_s3_md5(s3_object['Key'], etag)
+
+        if md5 is not None:
+            return md5
+
+        self.logger.debug("Hashing s3://{}/{}".format(self.bucket, s3_object['Key']))
+
+        digest = hashlib.md5()
+        body = self.s3_client.get_object(Bucket=self.bucket, Key=s3_object['Key'], IfMatch=s3_object['ETag'])['Body']
+
+        for chunk in S3ObjectReader(body, s3_object['Size']):
+            digest.update(chunk)
+
+        md5 = base64.b64encode(digest.digest())
+        self.index.set_s3_md5(s3_object['Key'], etag, md5)
+
+        return md5
+
+    def get_upload_urls(self, md5s, project=None):
+        '''
+        Ask Conductor where to upload the given files. Files already in Conductor's storage are
+        left out of the response.
+
+        :param md5s: The md5 of every file, by path
+        :type md5s: dict
+
+        :param project: The Conductor project of the job
+        :type project: str
+
+        :returns: The upload URL of the files that need to be uploaded, by path
+        :rtype: dict
+        '''
+
+        data = {'upload_files': md5s, 'project': project}
+
+        response, response_code = conductor.lib.api_client.ApiClient().make_request("api/v1/files/get_upload_urls",
+                                                                                     verb="POST",
+                                                                                     headers={'Content-Type': 'application/json'},
+                                                                                     data=json.dumps(data),
+                                                                                     raise_on_error=True,
+                                                                                     use_api_key=True)
+
+        return json.loads(response) if response else {}
+
+    def upload_object(self, s3_object, md5, upload_url):
+        '''
+        Stream a single object from S3 to its upload URL, retrying on errors
+        '''
+
+        attempt = 0
+
+        while True:
+            try:
+                body = self.s3_client.get_object(Bucket=self.bucket, Key=s3_object['Key'], IfMatch=s3_object['ETag'])['Body']
+
+                try:
+                    response = self.http_session.put(upload_url,
+                                                     data=S3ObjectReader(body, s3_object['Size']),
+                                                     headers={'Content-MD5': md5,
+                                                              'Content-Type': 'application/octet-stream'})
+                    response.raise_for_status()
+
+                finally:
+                    body.close()
+
+                return
+
+            except Exception as err:
+
+                if attempt >= self.max_retries:
+                    raise
+
+                delay = self.retry_delay * (2 ** attempt)
+                attempt += 1
+                self.logger.warning("Failed to upload {} ({}). Retrying in {}s [{}/{}]".format(s3_object['Key'], err, delay, attempt, self.max_retries))
+                time.sleep(delay)
+
+    def upload(self, files, project=None):
+        '''
+        Upload the given objects to Conductor's storage, skipping the ones it already has
+
+        :param files: The S3 objects (Key, ETag, Size), by the path the job refers to them with
+        :type files: dict
+
+        :param project: The Conductor project of the job
+        :type project: str
+
+        :returns: The md5 of every file, by path. Can be given to the job as its upload_files.
+        :rtype: dict
+        '''
+
+        if not files:
+            return {}
+
+        paths = list(files)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.max_workers, len(paths))) as executor:
+
+            md5s = dict(zip(paths, executor.map(lambda path: self.get_md5(files[path]), paths)))
+            upload_urls = self.get_upload_urls(md5s, project)
+
+            self.logger.info("Streaming {} of {} files from s3 bucket {} to Conductor".format(len(upload_urls), len(paths), self.bucket))
+
+            futures = [ executor.submit(self.upload_object, files[path], md5s[path], upload_url)
+                        for path, upload_url in upload_urls.items() ]
+
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+
+        return md5s
@@ -0,0 +1,219 @@
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+
+class LocalFileCache(object):
+    '''
+    Keeps track of the files downloaded from S3 so that they can be reused across events.
+
+    A cached file is only considered valid if the ETag and size of its S3 object haven't changed
+    and the local file still has the expected size. When the total size of the cached files
+    exceeds the budget, the least recently used files are deleted from disk.
+
+    Files in use by an event must be pinned until the event is done with them. Pins are counted
+    so that the events sharing a file each hold their own, pinned files are never evicted.
+    '''
+
+    def __init__(self, index_path, max_bytes=None, logger=None):
+        '''
+        :param index_path: The json file where the cache index is persisted
+        :type index_path: str
+
+        :param max_bytes: The size budget of the cache. None for unlimited.
+        :type max_bytes: int
+        '''
+
+        self.index_path = index_path
+        self.max_bytes = max_bytes
+        self.logger = logger or logging.getLogger(__name__)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.RLock()
+        self._entries = {}
+        self._pins = collections.Counter()
+
+        self.load()
+
+    def load(self):
+        '''
+        Load the index from disk, dropping entries for files that no longer exist
+        '''
+
+        with self._lock:
+
+            if not os.path.exists(self.index_path):
+                return
+
+            try:
+                with open(self.index_path) as fh:
+                    entries = json.load(fh)
+
+            except (IOError, ValueError) as err:
+                self.logger.warning("Unable to read cache index {} ({}). Starting empty".format(self.index_path, err))
+                return
+
+            self._entries = dict( (path, entry) for path, entry in entries.items() if os.path.exists(path) )
+
+    def save(self):
+        '''
+        Persist the index to disk
+        '''
+
+        with self._lock:
+
+            parent_dir = os.path.dirname(self.index_path)
+
+            if parent_dir and not os.path.exists(parent_dir):
+                os.makedirs(parent_dir)
+
+            tmp_path = "{}.tmp".format(self.index_path)
+
+            with open(tmp_path, 'w') as fh:
+                json.dump(self._entries, fh)
+
+            os.rename(tmp_path, self.index_path)
+
+    def lookup(self, file_path, etag, size):
+        '''
+        Check if file_path holds an up-to-date copy of an S3 object. Updates the hit/miss counters.
+
+        :param file_path: The local path of the file
+        :type file_path: str
+
+        :param etag: The ETag of the S3 object
+        :type etag: str
+
+        :param size: The size of the S3 object
+        :type size: int
+
+        :returns: True if the cached file can be used
+        :rtype: bool
+        '''
+
+        with self._lock:
+
+            entry = self._entries.get(file_path)
+
+            valid = ( entry is not None and
+                      entry['etag'] == etag and
+                      entry['size'] == size and
+                      os.path.exists(file_path) and
+                      os.path.getsize(file_path) == size )
+
+            if valid:
+                entry['last_access'] = time.time()
+                self.hits += 1
+
+            else:
+                self._entries.pop(file_path, None)
+                self.misses += 1
+
+            return valid
+
+    def add(self, file_path, key, etag, size):
+        '''
+        Record a file that has been downloaded from S3
+        '''
+
+        with self._lock:
+            self._entries[file_path] = {'key': key,
+                                        'etag': etag,
+                                        'size': size,
+                                        'last_access': time.time()}
+
+    def pin(self, file_paths):
+        '''
+        Protect the files from eviction until they're unpinned
+
+        :param file_paths: The local paths of the files
+        :type file_paths: list of str
+        '''
+
+        with self._lock:
+            self._pins.update(file_paths)
+
+    def unpin(self, file_paths):
+        '''
+        Release pins taken with pin(). A file can be evicted once all its pins are released.
+
+        :param file_paths: The local paths of the files, once for every time they were pinned
+        :type file_paths: list of str
+        '''
+
+        with self._lock:
+            self._pins.subtract(file_paths)
+
+            for file_path in set(file_paths):
+                if self._pins[file_path] <= 0:
+                    del self._pins[file_path]
+
+    def total_size(self):
+
+        with self._lock:
+            return sum( entry['size'] for entry in self._entries.values() )
+
+    def evict(self):
+        '''
+        Delete the least recently used files that aren't pinned until the cache is within its
+        budget
+
+        :returns: The paths that were evicted
+        :rtype: list of str
+        '''
+
+        if self.max_bytes is None:
+            return []
+
+        evicted = []
+
+        with self._lock:
+
+            total_size = self.total_size()
+            entries = sorted(self._entries.items(), key=lambda item: item[1]['last_access'])
+
+            for file_path, entry in entries:
+
+                if total_size <= self.max_bytes:
+                    break
+
+                if self._pins.get(file_path, 0) > 0:
+                    continue
+
+                try:
+                    os.remove(file_path)
+
+                except OSError as err:
+                    if os.path.exists(file_path):
+                        self.logger.warning("Unable to evict {} ({})".format(file_path, err))
+                        continue
+
+                del self._entries[file_path]
+                total_size -= entry['size']
+                evicted.append(file_path)
+
+            self.evictions += len(evicted)
+
+        if evicted:
+            self.logger.info("Evicted {} files from the cache".format(len(evicted)))
+
+        return evicted
+
+    def stats(self):
+        '''
+        :returns: The cache counters
+        :rtype: dict
+        '''
+
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'files': len(self._entries),
+                    'bytes': self.total_size()}
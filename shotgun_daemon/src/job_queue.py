@@ -0,0 +1,321 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+
+class JobQueue(object):
+    '''
+    A persistent record of the events processed by every plugin, so that an event interrupted by
+    a failure or a restart can be retried and resume from the last phase it completed.
+
+    Every job goes through the states:
+
+    * held - held by the plugin's EventCoalescer, processed once its window elapses
+    * superseded - held, then superseded by a newer event, won't be processed
+    * running - being processed
+    * retry - failed (or interrupted by a restart), waiting to be retried once next_attempt is due
+    * done - processed successfully
+    * failed - failed too many times, won't be retried
+
+    The phases completed by a job and the data it needs to resume (i.e. the ids of the Conductor
+    jobs already submitted) are kept in its data.
+    '''
+
+    SCHEMA = ['CREATE TABLE IF NOT EXISTS jobs (plugin TEXT, event_id INTEGER, event TEXT, state TEXT, phase TEXT, '
+              'attempts INTEGER, next_attempt REAL, error TEXT, data TEXT, updated_at REAL, PRIMARY KEY (plugin, event_id))',
+              'CREATE INDEX IF NOT EXISTS jobs_state ON jobs (plugin, state, next_attempt)']
+
+    FIELDS = ['plugin', 'event_id', 'event', 'state', 'phase', 'attempts', 'next_attempt', 'error', 'data', 'updated_at']
+
+    def __init__(self, db_path, logger=None):
+        '''
+        :param db_path: The path of the sqlite database
+        :type db_path: str
+        '''
+
+        self.db_path = db_path
+        self.logger = logger or logging.getLogger(__name__)
+
+        self._thread_data = threading.local()
+
+        parent_dir = os.path.dirname(db_path)
+
+        if parent_dir and not os.path.exists(parent_dir):
+            os.makedirs(parent_dir)
+
+        connection = self.get_connection()
+        connection.execute('PRAGMA journal_mode=WAL')
+
+        for statement in self.SCHEMA:
+            connection.execute(statement)
+
+        connection.commit()
+
+    def get_connection(self):
+        '''
+        sqlite connections can't be shared between threads so every thread gets its own.
+
+        :rtype: sqlite3.Connection
+        '''
+
+        connection = getattr(self._thread_data, 'connection', None)
+
+        if connection is None:
+            connection = self._thread_data.connection = sqlite3.connect(self.db_path, timeout=30)
+
+        return connection
+
+    def get_job(self, plugin, event_id):
+        '''
+        :returns: The job or None if the event was never queued for the plugin
+        :rtype: dict
+        '''
+
+        row = self.get_connection().execute('SELECT {} FROM jobs WHERE plugin=? AND event_id=?'.format(", ".join(self.FIELDS)),
+                                            (plugin, event_id)).fetchone()
+
+        if row is None:
+            return None
+
+        job = dict(zip(self.FIELDS, row))
+        job['event'] = json.loads(job['event'])
+        job['data'] = json.loads(job['data'])
+
+        return job
+
+    def start(self, plugin, event):
+        '''
+        Record that the plugin is processing the event. Events seen for the first time are
+        queued, events waiting to be retried are resumed.
+
+        :param plugin: The name of the plugin
+        :type plugin: str
+
+        :param event: The event
+        :type event: dict (EventLogEntry entity)
+
+        :returns: The job or None if the event is already being processed, has been processed,
+                  has been superseded or has failed for good
+        :rtype: dict
+        '''
+
+        now = time.time()
+        connection = self.get_connection()
+
+        with connection:
+            connection.execute('INSERT OR IGNORE INTO jobs (plugin, event_id, event, state, attempts, next_attempt, data, updated_at) '
+                               'VALUES (?, ?, ?, ?, 0, 0, ?, ?)',
+                               (plugin, event['id'], json.dumps(event, default=str), 'retry', '{}', now))
+
+            cursor = connection.execute('UPDATE jobs SET state=?, attempts=attempts+1, updated_at=? WHERE plugin=? AND event_id=? AND state IN (?, ?)',
+                                        ('running', now, plugin, event['id'], 'retry', 'held'))
+
+        if cursor.rowcount == 0:
+            return None
+
+        return self.get_job(plugin, event['id'])
+
+    def hold(self, plugin, event):
+        '''
+        Record that the plugin holds the event, so that it can be held again after a restart
+
+        :param plugin: The name of the plugin
+        :type plugin: str
+
+        :param event: The event
+        :type event: dict (EventLogEntry entity)
+        '''
+
+        connection = self.get_connection()
+
+        with connection:
+            connection.execute('INSERT OR IGNORE INTO jobs (plugin, event_id, event, state, attempts, next_attempt, data, updated_at) '
+                               'VALUES (?, ?, ?, ?, 0, NULL, ?, ?)',
+                               (plugin, event['id'], json.dumps(event, default=str), 'held', '{}', time.time()))
+
+    def supersede(self, plugin, event_id):
+        '''
+        Record that a held event was superseded by a newer one
+        '''
+
+        connection = self.get_connection()
+
+        with connection:
+            connection.execute('UPDATE jobs SET state=?, updated_at=? WHERE plugin=? AND event_id=? AND state=?',
+                               ('superseded', time.time(), plugin, event_id, 'held'))
+
+    def get_held(self, plugin):
+        '''
+        :returns: The events held by the plugin, oldest first
+        :rtype: list of dict
+        '''
+
+        rows = self.get_connection().execute('SELECT event FROM jobs WHERE plugin=? AND state=? ORDER BY event_id',
+                                             (plugin, 'held')).fetchall()
+
+        return [ json.loads(event) for event, in rows ]
+
+    def set_phase(self, plugin, event_id, phase, data):
+        '''
+        Record the last phase completed by the job and the data needed to resume it
+
+        :param data: Must be json serializable
+        :type data: dict
+        '''
+
+        connection = self.get_connection()
+
+        with connection:
+            connection.execute('UPDATE jobs SET phase=?, data=?, updated_at=? WHERE plugin=? AND event_id=?',
+                               (phase, json.dumps(data), time.time(), plugin, event_id))
+
+    def complete(self, plugin, event_id):
+
+        connection = self.get_connection()
+
+        with connection:
+            connection.execute('UPDATE jobs SET state=?, error=NULL, updated_at=? WHERE plugin=? AND event_id=?',
+                               ('done', time.time(), plugin, event_id))
+
+    def fail(self, plugin, event_id, error, max_attempts, retry_delay):
+        '''
+        Record a failed attempt. The job is retried with an exponential backoff until it has been
+        attempted max_attempts times.
+
+        :param error: The error the attempt failed with
+        :type error: str
+
+        :param max_attempts: The number of attempts before giving up
+        :type max_attempts: int
+
+        :param retry_delay: The delay (in seconds) before the first retry. Doubled on every retry.
+        :type retry_delay: float
+
+        :returns: The new state of the job, 'retry' or 'failed'
+        :rtype: str
+        '''
+
+        job = self.get_job(plugin, event_id)
+        now = time.time()
+
+        if job['attempts'] >= max_attempts:
+            state, next_attempt = 'failed', None
+
+        else:
+            state, next_attempt = 'retry', now + retry_delay * (2 ** (job['attempts'] - 1))
+
+        connection = self.get_connection()
+
+        with connection:
+            connection.execute('UPDATE jobs SET state=?, next_attempt=?, error=?, updated_at=? WHERE plugin=? AND event_id=?',
+                               (state, next_attempt, error, now, plugin, event_id))
+
+        return state
+
+    def recover(self, plugin):
+        '''
+        Make the jobs that were running when the daemon stopped due for a retry. Must only be
+        called before the plugin processes any event.
+
+        :returns: The number of jobs recovered
+        :rtype: int
+        '''
+
+        connection = self.get_connection()
+
+        with connection:
+            cursor = connection.execute('UPDATE jobs SET state=?, next_attempt=? WHERE plugin=? AND state=?',
+                                        ('retry', time.time(), plugin, 'running'))
+
+        return cursor.rowcount
+
+    def claim_due(self, plugin, claim_timeout=600):
+        '''
+        Get the events of the jobs due for a retry. They aren't returned again for claim_timeout
+        seconds, unless they fail in the meantime.
+
+        :returns: The events
+        :rtype: list of dict
+        '''
+
+        now = time.time()
+        connection = self.get_connection()
+
+        with connection:
+            rows = connection.execute('SELECT event_id, event FROM jobs WHERE plugin=? AND state=? AND next_attempt<=? ORDER BY event_id',
+                                      (plugin, 'retry', now)).fetchall()
+
+            connection.executemany('UPDATE jobs SET next_attempt=? WHERE plugin=? AND event_id=?',
+                                   [ (now + claim_timeout, plugin, event_id) for event_id, event in rows ])
+
+        return [ json.loads(event) for event_id, event in rows ]
+
+    def purge(self, older_than):
+        '''
+        Delete the jobs that completed or were superseded more than older_than seconds ago
+        '''
+
+        connection = self.get_connection()
+
+        with connection:
+            connection.execute('DELETE FROM jobs WHERE state IN (?, ?) AND updated_at<?', ('done', 'superseded', time.time() - older_than))
+
+
+class RetryScheduler(threading.Thread):
+    '''
+    Polls the queue for the jobs of a plugin that are due for a retry and dispatches their events
+    '''
+
+    def __init__(self, queue, plugin, dispatch, interval=10.0, retention=7*24*3600, logger=None):
+        '''
+        :param queue: The job queue
+        :type queue: JobQueue
+
+        :param plugin: The name of the plugin
+        :type plugin: str
+
+        :param dispatch: Called with every event to retry
+        :type dispatch: callable
+
+        :param interval: The time (in seconds) between two polls
+        :type interval: float
+
+        :param retention: The time (in seconds) completed jobs are kept for
+        :type retention: float
+        '''
+
+        super(RetryScheduler, self).__init__()
+
+        self.daemon = True
+        self.queue = queue
+        self.plugin = plugin
+        self.dispatch = dispatch
+        self.interval = interval
+        self.retention = retention
+        self.logger = logger or logging.getLogger(__name__)
+
+        self._stop_event = threading.Event()
+
+    def run(self):
+
+        while not self._stop_event.is_set():
+
+            try:
+                for event in self.queue.claim_due(self.plugin):
+                    self.logger.info("Retrying event {} for {}".format(event['id'], self.plugin))
+                    self.dispatch(event)
+
+                self.queue.purge(self.retention)
+
+            # Keep polling, the next poll will pick up where this one failed
+            except Exception:
+                self.logger.exception("Failed to retry the jobs of {}".format(self.plugin))
+
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+
+        self._stop_event.set()
@@ -0,0 +1,324 @@
+'''
+Per-event metrics of the daemon plugins.
+
+Every event gets an EventMetrics that counts what the plugin did (Shotgun requests, files
+downloaded, cache hits, ...) and times its phases. When the event completes the metrics are
+written as a single json line on stdout, either as a plain json record or in the CloudWatch
+embedded metric format (EMF), and added to a MetricsRegistry that can be scraped by Prometheus.
+'''
+
+import BaseHTTPServer
+import collections
+import contextlib
+import json
+import logging
+import resource
+import sys
+import threading
+import time
+
+
+# CloudWatch units of the metrics, by suffix of their name
+EMF_UNITS = [('_seconds', 'Seconds'), ('_bytes', 'Bytes')]
+
+
+def get_metrics_logger():
+    '''
+    Get the logger the metrics records are written to. The records are written as-is to stdout
+    so that CloudWatch can parse them.
+
+    :rtype: logging.Logger
+    '''
+
+    logger = logging.getLogger('sg_daemon.metrics')
+
+    if not logger.handlers:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+
+    return logger
+
+
+class EventMetrics(object):
+    '''
+    The counters and phase timings of a single event. Thread-safe so that work spread over
+    several threads can be accounted for.
+    '''
+
+    def __init__(self, plugin, event_id):
+        '''
+        :param plugin: The name of the plugin processing the event
+        :type plugin: str
+
+        :param event_id: The id of the event
+        :type event_id: int
+        '''
+
+        self.plugin = plugin
+        self.event_id = event_id
+        self.status = None
+
+        self.counters = collections.Counter()
+        self.timings = collections.defaultdict(float)
+
+        self._lock = threading.Lock()
+        self._start_time = time.time()
+        self._start_cpu = self.get_cpu_time()
+        self._duration = None
+
+    @staticmethod
+    def get_cpu_time():
+
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+
+        return usage.ru_utime + usage.ru_stime
+
+    def add(self, name, value=1):
+        '''
+        Increment the counter name by value
+        '''
+
+        with self._lock:
+            self.counters[name] += value
+
+    def add_time(self, phase, duration):
+        '''
+        Add duration (in seconds) to the time spent in phase
+        '''
+
+        with self._lock:
+            self.timings[phase] += duration
+
+    @contextlib.contextmanager
+    def timed(self, phase):
+        '''
+        Context manager adding the time spent in its block to phase. Phases can nest.
+        '''
+
+        start_time = time.time()
+
+        try:
+            yield
+
+        finally:
+            self.add_time(phase, time.time() - start_time)
+
+    def stop(self, status):
+        '''
+        Mark the event as completed
+
+        :param status: 'success' or 'failure'
+        :type status: str
+        '''
+
+        self.status = status
+        self._duration = time.time() - self._start_time
+
+        # The CPU time is the process', other events processed concurrently are included
+        self.add('cpu_seconds', self.get_cpu_time() - self._start_cpu)
+
+    def as_dict(self):
+        '''
+        :returns: The metrics as a flat dict. Timings are suffixed with '_seconds'.
+        :rtype: dict
+        '''
+
+        with self._lock:
+            record = dict(self.counters)
+            record.update( ("{}_seconds".format(phase), duration) for phase, duration in self.timings.items() )
+
+        record['duration_seconds'] = self._duration if self._duration is not None else time.time() - self._start_time
+
+        # ru_maxrss is in kilobytes on Linux
+        record['max_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+        return record
+
+    def to_json(self):
+        '''
+        :returns: The metrics as a plain json record
+        :rtype: str
+        '''
+
+        record = {'plugin': self.plugin, 'event_id': self.event_id, 'status': self.status, 'metrics': self.as_dict()}
+
+        return json.dumps(record, sort_keys=True)
+
+    def to_emf(self, namespace):
+        '''
+        :param namespace: The CloudWatch namespace of the metrics
+        :type namespace: str
+
+        :returns: The metrics in CloudWatch's embedded metric format
+        :rtype: str
+        '''
+
+        values = self.as_dict()
+        definitions = []
+
+        for name in sorted(values):
+            unit = next( (unit for suffix, unit in EMF_UNITS if name.endswith(suffix)), 'Count' )
+            definitions.append({'Name': name, 'Unit': unit})
+
+        record = {'_aws': {'Timestamp': int(time.time() * 1000),
+                           'CloudWatchMetrics': [{'Namespace': namespace,
+                                                  'Dimensions': [['Plugin']],
+                                                  'Metrics': definitions}]},
+                  'Plugin': self.plugin,
+                  'EventId': self.event_id,
+                  'Status': self.status}
+        record.update(values)
+
+        return json.dumps(record, sort_keys=True)
+
+
+class InstrumentedShotgun(object):
+    '''
+    Wraps a Shotgun connection to count and time the requests made through it.
+
+    shotgun_api3 connections are not thread-safe. When a connection_factory is given, requests
+    made from another thread than the one that created the wrapper use the connection returned
+    by the factory for that thread instead.
+    '''
+
+    REQUESTS = ('find', 'find_one', 'create', 'update', 'delete', 'batch', 'upload', 'summarize')
+
+    def __init__(self, sg, event_metrics, connection_factory=None):
+        '''
+        :param sg: The Shotgun connection
+        :type sg: shotgun_api3.Shotgun
+
+        :param event_metrics: The metrics the requests are recorded to
+        :type event_metrics: EventMetrics
+
+        :param connection_factory: Called with no arguments to get the connection of the current
+                                   thread
+        :type connection_factory: callable
+        '''
+
+        self._sg = sg
+        self._metrics = event_metrics
+        self._connection_factory = connection_factory
+        self._thread = threading.current_thread()
+
+    def __getattr__(self, name):
+
+        sg = self._sg
+
+        if self._connection_factory is not None and threading.current_thread() is not self._thread:
+            sg = self._connection_factory()
+
+        attribute = getattr(sg, name)
+
+        if name not in self.REQUESTS:
+            return attribute
+
+        def request(*args, **kwargs):
+
+            self._metrics.add('shotgun_requests')
+
+            with self._metrics.timed('shotgun'):
+                return attribute(*args, **kwargs)
+
+        return request
+
+
+class MetricsRegistry(object):
+    '''
+    Aggregates the metrics of every event processed by the daemon, by plugin
+    '''
+
+    PREFIX = 'sg_daemon'
+
+    def __init__(self):
+
+        self._lock = threading.Lock()
+        self._events = collections.Counter()
+        self._totals = collections.defaultdict(collections.Counter)
+        self._max_rss = 0
+
+    def record(self, event_metrics):
+        '''
+        Add the metrics of a completed event
+
+        :type event_metrics: EventMetrics
+        '''
+
+        values = event_metrics.as_dict()
+
+        with self._lock:
+            self._events[(event_metrics.plugin, event_metrics.status)] += 1
+            self._max_rss = max(self._max_rss, values.pop('max_rss_bytes'))
+            self._totals[event_metrics.plugin].update(values)
+
+    def render_prometheus(self):
+        '''
+        :returns: The aggregated metrics in the Prometheus text format
+        :rtype: str
+        '''
+
+        lines = []
+
+        with self._lock:
+
+            lines.append("# TYPE {}_events_total counter".format(self.PREFIX))
+
+            for (plugin, status), count in sorted(self._events.items()):
+                lines.append('{}_events_total{{plugin="{}",status="{}"}} {}'.format(self.PREFIX, plugin, status, count))
+
+            names = sorted(set( name for totals in self._totals.values() for name in totals ))
+
+            for name in names:
+                lines.append("# TYPE {}_{}_total counter".format(self.PREFIX, name))
+
+                for plugin, totals in sorted(self._totals.items()):
+                    if name in totals:
+                        lines.append('{}_{}_total{{plugin="{}"}} {}'.format(self.PREFIX, name, plugin, totals[name]))
+
+            lines.append("# TYPE {}_max_rss_bytes gauge".format(self.PREFIX))
+            lines.append("{}_max_rss_bytes {}".format(self.PREFIX, self._max_rss))
+
+        return "\n".join(lines) + "\n"
+
+
+def start_http_server(port, registry, logger=None):
+    '''
+    Serve the metrics of registry on http://0.0.0.0:port/metrics from a background thread
+
+    :returns: The server
+    :rtype: BaseHTTPServer.HTTPServer
+    '''
+
+    logger = logger or logging.getLogger(__name__)
+
+    class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+
+            body = registry.render_prometheus()
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    server = BaseHTTPServer.HTTPServer(('', port), MetricsHandler)
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    logger.info("Serving metrics on port {}".format(port))
+
+    return server
@@ -1,11 +1,13 @@
+import json
 import os
-import boto3
+
+import render_uploader
 
 print "------------------------Running post-render-script------------------------------"
 
-output_path = os.environ.get('CONDUCTOR_OUTPUT_PATH', None)
-s3_bucket = os.environ.get('CONDUCTOR_S3_BUCKET', None)
-s3_path_root = os.environ.get('CONDUCTOR_S3_PATH', None)
+output_path = render_uploader.output_path
+s3_bucket = render_uploader.s3_bucket
+s3_path_root = render_uploader.s3_path_root
 
 
 if output_path is None:
@@ -14,25 +16,69 @@ if output_path is None:
 if s3_bucket is None:
     raise Exception("Environment variable 'CONDUCTOR_S3_BUCKET' is not defined.")
 
+# Let the background uploader started by pre_task_cmd finish the frames it's uploading
+render_uploader.stop()
+uploaded = render_uploader.read_journal()
+
+uploader = render_uploader.Uploader()
+
+# Upload the frames the background uploader hasn't, or that changed since it uploaded them
 print "Scanning output path '{}'".format(output_path)
-src_paths = []
-for root, dir_list, file_list in os.walk(output_path):
-
-    for filename in file_list:
-        src_paths.append(os.path.join(root, filename))
-        
-file_count = len(src_paths)
-print "Transferring {} files to s3 bucket".format(file_count)
-
-s3 = boto3.client('s3')
-
-for index, path in enumerate(src_paths):
-    
-    file_size = os.path.getsize(path)    
-    frame = path.split(".")[-2]
-    dest_path = s3_path_root % int(frame)
-    
-    print "[{}/{}] Uploading {} ({}) to {}".format(index+1, file_count, path, file_size, dest_path)
-    s3.upload_file(path, s3_bucket, dest_path)
-
-print "Transfer to s3 complete."
\ No newline at end of file
+for path, (size, mtime) in sorted(render_uploader.scan_output_path().items()):
+
+    # Logs and temporary files written next to the frames aren't uploaded
+    if render_uploader.get_frame(path) is None:
+        continue
+
+    entry = uploaded.get(path)
+
+    if entry and (entry['size'], entry['mtime']) == (size, mtime):
+        continue
+
+    uploaded.pop(path, None)
+    uploader.put(path)
+
+uploader.join()
+
+manifest = uploader.manifest
+errors = uploader.errors
+
+# Verify the frames uploaded in the background are on S3, listing their directory in one go
+if uploaded:
+
+    prefix = os.path.dirname(s3_path_root) + "/"
+    objects = {}
+
+    for page in uploader.s3.get_paginator('list_objects_v2').paginate(Bucket=s3_bucket, Prefix=prefix):
+        objects.update([ (obj['Key'], obj) for obj in page.get('Contents', []) ])
+
+    for entry in uploaded.values():
+        s3_object = objects.get(entry['key'])
+
+        if s3_object is None or s3_object['Size'] != entry['size'] or s3_object['ETag'] != entry['etag']:
+            errors.append((entry['path'], "{} doesn't match the uploaded file".format(entry['key'])))
+
+        else:
+            manifest.append(entry)
+
+    print "Verified {} files uploaded while rendering".format(len(uploaded))
+
+manifest.sort(key=lambda entry: entry['frame'])
+print "Transferred {} files to s3 bucket".format(len(manifest))
+
+if manifest:
+
+    # Keep a record of what was uploaded next to the frames
+    manifest_path = os.path.join("/tmp", "upload_manifest.{}-{}.json".format(manifest[0]['frame'], manifest[-1]['frame']))
+
+    with open(manifest_path, 'w') as fh:
+        json.dump(manifest, fh, indent=4)
+
+    manifest_key = "{}/{}".format(os.path.dirname(s3_path_root), os.path.basename(manifest_path))
+    uploader.s3.upload_file(manifest_path, s3_bucket, manifest_key)
+    print "Wrote manifest {}".format(manifest_key)
+
+if errors:
+    raise Exception("Failed to upload {} files to s3: {}".format(len(errors), errors))
+
+print "Transfer to s3 complete."
@@ -1,22 +1,69 @@
 import json
 import os
 import pprint
+import sys
 
 import shotgun_api3
 
 SERVER = os.environ['SHOTGUN_SERVER']
 SCRIPT_NAME = os.environ['SHOTGUN_SCRIPT_NAME']
 SCRIPT_KEY = os.environ['SHOTGUN_SCRIPT_KEY']
+PUBLISH_DATA_PATH = os.environ.get('PUBLISH_DATA_PATH', "/tmp/published_file.json")
+
+# Set when the render was split into several jobs. Every job runs this script but the publish is 
+# only registered once all the frames of the range are on S3, by the first job to find them.
+PUBLISH_FRAME_RANGE = os.environ.get('PUBLISH_FRAME_RANGE', None)
     
 print "Registering publish of file to Shotgun"
 
 sg = shotgun_api3.Shotgun(SERVER, SCRIPT_NAME, SCRIPT_KEY)
 
-with open("/tmp/published_file.json") as fh:
+with open(PUBLISH_DATA_PATH) as fh:
     data = json.load(fh)
     
 print "Using data:"
 pprint.pprint(data, indent=4)
 
-entity = sg.create("PublishedFile", data=data)
+if PUBLISH_FRAME_RANGE:
+    
+    import boto3
+    
+    s3_bucket = os.environ['CONDUCTOR_S3_BUCKET']
+    s3_path_root = os.environ['CONDUCTOR_S3_PATH']
+    start_frame, end_frame = [ int(frame) for frame in PUBLISH_FRAME_RANGE.split("-") ]
+    
+    publish_filters = [[ 'code', 'is', data['code'] ], 
+                       [ 'path_cache', 'ends_with', os.path.basename(data['path']['local_path']) ]]
+    
+    # Another chunk of the render may have registered it already
+    existing_publish = sg.find_one("PublishedFile", publish_filters)
+    
+    if existing_publish:
+        print "Already published as {}. Skipping".format(existing_publish)
+        sys.exit(0)
+    
+    # List everything under the sequence's directory in one go rather than a request per frame
+    prefix = os.path.dirname(s3_path_root) + "/"
+    keys = set()
+    
+    for page in boto3.client('s3').get_paginator('list_objects_v2').paginate(Bucket=s3_bucket, Prefix=prefix):
+        keys.update([ obj['Key'] for obj in page.get('Contents', []) ])
+        
+    missing_frames = [ frame for frame in range(start_frame, end_frame + 1) if s3_path_root % frame not in keys ]
+    
+    # The chunk rendering them will publish
+    if missing_frames:
+        print "{} frames are still rendering. Skipping".format(len(missing_frames))
+        sys.exit(0)
+        
+    entity = sg.create("PublishedFile", data=data)
+    
+    # Chunks that complete together may both have found every frame. The oldest publish is kept.
+    publishes = sg.find("PublishedFile", publish_filters, order=[{'field_name': 'id', 'direction': 'asc'}])
+    
+    if publishes and publishes[0]['id'] != entity['id']:
+        print "Already published as {}. Removing PublishedFile {}".format(publishes[0], entity['id'])
+        sg.delete("PublishedFile", entity['id'])
 
+else:
+    entity = sg.create("PublishedFile", data=data)
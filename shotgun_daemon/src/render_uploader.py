@@ -0,0 +1,487 @@
+'''
+Uploads the frames of a Conductor task to S3 while the task is still rendering.
+
+    python render_uploader.py start
+
+is run as the task's pre_task_cmd. It starts a background process that polls CONDUCTOR_OUTPUT_PATH
+and uploads every frame once the renderer has closed it and it has stopped changing. Every upload
+is recorded in a journal. A background process left running by a previous task is killed first.
+
+post_render_script.py (the task's post_task_cmd) stops the background process, uploads the files
+that aren't in the journal and verifies all of them are on S3.
+'''
+
+import json
+import os
+import Queue
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import boto3
+import boto3.s3.transfer
+import botocore.config
+
+
+output_path = os.environ.get('CONDUCTOR_OUTPUT_PATH', None)
+s3_bucket = os.environ.get('CONDUCTOR_S3_BUCKET', None)
+s3_path_root = os.environ.get('CONDUCTOR_S3_PATH', None)
+
+# Tuning for the transfers to S3
+upload_workers = int(os.environ.get('CONDUCTOR_UPLOAD_WORKERS', 8))
+upload_retries = int(os.environ.get('CONDUCTOR_UPLOAD_RETRIES', 3))
+chunk_size = int(os.environ.get('CONDUCTOR_UPLOAD_CHUNK_SIZE', 16*1024*1024))
+max_concurrency = 4
+
+# A frame is uploaded once it hasn't changed for stable_seconds. The output path is scanned every
+# poll_interval seconds.
+poll_interval = float(os.environ.get('CONDUCTOR_UPLOAD_POLL_INTERVAL', 2))
+stable_seconds = float(os.environ.get('CONDUCTOR_UPLOAD_STABLE_SECONDS', 5))
+
+# The state of the background uploader. Tasks run one after the other on an instance.
+state_dir = os.environ.get('CONDUCTOR_UPLOAD_STATE_DIR', "/tmp/render_uploader")
+pid_path = os.path.join(state_dir, "uploader.pid")
+stop_path = os.path.join(state_dir, "stop")
+journal_path = os.path.join(state_dir, "uploaded.jsonl")
+log_path = os.path.join(state_dir, "uploader.log")
+
+
+def get_s3_client():
+    '''
+    A single client is shared by all the uploaders. botocore retries failed requests (including
+    individual parts of a multipart upload) on its own.
+    '''
+
+    client_config = botocore.config.Config(max_pool_connections=upload_workers * max_concurrency,
+                                           retries={'max_attempts': 10})
+
+    return boto3.client('s3', config=client_config)
+
+
+def get_frame(path):
+    '''
+    :returns: The frame number of the file or None if it isn't a frame
+    :rtype: int
+    '''
+
+    parts = os.path.basename(path).split(".")
+
+    if len(parts) < 3 or not parts[-2].lstrip('-').isdigit():
+        return None
+
+    return int(parts[-2])
+
+
+def get_dest_path(path):
+    '''
+    :returns: The S3 key of the frame
+    :rtype: str
+    '''
+
+    return s3_path_root % int(path.split(".")[-2])
+
+
+def scan_output_path():
+    '''
+    :returns: The size and modification time of every file under the output path, by path
+    :rtype: dict
+    '''
+
+    files = {}
+
+    for root, dir_list, file_list in os.walk(output_path):
+
+        for filename in file_list:
+            path = os.path.join(root, filename)
+
+            try:
+                stat = os.stat(path)
+
+            # Deleted since it was listed (ie. a temporary file)
+            except OSError:
+                continue
+
+            files[path] = (stat.st_size, stat.st_mtime)
+
+    return files
+
+
+def get_open_files():
+    '''
+    :returns: The paths of the files that are open for writing by a process, None if it can't be
+              known on this platform
+    :rtype: set
+    '''
+
+    if not os.path.isdir("/proc"):
+        return None
+
+    open_files = set()
+
+    for pid in os.listdir("/proc"):
+
+        if not pid.isdigit():
+            continue
+
+        fd_dir = os.path.join("/proc", pid, "fd")
+
+        try:
+            for fd in os.listdir(fd_dir):
+
+                # Only the file descriptors opened for writing matter
+                with open(os.path.join("/proc", pid, "fdinfo", fd)) as fh:
+                    flags = [ int(line.split()[1], 8) for line in fh if line.startswith("flags:") ]
+
+                if flags and flags[0] & (os.O_WRONLY | os.O_RDWR):
+                    open_files.add(os.readlink(os.path.join(fd_dir, fd)))
+
+        # The process or file descriptor went away, or belongs to another user
+        except (IOError, OSError, ValueError):
+            continue
+
+    return open_files
+
+
+def read_journal():
+    '''
+    :returns: The uploads recorded in the journal, by path
+    :rtype: dict
+    '''
+
+    uploads = {}
+
+    if not os.path.exists(journal_path):
+        return uploads
+
+    with open(journal_path) as fh:
+
+        for line in fh:
+            try:
+                entry = json.loads(line)
+
+            # The last line can be truncated if the uploader was killed while writing it
+            except ValueError:
+                continue
+
+            uploads[entry['path']] = entry
+
+    return uploads
+
+
+class Uploader(object):
+    '''
+    Uploads frames to S3 on a pool of worker threads and records every upload in the journal
+    '''
+
+    def __init__(self):
+
+        self.s3 = get_s3_client()
+        self.transfer_config = boto3.s3.transfer.TransferConfig(multipart_threshold=chunk_size,
+                                                                multipart_chunksize=chunk_size,
+                                                                max_concurrency=max_concurrency)
+
+        # Keep the queue bounded so that the scan doesn't run too far ahead of the uploads
+        self.upload_queue = Queue.Queue(maxsize=upload_workers * 4)
+        self.manifest = []
+        self.errors = []
+        self.lock = threading.Lock()
+
+        self.workers = [ threading.Thread(target=self.upload_worker) for _ in range(upload_workers) ]
+
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def upload(self, path):
+
+        stat = os.stat(path)
+        dest_path = get_dest_path(path)
+
+        for attempt in range(upload_retries + 1):
+
+            try:
+                start_time = time.time()
+                self.s3.upload_file(path, s3_bucket, dest_path, Config=self.transfer_config)
+                duration = time.time() - start_time
+                break
+
+            except Exception as err:
+                if attempt == upload_retries:
+                    raise
+
+                print "Failed to upload {} ({}). Retrying".format(path, err)
+                time.sleep(2 ** attempt)
+
+        etag = self.s3.head_object(Bucket=s3_bucket, Key=dest_path)['ETag']
+
+        print "Uploaded {} ({}) to {} in {:.2f}s".format(path, stat.st_size, dest_path, duration)
+
+        entry = {'path': path,
+                 'frame': int(path.split(".")[-2]),
+                 'key': dest_path,
+                 'size': stat.st_size,
+                 'mtime': stat.st_mtime,
+                 'etag': etag,
+                 'duration': duration}
+
+        with self.lock:
+            self.manifest.append(entry)
+
+            with open(journal_path, 'a') as fh:
+                fh.write(json.dumps(entry) + "\n")
+
+    def upload_worker(self):
+
+        while True:
+            path = self.upload_queue.get()
+
+            if path is None:
+                break
+
+            try:
+                self.upload(path)
+
+            except Exception as err:
+                print "Failed to upload {}: {}".format(path, err)
+
+                with self.lock:
+                    self.errors.append((path, str(err)))
+
+    def put(self, path):
+        '''
+        Queue the file to be uploaded. Blocks while the queue is full.
+        '''
+
+        self.upload_queue.put(path)
+
+    def join(self):
+        '''
+        Wait for the queued files to be uploaded and stop the workers
+        '''
+
+        for worker in self.workers:
+            self.upload_queue.put(None)
+
+        for worker in self.workers:
+            worker.join()
+
+
+def watch():
+    '''
+    Upload the frames as they're rendered until the stop file is created
+    '''
+
+    uploader = Uploader()
+    uploaded = read_journal()
+    queued = set()
+
+    # The size and modification time of the files when they were last seen
+    last_seen = {}
+
+    print "Watching output path '{}'".format(output_path)
+
+    while not os.path.exists(stop_path):
+
+        now = time.time()
+        files = scan_output_path() if os.path.isdir(output_path) else {}
+        open_files = get_open_files()
+
+        for path, (size, mtime) in sorted(files.items()):
+
+            if path in queued or get_frame(path) is None:
+                continue
+
+            entry = uploaded.get(path)
+
+            if entry and (entry['size'], entry['mtime']) == (size, mtime):
+                continue
+
+            stable = ( last_seen.get(path) == (size, mtime) and
+                       now - mtime >= stable_seconds and
+                       (open_files is None or path not in open_files) )
+
+            if stable:
+                queued.add(path)
+                uploader.put(path)
+
+        last_seen = files
+        time.sleep(poll_interval)
+
+    # post_render_script.py uploads whatever is left
+    uploader.join()
+
+    print "Uploaded {} frames while rendering".format(len(uploader.manifest))
+
+
+def start():
+    '''
+    Start the background uploader, detached from the task's process
+    '''
+
+    if not os.path.exists(state_dir):
+        os.makedirs(state_dir)
+
+    kill_previous_watcher()
+
+    for path in (stop_path, journal_path, pid_path):
+        if os.path.exists(path):
+            os.remove(path)
+
+    with open(log_path, 'a') as log:
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "watch"],
+                                   stdout=log,
+                                   stderr=subprocess.STDOUT,
+                                   preexec_fn=os.setsid,
+                                   close_fds=True)
+
+    with open(pid_path, 'w') as fh:
+        fh.write(str(process.pid))
+
+    print "Started the background uploader ({})".format(process.pid)
+
+
+def kill_previous_watcher(timeout=10):
+    '''
+    Kill the background uploader of a previous task that was never stopped (ie. the task was
+    killed before its post_task_cmd ran), so that it doesn't upload this task's frames or write to
+    its journal
+
+    :param timeout: The time (in seconds) to wait for it to exit
+    :type timeout: float
+    '''
+
+    if not os.path.exists(pid_path):
+        return
+
+    with open(pid_path) as fh:
+        try:
+            pid = int(fh.read().strip())
+
+        except ValueError:
+            return
+
+    if not is_running(pid) or not is_watcher(pid):
+        return
+
+    print "Killing the background uploader of a previous task ({})".format(pid)
+
+    # It leads its own process group (see start)
+    try:
+        os.killpg(pid, signal.SIGKILL)
+
+    except OSError:
+        pass
+
+    start_time = time.time()
+
+    while is_running(pid) and time.time() - start_time < timeout:
+        time.sleep(0.1)
+
+
+def stop(timeout=3600):
+    '''
+    Ask the background uploader to stop and wait for its uploads to finish
+
+    :param timeout: The time (in seconds) to wait before killing it
+    :type timeout: float
+    '''
+
+    if not os.path.exists(pid_path):
+        return
+
+    with open(pid_path) as fh:
+        pid = int(fh.read().strip())
+
+    open(stop_path, 'w').close()
+
+    start_time = time.time()
+
+    while is_running(pid):
+
+        if time.time() - start_time > timeout:
+            print "The background uploader didn't stop, killing it"
+            os.kill(pid, signal.SIGKILL)
+            break
+
+        time.sleep(0.5)
+
+    os.remove(pid_path)
+
+    if os.path.exists(log_path):
+        with open(log_path) as fh:
+            print fh.read()
+
+        os.remove(log_path)
+
+
+def is_running(pid):
+    '''
+    :rtype: bool
+    '''
+
+    # Reap it if it's our child, it can't be when started by pre_task_cmd
+    try:
+        if os.waitpid(pid, os.WNOHANG)[0] == pid:
+            return False
+
+    except OSError:
+        pass
+
+    try:
+        os.kill(pid, 0)
+
+    except OSError:
+        return False
+
+    # A zombie has exited
+    try:
+        with open(os.path.join("/proc", str(pid), "stat")) as fh:
+            return fh.read().split(") ")[-1].split()[0] != 'Z'
+
+    except IOError:
+        return True
+
+
+def is_watcher(pid):
+    '''
+    :returns: Whether the process is a background uploader, the pid of a dead one may have been
+              re-used
+    :rtype: bool
+    '''
+
+    try:
+        with open(os.path.join("/proc", str(pid), "cmdline")) as fh:
+            argv = fh.read().split("\0")
+
+    # Assume the pid file is right when it can't be checked
+    except IOError:
+        return True
+
+    script_name = os.path.splitext(os.path.basename(__file__))[0]
+
+    return "watch" in argv and any( os.path.basename(arg).startswith(script_name) for arg in argv )
+
+
+if __name__ == "__main__":
+
+    if output_path is None:
+        raise Exception("Environment variable 'CONDUCTOR_OUTPUT_PATH' is not defined.")
+
+    if s3_bucket is None:
+        raise Exception("Environment variable 'CONDUCTOR_S3_BUCKET' is not defined.")
+
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+
+    if command == "start":
+        start()
+
+    elif command == "watch":
+        watch()
+
+    elif command == "stop":
+        stop()
+
+    else:
+        raise Exception("Usage: render_uploader.py start|watch|stop")
@@ -0,0 +1,277 @@
+'''
+Replays the events of a range of ids or of a time window through the daemon plugins, ie. to
+catch up after an outage:
+
+    python replay.py --from-id 1200 --to-id 1850 --plugin create_version --workers 8
+    python replay.py --since "2020-06-01 18:00" --until "2020-06-02 09:00" --dry-run
+    python replay.py --from-watermark
+
+With --from-watermark every plugin replays the events after the last one it processed, as saved
+by the daemon (see EventWatermark), ie. the events that were in flight when it stopped.
+
+The events are fetched by pages. The entities of a page are fetched with one query per entity
+type and primed in the plugins' EventRouter, so that the plugins don't query them one by one.
+'''
+
+import argparse
+import datetime
+import importlib
+import inspect
+import logging
+import sys
+import threading
+
+import submit_to_conductor_base
+
+
+PLUGINS_DIR = "/usr/local/shotgun/plugins"
+PLUGIN_NAMES = ['submit_maya_render_to_conductor', 'submit_nuke_template_to_conductor', 'create_version']
+
+TIME_FORMATS = ["%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"]
+
+
+def parse_time(value):
+    '''
+    :param value: A local date and time, ie. '2020-06-01 18:00'
+    :type value: str
+
+    :rtype: datetime.datetime
+    '''
+
+    for time_format in TIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, time_format)
+
+        except ValueError:
+            continue
+
+    raise argparse.ArgumentTypeError("Invalid date '{}', expected one of {}".format(value, ", ".join(TIME_FORMATS)))
+
+
+def load_plugins(plugins_dir, names):
+    '''
+    :param plugins_dir: The directory of the plugin modules
+    :type plugins_dir: str
+
+    :param names: The names of the plugin modules
+    :type names: list of str
+
+    :returns: The plugin classes defined by the modules
+    :rtype: list of class
+    '''
+
+    if plugins_dir not in sys.path:
+        sys.path.insert(0, plugins_dir)
+
+    plugins = []
+
+    for name in names:
+        module = importlib.import_module(name)
+
+        plugins.extend( value for value in vars(module).values()
+                        if inspect.isclass(value) and
+                           issubclass(value, submit_to_conductor_base.SubmitToConductorSGDaemonPlugin) and
+                           value.__module__ == module.__name__ )
+
+    return plugins
+
+
+def read_watermarks(plugins, logger):
+    '''
+    :returns: The id of the last event processed by every plugin that saved one, by plugin
+    :rtype: dict
+    '''
+
+    watermarks = {}
+
+    for plugin in plugins:
+        watermark = submit_to_conductor_base.read_watermark(plugin.get_watermark_path())
+
+        if watermark is None:
+            logger.warning("{} has no saved event id in {}. Skipping it".format(plugin.__name__, plugin.EVENT_WATERMARK_DIR))
+            continue
+
+        logger.info("{} processed every event up to {}".format(plugin.__name__, watermark))
+        watermarks[plugin] = watermark
+
+    return watermarks
+
+
+def iter_event_pages(sg, event_types, from_id=None, to_id=None, since=None, until=None, page_size=100):
+    '''
+    Fetch the events by pages, in order
+
+    :returns: The pages of events
+    :rtype: generator of list of dict
+    '''
+
+    base_filters = [[ 'event_type', 'in', event_types ]]
+
+    if to_id is not None:
+        base_filters.append([ 'id', 'less_than', to_id + 1 ])
+
+    if since is not None:
+        base_filters.append([ 'created_at', 'greater_than', since ])
+
+    if until is not None:
+        base_filters.append([ 'created_at', 'less_than', until ])
+
+    last_id = from_id - 1 if from_id is not None else None
+
+    while True:
+        filters = list(base_filters)
+
+        if last_id is not None:
+            filters.append([ 'id', 'greater_than', last_id ])
+
+        events = sg.find("EventLogEntry",
+                         filters,
+                         submit_to_conductor_base.SubmitToConductorSGDaemonPlugin.EVENT_FIELDS,
+                         order=[{'field_name': 'id', 'direction': 'asc'}],
+                         limit=page_size)
+
+        if not events:
+            break
+
+        yield events
+
+        last_id = events[-1]['id']
+
+        if len(events) < page_size:
+            break
+
+
+def replay(plugins, args, logger):
+    '''
+    :returns: The number of events matched by a plugin, processed, skipped and failed
+    :rtype: dict
+    '''
+
+    base_cls = submit_to_conductor_base.SubmitToConductorSGDaemonPlugin
+    router = base_cls._router
+    sg = base_cls.get_sg_instance()
+
+    max_pending = args.workers * 4
+
+    # Entities primed for a page must still be cached when their event is processed
+    router.max_events = max(router.max_events, args.page_size + max_pending)
+
+    # Every plugin resumes after its own watermark, the events are fetched from the oldest one
+    watermarks = {}
+    from_id = args.from_id
+
+    if args.from_watermark:
+        watermarks = read_watermarks(plugins, logger)
+        plugins = list(watermarks)
+
+        if not plugins:
+            return {'matched': 0, 'processed': 0, 'skipped': 0, 'failed': 0}
+
+        from_id = min(watermarks.values()) + 1
+
+    for plugin in plugins:
+        router.register_fields(plugin.PUBLISHED_FILE_FIELDS + plugin.COALESCE_FIELDS)
+
+    executor = submit_to_conductor_base.EventExecutor(args.workers, max_pending, logger=logger)
+    outcomes = {'matched': 0, 'processed': 0, 'skipped': 0, 'failed': 0}
+    lock = threading.Lock()
+
+    def process(plugin, event):
+
+        outcome = 'failed'
+
+        try:
+            # With DURABLE_JOBS failures aren't raised, they're left in the job queue to be retried
+            outcome = plugin.process_event(logger, event)
+
+        finally:
+            with lock:
+                outcomes[outcome] += 1
+
+    event_types = sorted(set( event_type for plugin in plugins for event_type in plugin.EVENT ))
+
+    for events in iter_event_pages(sg, event_types, from_id, args.to_id, args.since, args.until, args.page_size):
+
+        router.prefetch(sg, events, args.page_size)
+        logger.info("Replaying events {} to {}".format(events[0]['id'], events[-1]['id']))
+
+        for event in events:
+
+            entity = router.get_entity(sg, event) if event.get('entity') else None
+
+            if event.get('entity') and entity is None:
+                logger.warning("Skipping event {}, its {} has been deleted".format(event['id'], event['entity']['type']))
+
+                with lock:
+                    outcomes['skipped'] += 1
+
+                continue
+
+            for plugin in plugins:
+
+                if event['event_type'] not in plugin.EVENT or (entity is not None and not plugin.accepts(entity)):
+                    continue
+
+                if event['id'] <= watermarks.get(plugin, -1):
+                    continue
+
+                entity_key = event.get('entity') or {'type': 'EventLogEntry', 'id': event['id']}
+
+                with lock:
+                    outcomes['matched'] += 1
+
+                if args.dry_run:
+                    logger.info("Would process event {} ({} {}) with {}".format(event['id'], entity_key['type'], entity_key['id'], plugin.__name__))
+                    continue
+
+                executor.submit((plugin.__name__, entity_key['type'], entity_key['id']), event['id'], process, plugin, event)
+
+    executor.shutdown(wait=True)
+
+    return outcomes
+
+
+def parse_args(argv=None):
+
+    parser = argparse.ArgumentParser(description="Replay Shotgun events through the daemon plugins")
+
+    parser.add_argument('--from-id', type=int, help="First event id to replay")
+    parser.add_argument('--to-id', type=int, help="Last event id to replay")
+    parser.add_argument('--from-watermark', action='store_true', help="Replay the events after the last one every plugin processed")
+    parser.add_argument('--since', type=parse_time, help="Replay the events created after this local time")
+    parser.add_argument('--until', type=parse_time, help="Replay the events created before this local time")
+    parser.add_argument('--plugin', dest='plugins', action='append', help="Name of a plugin module to replay the events through (default: all)")
+    parser.add_argument('--plugins-dir', default=PLUGINS_DIR, help="Directory of the plugin modules")
+    parser.add_argument('--workers', type=int, default=4, help="Number of events processed concurrently")
+    parser.add_argument('--page-size', type=int, default=100, help="Number of events fetched per query")
+    parser.add_argument('--dry-run', action='store_true', help="Only log the events that would be processed")
+    parser.add_argument('--verbose', action='store_true', help="Log what the plugins do")
+
+    args = parser.parse_args(argv)
+
+    if args.from_watermark and args.from_id is not None:
+        parser.error("--from-id can't be used with --from-watermark")
+
+    if args.from_id is None and args.since is None and not args.from_watermark:
+        parser.error("Either --from-id, --since or --from-watermark is required")
+
+    return args
+
+
+def main(argv=None):
+
+    args = parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    logger = logging.getLogger('sg_event_replay')
+
+    plugins = load_plugins(args.plugins_dir, args.plugins or PLUGIN_NAMES)
+    outcomes = replay(plugins, args, logger)
+
+    logger.info("Matched {matched} events, processed {processed}, skipped {skipped}, {failed} failed".format(**outcomes))
+
+    return 1 if outcomes['failed'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
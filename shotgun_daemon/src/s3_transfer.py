@@ -0,0 +1,340 @@
+import logging
+import os
+import re
+import time
+import uuid
+
+import concurrent.futures
+
+import boto3
+import boto3.s3.transfer
+import botocore.config
+import botocore.exceptions
+
+
+class S3Sequence(object):
+    '''
+    A sequence of frames on S3 described by a printf pattern, i.e. 'path/render.%05d.exr'
+    '''
+
+    FRAME_TOKEN = re.compile(r'%0(\d)d')
+
+    def __init__(self, pattern):
+        '''
+        :param pattern: The key of the frames. Must contain a single '%0[0-9]d' token.
+        :type pattern: str
+        '''
+
+        match = self.FRAME_TOKEN.search(pattern)
+
+        if match is None:
+            raise Exception("{} is not a file sequence".format(pattern))
+
+        self.pattern = pattern
+        self.prefix = pattern[:match.start()]
+        self.suffix = pattern[match.end():]
+        self.padding = int(match.group(1))
+
+        self.regex = re.compile("^{}(-?\\d+){}$".format(re.escape(self.prefix), re.escape(self.suffix)))
+
+    @classmethod
+    def is_sequence(cls, pattern):
+        return cls.FRAME_TOKEN.search(pattern) is not None
+
+    def get_key(self, frame):
+        '''
+        :returns: The key of the given frame
+        :rtype: str
+        '''
+
+        return "{}{:0{}d}{}".format(self.prefix, frame, self.padding, self.suffix)
+
+    def get_frame(self, key):
+        '''
+        :returns: The frame number of key or None if key isn't part of the sequence
+        :rtype: int
+        '''
+
+        match = self.regex.match(key)
+
+        if match is None:
+            return None
+
+        frame = int(match.group(1))
+
+        # Reject frame numbers that don't have the padding of the pattern (i.e. 'render.1.exr')
+        if self.get_key(frame) != key:
+            return None
+
+        return frame
+
+
+class S3Downloader(object):
+    '''
+    Downloads many objects from a single S3 bucket concurrently.
+
+    A single boto3 client (and its connection pool) is shared by all the worker threads. Each file
+    is transferred with boto3's managed transfer so large files are fetched as parallel multipart
+    ranges. Failed files are retried with an exponential backoff.
+
+    The worker threads are shared by every call to download, so at most max_workers files are
+    downloaded at once however many threads are downloading.
+    '''
+
+    # Errors that are not worth retrying
+    FATAL_ERROR_CODES = ('403', '404', 'AccessDenied', 'NoSuchBucket', 'NoSuchKey')
+
+    def __init__(self, bucket, max_workers=8, multipart_chunksize=8*1024*1024,
+                 max_concurrency=4, max_retries=3, retry_delay=1.0, client=None, logger=None):
+        '''
+        :param bucket: The name of the bucket to download from
+        :type bucket: str
+
+        :param max_workers: The number of files to download concurrently
+        :type max_workers: int
+
+        :param multipart_chunksize: The size (in bytes) of each part of a multipart download
+        :type multipart_chunksize: int
+
+        :param max_concurrency: The number of threads used to download the parts of a single file
+        :type max_concurrency: int
+
+        :param max_retries: The number of times a failed download is retried
+        :type max_retries: int
+
+        :param retry_delay: The delay (in seconds) before the first retry. Doubled on every retry.
+        :type retry_delay: float
+
+        :param client: The S3 client to use. Its connection pool should be able to hold
+                       max_workers * max_concurrency connections. A new client is created if None.
+        :type client: botocore.client.S3
+        '''
+
+        self.bucket = bucket
+        self.max_workers = max(1, int(max_workers))
+        self.max_retries = max(0, int(max_retries))
+        self.retry_delay = retry_delay
+        self.logger = logger or logging.getLogger(__name__)
+
+        self.transfer_config = boto3.s3.transfer.TransferConfig(multipart_threshold=multipart_chunksize,
+                                                                multipart_chunksize=multipart_chunksize,
+                                                                max_concurrency=max_concurrency,
+                                                                use_threads=max_concurrency > 1)
+
+        if client is None:
+            # Every worker can have max_concurrency requests in flight for a multipart download
+            client_config = botocore.config.Config(max_pool_connections=self.max_workers * max_concurrency)
+            client = boto3.client('s3', config=client_config)
+
+        self.client = client
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+
+    def download_file(self, key, file_path):
+        '''
+        Download a single object, retrying on transient errors.
+
+        :param key: The key of the object to download
+        :type key: str
+
+        :param file_path: The local path to download the object to
+        :type file_path: str
+
+        :returns: The local path
+        :rtype: str
+        '''
+
+        parent_dir = os.path.dirname(file_path)
+
+        if parent_dir and not os.path.exists(parent_dir):
+            try:
+                os.makedirs(parent_dir)
+            except OSError:
+                # Another worker may have created it in the meantime
+                if not os.path.isdir(parent_dir):
+                    raise
+
+        # Download to a temporary file and rename it once complete so that a partial file is
+        # never visible at file_path
+        tmp_path = "{}.part-{}".format(file_path, uuid.uuid4().hex)
+        attempt = 0
+
+        while True:
+            try:
+                self.client.download_file(self.bucket, key, tmp_path, Config=self.transfer_config)
+                os.rename(tmp_path, file_path)
+                return file_path
+
+            except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError, IOError, OSError) as err:
+
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+                if attempt >= self.max_retries or not self.is_retryable(err):
+                    raise
+
+                delay = self.retry_delay * (2 ** attempt)
+                attempt += 1
+                self.logger.warning("Failed to download {} ({}). Retrying in {}s [{}/{}]".format(key, err, delay, attempt, self.max_retries))
+                time.sleep(delay)
+
+    def download(self, transfers):
+        '''
+        Download several objects concurrently.
+
+        :param transfers: The objects to download
+        :type transfers: list of (key, local path) tuples
+
+        :returns: The local paths, in the same order as transfers
+        :rtype: list of str
+        '''
+
+        if not transfers:
+            return []
+
+        file_count = len(transfers)
+        self.logger.info("Downloading {} files from s3 bucket {}".format(file_count, self.bucket))
+
+        futures = [ self.executor.submit(self.download_file, key, file_path) for key, file_path in transfers ]
+
+        try:
+            for index, future in enumerate(concurrent.futures.as_completed(futures)):
+                self.logger.debug("[{}/{}] Downloaded {}".format(index+1, file_count, future.result()))
+
+        # The other files aren't needed anymore, the ones being downloaded are waited for so that
+        # nothing is written once this returns
+        except Exception:
+            for future in futures:
+                future.cancel()
+
+            concurrent.futures.wait(futures)
+            raise
+
+        return [ future.result() for future in futures ]
+
+    def list_objects(self, prefix, max_keys=None):
+        '''
+        List the objects in the bucket whose key starts with the given prefix.
+
+        :param prefix: The key prefix
+        :type prefix: str
+
+        :param max_keys: Stop after this many objects. None to list all of them.
+        :type max_keys: int
+
+        :returns: The matching objects, as returned by list_objects_v2 (Key, ETag, Size, ...)
+        :rtype: list of dict
+        '''
+
+        return list(self.iter_objects(prefix, max_keys=max_keys))
+
+    def iter_objects(self, prefix, max_keys=None):
+        '''
+        Same as list_objects but the objects are yielded as each page is received
+        '''
+
+        paginator = self.client.get_paginator('list_objects_v2')
+        pagination_config = {'MaxItems': max_keys} if max_keys else {}
+
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix, PaginationConfig=pagination_config):
+            for s3_object in page.get('Contents', []):
+                yield s3_object
+
+    def list_sequence(self, sequence, start_frame=None, end_frame=None):
+        '''
+        List the frames of a sequence. Only the keys that match the pattern of the sequence (and
+        fall inside the frame range, if given) are kept, other files sharing the same prefix are
+        ignored.
+
+        :param sequence: The sequence to list
+        :type sequence: S3Sequence
+
+        :param start_frame: The first frame to keep. None to not filter on the frame range.
+        :type start_frame: int
+
+        :param end_frame: The last frame to keep. None to not filter on the frame range.
+        :type end_frame: int
+
+        :returns: The objects (Key, ETag, Size, ...) sorted by frame and the frames of the range
+                  that were not found (always empty when there's no frame range)
+        :rtype: tuple (list of dict, list of int)
+        '''
+
+        has_range = start_frame is not None and end_frame is not None
+        frames = {}
+        skipped = 0
+
+        for s3_object in self.iter_objects(sequence.prefix):
+
+            frame = sequence.get_frame(s3_object['Key'])
+
+            if frame is None or (has_range and not start_frame <= frame <= end_frame):
+                skipped += 1
+                continue
+
+            frames[frame] = s3_object
+
+        if skipped:
+            self.logger.debug("Ignored {} objects under {} that are not frames of {}".format(skipped, sequence.prefix, sequence.pattern))
+
+        missing_frames = []
+
+        if has_range:
+            missing_frames = [ frame for frame in range(start_frame, end_frame + 1) if frame not in frames ]
+
+        return [ frames[frame] for frame in sorted(frames) ], missing_frames
+
+    def build_sequence(self, sequence, start_frame, end_frame):
+        '''
+        Build the objects of a sequence from its frame range, without listing the bucket. The
+        objects only have a Key, frames that don't exist will fail to download.
+
+        :param sequence: The sequence
+        :type sequence: S3Sequence
+
+        :returns: The objects, sorted by frame
+        :rtype: list of dict
+        '''
+
+        return [ {'Key': sequence.get_key(frame)} for frame in range(start_frame, end_frame + 1) ]
+
+    def get_object_info(self, key):
+        '''
+        Get the listing entry for a single key. A single list_objects_v2 request is used instead of
+        a HEAD request so that it returns the same ETag/Size as a sequence listing.
+
+        :param key: The key of the object
+        :type key: str
+
+        :returns: The object (Key, ETag, Size, ...) or None if it doesn't exist
+        :rtype: dict
+        '''
+
+        # Keys are listed in lexical order so an exact match is always the first result
+        objects = self.list_objects(key, max_keys=1)
+
+        if objects and objects[0]['Key'] == key:
+            return objects[0]
+
+        return None
+
+    @classmethod
+    def is_retryable(cls, err):
+        '''
+        Whether the given error is likely to be transient
+        '''
+
+        if isinstance(err, botocore.exceptions.ClientError):
+            return err.response.get('Error', {}).get('Code') not in cls.FATAL_ERROR_CODES
+
+        return True
+
+    @classmethod
+    def is_missing(cls, err):
+        '''
+        Whether the given error means the object doesn't exist
+        '''
+
+        if isinstance(err, botocore.exceptions.ClientError):
+            return err.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey')
+
+        return False
@@ -0,0 +1,78 @@
+import logging
+
+
+class ShotgunBatch(object):
+    '''
+    Collects Shotgun writes (creates and updates) and sends them with sg.batch(), so that related
+    writes take a single round trip and are applied in a single transaction.
+
+    Entities created by a batch can't be referenced by the other requests of the same batch, only
+    existing entities can be linked.
+    '''
+
+    def __init__(self, sg, max_requests=100, logger=None):
+        '''
+        :param sg: The Shotgun connection
+        :type sg: shotgun_api3.Shotgun
+
+        :param max_requests: The number of requests sent in a single batch. Larger batches are
+                             split, each part is its own transaction.
+        :type max_requests: int
+        '''
+
+        self.sg = sg
+        self.max_requests = max(1, int(max_requests))
+        self.logger = logger or logging.getLogger(__name__)
+
+        self.requests = []
+
+    def __len__(self):
+        return len(self.requests)
+
+    def create(self, entity_type, data, return_fields=None):
+        '''
+        Queue the creation of an entity
+
+        :returns: The index of its result in the list returned by commit
+        :rtype: int
+        '''
+
+        request = {'request_type': 'create', 'entity_type': entity_type, 'data': data}
+
+        if return_fields:
+            request['return_fields'] = return_fields
+
+        self.requests.append(request)
+
+        return len(self.requests) - 1
+
+    def update(self, entity_type, entity_id, data):
+        '''
+        Queue the update of an entity
+
+        :returns: The index of its result in the list returned by commit
+        :rtype: int
+        '''
+
+        self.requests.append({'request_type': 'update', 'entity_type': entity_type, 'entity_id': entity_id, 'data': data})
+
+        return len(self.requests) - 1
+
+    def commit(self):
+        '''
+        Send the queued requests
+
+        :returns: The result of every request, in the order they were queued
+        :rtype: list of dict
+        '''
+
+        results = []
+        requests, self.requests = self.requests, []
+
+        for index in range(0, len(requests), self.max_requests):
+            chunk = requests[index:index + self.max_requests]
+
+            self.logger.debug("Sending a batch of {} Shotgun requests".format(len(chunk)))
+            results.extend(self.sg.batch(chunk))
+
+        return results
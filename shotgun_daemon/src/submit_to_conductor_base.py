@@ -1,11 +1,639 @@
+import collections
+import contextlib
+import heapq
 import json
+import logging
 import os
 import re
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
 
-import boto3
-import shotgun_api3
+import concurrent.futures
 import conductor.lib
 
+import client_registry
+import conductor_transfer
+import file_cache
+import job_queue
+import metrics
+import s3_transfer
+import ttl_cache
+import upload_index
+
+
+# A range of frames rendered by a single Conductor job. preview jobs don't publish their renders
+# and only render the frames listed in frames (None for every frame of the range).
+FrameChunk = collections.namedtuple('FrameChunk', ['start', 'end', 'step', 'preview', 'frames'])
+
+
+def plan_frame_chunks(start_frame, end_frame, chunk_size=0, preview=False):
+    '''
+    Split a frame range into the chunks that should each be submitted as a Conductor job
+    
+    :param start_frame: The first frame of the range
+    :type start_frame: int
+    
+    :param end_frame: The last frame of the range
+    :type end_frame: int
+    
+    :param chunk_size: The number of frames per chunk. 0 for a single chunk.
+    :type chunk_size: int
+    
+    :param preview: Start with a single chunk that only renders the first, middle and last frames
+    :type preview: bool
+    
+    :returns: The chunks, in the order they should be submitted
+    :rtype: list of FrameChunk
+    '''
+    
+    chunks = []
+    frame_count = end_frame - start_frame + 1
+    
+    if preview and frame_count > 3:
+        middle_frame = start_frame + (end_frame - start_frame) // 2
+        chunks.append(FrameChunk(start_frame, end_frame, 1, True, [start_frame, middle_frame, end_frame]))
+    
+    if chunk_size <= 0:
+        chunk_size = frame_count
+        
+    for chunk_start in range(start_frame, end_frame + 1, chunk_size):
+        chunks.append(FrameChunk(chunk_start, min(chunk_start + chunk_size - 1, end_frame), 1, False, None))
+        
+    return chunks
+
+
+def read_watermark(watermark_path):
+    '''
+    :param watermark_path: The file an EventWatermark saves its last_event_id to
+    :type watermark_path: str
+    
+    :returns: The id of the last event processed, None if none was saved
+    :rtype: int
+    '''
+    
+    if os.path.exists(watermark_path):
+        with open(watermark_path) as fh:
+            return int(fh.read().strip() or 0)
+        
+    return None
+
+
+class EventWatermark(object):
+    '''
+    Tracks the id of the last event processed, such that every event received before it has been
+    processed too.
+    
+    An event is started when it's received, whether it's processed straight away, queued or held,
+    and finished once it's been processed (successfully or not), skipped or superseded. 
+    last_event_id is only advanced once every event started before it has finished. It's 
+    persisted to watermark_path so that events that were still in flight when the daemon stopped
+    can be replayed (see replay.py --from-watermark).
+    '''
+    
+    def __init__(self, watermark_path=None, logger=None):
+        '''
+        :param watermark_path: The file last_event_id is saved to. None to not persist it.
+        :type watermark_path: str
+        '''
+        
+        self.watermark_path = watermark_path
+        self.logger = logger or logging.getLogger(__name__)
+        
+        self._lock = threading.Lock()
+        self._running_ids = set()
+        self._done_ids = set()
+        self.last_event_id = self.read_watermark()
+        
+    def read_watermark(self):
+        
+        return read_watermark(self.watermark_path) if self.watermark_path else None
+        
+    def write_watermark(self):
+        
+        if self.watermark_path:
+            
+            tmp_path = "{}.tmp".format(self.watermark_path)
+            
+            with open(tmp_path, 'w') as fh:
+                fh.write(str(self.last_event_id))
+                
+            os.rename(tmp_path, self.watermark_path)
+            
+    def start(self, event_id):
+        '''
+        Record that the event has been received. Starting an event twice has no effect.
+        '''
+        
+        with self._lock:
+            self._running_ids.add(event_id)
+            
+    def finish(self, event_id):
+        '''
+        Record that the event is done with and advance last_event_id if possible
+        '''
+        
+        with self._lock:
+            self._running_ids.discard(event_id)
+            self._done_ids.add(event_id)
+            self._advance_watermark()
+            
+    def _advance_watermark(self):
+        '''
+        Move last_event_id to the highest finished event that has no unfinished events before it.
+        Must be called while holding the lock.
+        '''
+        
+        if self._running_ids:
+            oldest_running_id = min(self._running_ids)
+            done_ids = [ id_ for id_ in self._done_ids if id_ < oldest_running_id ]
+            
+        else:
+            done_ids = list(self._done_ids)
+            
+        if not done_ids:
+            return
+        
+        self._done_ids.difference_update(done_ids)
+        
+        # Events from before the watermark (i.e. retries) don't move it back
+        if max(done_ids) <= (self.last_event_id or 0):
+            return
+        
+        self.last_event_id = max(done_ids)
+        
+        try:
+            self.write_watermark()
+            
+        except (IOError, OSError) as err:
+            self.logger.warning("Unable to save the last event id to {} ({})".format(self.watermark_path, err))
+
+
+class EventExecutor(object):
+    '''
+    Runs event callbacks on a bounded pool of worker threads.
+    
+    Events that share an ordering key (ie. the same PublishedFile) are run one after the other, in
+    the order they were submitted. When max_pending events are waiting or running, submit() blocks
+    until one of them is done.
+    '''
+    
+    def __init__(self, max_workers, max_pending, logger=None):
+        '''
+        :param max_workers: The number of events processed concurrently
+        :type max_workers: int
+        
+        :param max_pending: The number of events that can be queued or running before submit blocks
+        :type max_pending: int
+        '''
+        
+        self.logger = logger or logging.getLogger(__name__)
+        
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self._slots = threading.BoundedSemaphore(max(max_pending, max_workers))
+        self._lock = threading.Lock()
+        
+        # Events waiting for an earlier event with the same ordering key to finish
+        self._queues = {}
+        
+    def submit(self, ordering_key, event_id, fn, *args):
+        '''
+        Queue fn(*args) to be run on a worker thread.
+        
+        :param ordering_key: Events with the same key are processed in order
+        :type ordering_key: hashable
+        
+        :param event_id: The id of the event being processed
+        :type event_id: int
+        
+        :param fn: The callable that processes the event
+        :type fn: callable
+        '''
+        
+        # Backpressure - block the caller until there's room for the event
+        self._slots.acquire()
+        
+        with self._lock:
+            
+            if ordering_key in self._queues:
+                self._queues[ordering_key].append((event_id, fn, args))
+                return
+            
+            self._queues[ordering_key] = collections.deque()
+            
+        self._executor.submit(self._run, ordering_key, event_id, fn, args)
+        
+    def _run(self, ordering_key, event_id, fn, args):
+        
+        # Keep processing the events for ordering_key on this worker until there are none left
+        while True:
+            
+            try:
+                fn(*args)
+                
+            except Exception:
+                self.logger.exception("Failed to process event {}".format(event_id))
+            
+            with self._lock:
+                
+                queue = self._queues[ordering_key]
+                
+                if queue:
+                    event_id, fn, args = queue.popleft()
+                    
+                else:
+                    del self._queues[ordering_key]
+                    event_id = None
+                    
+            self._slots.release()
+            
+            if event_id is None:
+                break
+            
+    def shutdown(self, wait=True):
+        
+        self._executor.shutdown(wait=wait)
+
+
+class EventCoalescer(object):
+    '''
+    Holds events for a few seconds so that only the newest of a burst of related events is
+    processed. 
+    
+    Every event added with a key replaces the event held for that key (if it's older), and
+    restarts the key's window. When the window elapses without a new event, the held event is
+    passed to the dispatch callable.
+    
+    A single thread waits for the windows to elapse. The events are dispatched on a pool of 
+    max_workers threads, however many keys are held.
+    '''
+    
+    def __init__(self, window, dispatch, max_workers=1, logger=None):
+        '''
+        :param window: How long (in seconds) events are held for
+        :type window: float
+        
+        :param dispatch: Called with the arguments given to add() to process an event
+        :type dispatch: callable
+        
+        :param max_workers: The number of events dispatched concurrently
+        :type max_workers: int
+        '''
+        
+        self.window = window
+        self.dispatch = dispatch
+        self.logger = logger or logging.getLogger(__name__)
+        
+        self._condition = threading.Condition()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, max_workers))
+        
+        # key -> (event id, args, release time)
+        self._held_events = {}
+        
+        # (release time, event id, key) of the held events, windows restarted by a newer event
+        # are skipped when popped
+        self._releases = []
+        
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        
+    def add(self, key, event_id, *args):
+        '''
+        Hold an event
+        
+        :param key: Events with the same key supersede each other
+        :type key: hashable
+        
+        :param event_id: The id of the event. Higher ids are newer.
+        :type event_id: int
+        
+        :returns: The id of the event that was superseded, if any
+        :rtype: int
+        '''
+        
+        with self._condition:
+            
+            held_event = self._held_events.get(key)
+            superseded_id = None
+            
+            if held_event is not None:
+                
+                if held_event[0] > event_id:
+                    self.logger.info("Event {} is superseded by event {}. Skipping".format(event_id, held_event[0]))
+                    return event_id
+                
+                if held_event[0] != event_id:
+                    superseded_id = held_event[0]
+                    self.logger.info("Event {} is superseded by event {}. Skipping".format(superseded_id, event_id))
+            
+            release_time = time.time() + self.window
+            self._held_events[key] = (event_id, args, release_time)
+            heapq.heappush(self._releases, (release_time, event_id, key))
+            self._condition.notify()
+            
+        return superseded_id
+    
+    def _run(self):
+        
+        while True:
+            
+            with self._condition:
+                
+                while not self._releases or self._releases[0][0] > time.time():
+                    self._condition.wait(self._releases[0][0] - time.time() if self._releases else None)
+                    
+                release_time, event_id, key = heapq.heappop(self._releases)
+                held_event = self._held_events.get(key)
+                
+                # A newer event has replaced this one or restarted its window
+                if held_event is None or held_event[0] != event_id or held_event[2] != release_time:
+                    continue
+                
+                del self._held_events[key]
+                
+            self._executor.submit(self._dispatch, event_id, held_event[1])
+            
+    def _dispatch(self, event_id, args):
+        
+        try:
+            self.dispatch(*args)
+            
+        except Exception:
+            self.logger.exception("Failed to process event {}".format(event_id))
+            
+    def flush(self):
+        '''
+        Dispatch all the held events immediately
+        '''
+        
+        with self._condition:
+            held_events = list(self._held_events.values())
+            self._held_events.clear()
+            self._releases = []
+            
+        for event_id, args, release_time in held_events:
+            self._dispatch(event_id, args)
+            
+            
+class EventRouter(object):
+    '''
+    Fetches the entity of an event once for all the plugins.
+    
+    Every plugin registers the fields it needs and the entity is queried with the union of those
+    fields. The entities of the most recent events are cached so that the plugins processing the 
+    same event share a single query.
+    '''
+    
+    def __init__(self, max_events=128):
+        '''
+        :param max_events: The number of events whose entity is cached
+        :type max_events: int
+        '''
+        
+        self.max_events = max_events
+        
+        self._lock = threading.Lock()
+        self._fields = set()
+        self._entities = collections.OrderedDict()
+        
+    def register_fields(self, fields):
+        
+        with self._lock:
+            self._fields.update(fields)
+            
+    def add_entity(self, event_id, entity, fields):
+        '''
+        Cache the entity of an event
+        
+        :param event_id: The id of the event
+        :type event_id: int
+        
+        :param entity: The event's entity
+        :type entity: dict
+        
+        :param fields: The fields entity was queried with
+        :type fields: list of str
+        '''
+        
+        with self._lock:
+            self._entities[event_id] = (entity, set(fields))
+            
+            while len(self._entities) > self.max_events:
+                self._entities.popitem(last=False)
+            
+    def get_entity(self, sg, event, fields=()):
+        '''
+        Get the entity of the event, with every registered field
+        
+        :param sg: The Shotgun connection to use if the entity isn't cached
+        :type sg: shotgun_api3.Shotgun
+        
+        :param event: The event
+        :type event: dict (EventLogEntry entity)
+        
+        :param fields: Fields to register before getting the entity
+        :type fields: list of str
+        
+        :returns: The event's entity
+        :rtype: dict
+        '''
+        
+        with self._lock:
+            self._fields.update(fields)
+            fields = sorted(self._fields)
+            cached = self._entities.get(event['id'])
+            
+        if cached is not None and cached[1].issuperset(fields):
+            return cached[0]
+        
+        entity = sg.find_one( event['entity']['type'],
+                              [[ 'id', 'is', int(event['entity']['id']) ]],
+                              fields)
+        
+        self.add_entity(event['id'], entity, fields)
+        
+        return entity
+    
+    def prefetch(self, sg, events, batch_size=100):
+        '''
+        Fetch and cache the entities of many events, with a single query per entity type and 
+        batch_size entities
+        
+        :param sg: The Shotgun connection
+        :type sg: shotgun_api3.Shotgun
+        
+        :param events: The events
+        :type events: list of dict (EventLogEntry entities)
+        
+        :returns: The number of entities found
+        :rtype: int
+        '''
+        
+        with self._lock:
+            fields = sorted(self._fields)
+            
+        ids_by_type = collections.defaultdict(set)
+        
+        for event in events:
+            if event.get('entity'):
+                ids_by_type[event['entity']['type']].add(int(event['entity']['id']))
+                
+        entities = {}
+        
+        for entity_type, entity_ids in ids_by_type.items():
+            entity_ids = sorted(entity_ids)
+            
+            for index in range(0, len(entity_ids), batch_size):
+                for entity in sg.find(entity_type, [[ 'id', 'in', entity_ids[index:index + batch_size] ]], fields):
+                    entities[(entity_type, entity['id'])] = entity
+                    
+        for event in events:
+            entity = entities.get((event['entity']['type'], int(event['entity']['id']))) if event.get('entity') else None
+            
+            if entity is not None:
+                self.add_entity(event['id'], entity, fields)
+                
+        return len(entities)
+            
+            
+class EventWorkspace(object):
+    '''
+    A scratch directory that belongs to a single event, so that concurrent events never write to
+    the same files. The directory and everything in it is deleted by cleanup().
+    
+    Work that outlives the event (ie. a background encode) can retain() the workspace, it's then
+    only cleaned-up once every retain() has been matched by a release().
+    
+    Files written concurrently reserve() their size first and free() it once deleted. The quota
+    is enforced against the running count of reserved bytes, the workspace isn't walked.
+    '''
+    
+    def __init__(self, root, event_id, quota_bytes=None):
+        '''
+        :param root: The directory the workspace is created in
+        :type root: str
+        
+        :param event_id: The id of the event the workspace is for
+        :type event_id: int
+        
+        :param quota_bytes: The maximum size of the workspace. None for unlimited.
+        :type quota_bytes: int
+        '''
+        
+        if not os.path.exists(root):
+            try:
+                os.makedirs(root)
+            except OSError:
+                if not os.path.isdir(root):
+                    raise
+        
+        self.quota_bytes = quota_bytes
+        self.path = tempfile.mkdtemp(prefix="event_{}_".format(event_id), dir=root)
+        
+        self._lock = threading.Lock()
+        self._ref_count = 1
+        self._reserved_bytes = 0
+        
+    def get_path(self, *names):
+        '''
+        :returns: The path of the given file in the workspace
+        :rtype: str
+        '''
+        
+        return os.path.join(self.path, *names)
+    
+    def disk_usage(self):
+        '''
+        :returns: The size (in bytes) of all the files in the workspace
+        :rtype: int
+        '''
+        
+        total_size = 0
+        
+        for root, dir_list, file_list in os.walk(self.path):
+            for filename in file_list:
+                try:
+                    total_size += os.path.getsize(os.path.join(root, filename))
+                    
+                # Deleted or renamed by another thread since it was listed
+                except OSError:
+                    continue
+                
+        return total_size
+    
+    def check_quota(self, extra_bytes=0):
+        '''
+        Ensure the workspace (plus extra_bytes that are about to be written) is within its quota
+        '''
+        
+        if self.quota_bytes is None:
+            return
+        
+        disk_usage = self.disk_usage() + extra_bytes
+        
+        if disk_usage > self.quota_bytes:
+            raise Exception("Workspace {} is over its quota ({} > {} bytes)".format(self.path, disk_usage, self.quota_bytes))
+        
+    @contextlib.contextmanager
+    def reserve(self, size):
+        '''
+        Context manager reserving size bytes for a file written in its block. Raises if the 
+        reserved bytes would go over the quota. The reservation is kept once the block completes,
+        until the file is free()d, and is cancelled if the block raises.
+        
+        :param size: The size (in bytes) of the file about to be written
+        :type size: int
+        '''
+        
+        with self._lock:
+            
+            if self.quota_bytes is not None and self._reserved_bytes + size > self.quota_bytes:
+                raise Exception("Workspace {} is over its quota ({} > {} bytes)".format(self.path, self._reserved_bytes + size, self.quota_bytes))
+            
+            self._reserved_bytes += size
+            
+        try:
+            yield
+            
+        except Exception:
+            self.free(size)
+            raise
+        
+    def free(self, size):
+        '''
+        Release the reservation of a file that has been deleted
+        
+        :param size: The size (in bytes) reserved for the file
+        :type size: int
+        '''
+        
+        with self._lock:
+            self._reserved_bytes -= size
+        
+    def retain(self):
+        
+        with self._lock:
+            self._ref_count += 1
+            
+    def release(self):
+        '''
+        Release the workspace, cleaning it up if nothing else has retained it
+        '''
+        
+        with self._lock:
+            self._ref_count -= 1
+            ref_count = self._ref_count
+            
+        if ref_count <= 0:
+            self.cleanup()
+        
+    def cleanup(self):
+        
+        shutil.rmtree(self.path, ignore_errors=True)
+        
 
 class SubmitToConductorSGDaemonPlugin(object):
     
@@ -16,71 +644,763 @@ class SubmitToConductorSGDaemonPlugin(object):
     
     REGISTER_PUBLISH_SCRIPT_PATH = "/usr/local/shotgun/support_files/register_publish.py"
     POST_RENDER_SCRIPT_PATH = "/usr/local/shotgun/support_files/post_render_script.py"
+    RENDER_UPLOADER_SCRIPT_PATH = "/usr/local/shotgun/support_files/render_uploader.py"
     S3_BUCKET = os.environ['AWS_PROJECT_BUCKET']
     TARGET_INSTANCE = '2 core, 13GB Mem'
     
-    EVENT = {"Shotgun_PublishedFile_New": None}    
+    # Tuning for the transfers from S3. The chunk size is in bytes. At most DOWNLOAD_CONCURRENCY
+    # files are downloaded at once by the daemon, whatever the number of events being processed.
+    DOWNLOAD_CONCURRENCY = int(os.environ.get('SG_DAEMON_DOWNLOAD_CONCURRENCY', 8))
+    DOWNLOAD_CHUNK_SIZE = int(os.environ.get('SG_DAEMON_DOWNLOAD_CHUNK_SIZE', 8*1024*1024))
+    DOWNLOAD_RETRIES = int(os.environ.get('SG_DAEMON_DOWNLOAD_RETRIES', 3))
+    
+    # Files downloaded from S3 are kept and re-used until the cache grows over its budget (in bytes)
+    FILE_CACHE_INDEX_PATH = os.environ.get('SG_DAEMON_FILE_CACHE_INDEX', '/var/cache/shotgun_daemon/file_cache.json')
+    FILE_CACHE_MAX_BYTES = int(os.environ.get('SG_DAEMON_FILE_CACHE_MAX_BYTES', 10*1024**3))
+    
+    # Review movies are encoded from keys built from the Shot's cut range instead of listing the
+    # render prefix. Missing frames are skipped.
+    BUILD_SEQUENCE_KEYS = os.environ.get('SG_DAEMON_BUILD_SEQUENCE_KEYS', '0') == '1'
+    
+    EVENT = {"Shotgun_PublishedFile_New": None}
+    EVENT_FIELDS = ['attribute_name', 'event_type', 'created_at', 'entity', 'project', 'meta', 'type', 'user', 'session_uuid', 'user.HumanUser.login']
+    
+    # Conductor and Shotgun catalogue lookups (instance types, packages, ...) are cached for 
+    # CATALOGUE_CACHE_TTL seconds. The snapshot lets a restarted daemon start with a warm cache.
+    CATALOGUE_CACHE_TTL = int(os.environ.get('SG_DAEMON_CATALOGUE_CACHE_TTL', 3600))
+    CATALOGUE_CACHE_SNAPSHOT_PATH = os.environ.get('SG_DAEMON_CATALOGUE_CACHE_SNAPSHOT', '/mount/shotgun-daemon-efs/cache/catalogue.json')
+    
+    # Events are processed on EVENT_WORKERS threads. 0 processes them synchronously in the daemon's
+    # callback. When EVENT_QUEUE_SIZE events are in flight the daemon waits for one to finish.
+    EVENT_WORKERS = int(os.environ.get('SG_DAEMON_EVENT_WORKERS', 0))
+    EVENT_QUEUE_SIZE = int(os.environ.get('SG_DAEMON_EVENT_QUEUE_SIZE', 32))
+    EVENT_WATERMARK_DIR = os.environ.get('SG_DAEMON_EVENT_WATERMARK_DIR', '/mount/shotgun-daemon-efs')
+    
+    # With SKIP_STORED_UPLOADS files that a previous submission has uploaded are given to the job 
+    # as a pre-hashed upload_files manifest instead of upload_paths. The md5s of the files are kept
+    # in UPLOAD_INDEX_PATH so that unchanged files aren't hashed again.
+    UPLOAD_INDEX_PATH = os.environ.get('SG_DAEMON_UPLOAD_INDEX', '/mount/shotgun-daemon-efs/cache/upload_index.db')
+    SKIP_STORED_UPLOADS = os.environ.get('SG_DAEMON_SKIP_STORED_UPLOADS', '0') == '1'
+    
+    # Long shots are split into jobs of FRAME_CHUNK_SIZE frames (0 for a single job). With 
+    # PREVIEW_PASS a job rendering the first, middle and last frames is submitted first.
+    FRAME_CHUNK_SIZE = int(os.environ.get('SG_DAEMON_FRAME_CHUNK_SIZE', 0))
+    PREVIEW_PASS = os.environ.get('SG_DAEMON_PREVIEW_PASS', '0') == '1'
+    
+    # Plugins that implement get_coalesce_key hold events for COALESCE_WINDOW seconds (0 to 
+    # disable) and only process the newest event for a key. COALESCE_WORKERS held events are 
+    # released concurrently. With CANCEL_SUPERSEDED_JOBS, Conductor jobs submitted for an event 
+    # that has since been superseded are killed. With DURABLE_JOBS held events are recorded in the
+    # job queue and held again after a restart.
+    COALESCE_WINDOW = float(os.environ.get('SG_DAEMON_COALESCE_WINDOW', 0))
+    COALESCE_WORKERS = int(os.environ.get('SG_DAEMON_COALESCE_WORKERS', 4))
+    CANCEL_SUPERSEDED_JOBS = os.environ.get('SG_DAEMON_CANCEL_SUPERSEDED_JOBS', '0') == '1'
+    
+    # The submitted jobs of at most SUBMITTED_JOBS_MAX keys are kept for cancelling, and only for 
+    # SUBMITTED_JOBS_TTL seconds after which they're assumed to have finished rendering
+    SUBMITTED_JOBS_MAX = int(os.environ.get('SG_DAEMON_SUBMITTED_JOBS_MAX', 1000))
+    SUBMITTED_JOBS_TTL = float(os.environ.get('SG_DAEMON_SUBMITTED_JOBS_TTL', 24*3600))
+    COALESCE_FIELDS = ['entity', 'task', 'published_file_type.PublishedFileType.code']
+    
+    # The fields of the event's entity needed by the plugin. The entity is fetched once for all 
+    # the plugins (see EventRouter).
+    PUBLISHED_FILE_FIELDS = ['code',
+                             'created_by',
+                             'entity',
+                             'id',
+                             'name',
+                             'path',
+                             'project',
+                             'task',
+                             'published_file_type.PublishedFileType.code',
+                             'task.Task.step.Step.code']
+    
+    # The metrics of every event are written to stdout as json records (METRICS_FORMAT 'json'), in
+    # CloudWatch's embedded metric format ('emf') or not at all ('none'). The aggregated metrics
+    # are served to Prometheus on METRICS_PORT (0 to disable).
+    METRICS_FORMAT = os.environ.get('SG_DAEMON_METRICS_FORMAT', 'json')
+    METRICS_NAMESPACE = os.environ.get('SG_DAEMON_METRICS_NAMESPACE', 'ShotgunDaemon')
+    METRICS_PORT = int(os.environ.get('SG_DAEMON_METRICS_PORT', 0))
+    
+    # With ASYNC_IO the independent I/O of an event (Shotgun queries, S3 transfers, Conductor
+    # catalogue requests) runs concurrently on IO_WORKERS threads shared by all the plugins.
+    ASYNC_IO = os.environ.get('SG_DAEMON_ASYNC_IO', '0') == '1'
+    IO_WORKERS = int(os.environ.get('SG_DAEMON_IO_WORKERS', 16))
+    
+    # With TRANSFER_MODE 'stream' the files the jobs need from S3 aren't downloaded to the local 
+    # disk, they're streamed from S3 to Conductor's storage when the job is built. Their local
+    # paths are only used as names. 'local' downloads them for Conductor to upload.
+    TRANSFER_MODE = os.environ.get('SG_DAEMON_TRANSFER_MODE', 'local')
+    
+    # With DURABLE_JOBS the phases completed by every event are recorded in JOB_QUEUE_PATH. Failed
+    # events are retried JOB_RETRIES times, after JOB_RETRY_DELAY seconds doubled on every retry,
+    # and events interrupted by a restart are resumed from their last completed phase.
+    DURABLE_JOBS = os.environ.get('SG_DAEMON_DURABLE_JOBS', '0') == '1'
+    JOB_QUEUE_PATH = os.environ.get('SG_DAEMON_JOB_QUEUE', '/mount/shotgun-daemon-efs/cache/job_queue.db')
+    JOB_RETRIES = int(os.environ.get('SG_DAEMON_JOB_RETRIES', 3))
+    JOB_RETRY_DELAY = float(os.environ.get('SG_DAEMON_JOB_RETRY_DELAY', 60))
+    
+    # Every event gets its own scratch directory under WORKSPACE_ROOT, limited to WORKSPACE_QUOTA bytes
+    WORKSPACE_ROOT = os.environ.get('SG_DAEMON_WORKSPACE_ROOT', '/tmp/shotgun_daemon')
+    WORKSPACE_QUOTA = int(os.environ.get('SG_DAEMON_WORKSPACE_QUOTA', 2*1024**3))
+    
+    # Shared by all the plugins for the life of the daemon
+    _lock = threading.Lock()
+    _router = EventRouter()
+    _executors = {}
+    _watermarks = {}
+    _coalescers = {}
+    
+    # The time and Conductor job ids of the last submission for every coalesce key, oldest first
+    _submitted_jobs = collections.OrderedDict()
+    _downloader = None
+    _file_cache = None
+    _catalogue_cache = None
+    _upload_index = None
+    _metrics = metrics.MetricsRegistry()
+    _metrics_server = None
+    _io_executor = None
+    _io_slots = None
+    _conductor_uploader = None
+    _io_thread_data = threading.local()
+    _job_queue = None
+    _retry_schedulers = {}
     
     def __init__(self):
         
-        self.sg = None
-        self.logger = None
-        self.event_id = None
-        self.event_entity = None
+        self.sg = None
+        self.logger = None
+        self.event_id = None
+        self.event_entity = None
+        self.workspace = None
+        self.metrics = None
+        
+        # The job of the event in the job queue (DURABLE_JOBS) and the data it can be resumed with
+        self.job = None
+        self.job_data = {}
+        
+        self.s3_dest_path = None
+        self.file_pattern = None
+        self.publish_data_path = None
+        self.render_extension = "exr"        
+        
+        # The chunk being submitted and the upload paths shared by all the chunks
+        self.frame_chunk = None
+        self.upload_manifest = None
+        
+        # PublishedFile entities fetched while resolving dependencies, by id. Only valid for the 
+        # current event.
+        self.published_file_cache = {}
+        
+        # The S3 objects to stream to Conductor by local path and the frames of the sequences
+        self.streamed_objects = {}
+        self.streamed_sequences = {}
+        
+        # The files of the file cache in use by the current event, pinned until it ends
+        self.pinned_paths = []
+        
+    def main(self, sg, logger, event, args=None):
+        '''
+        Daemon callback. Processes the event in its own workspace.
+        
+        :returns: How the event ended, 'processed', 'skipped' or 'failed'. With DURABLE_JOBS a 
+                  failed event is left in the job queue to be retried, otherwise the error is 
+                  raised.
+        :rtype: str
+        '''
+        
+        # The Shotgun requests made for the event are counted in its metrics
+        event_metrics = metrics.EventMetrics(type(self).__name__, event['id'])
+        sg = metrics.InstrumentedShotgun(sg, event_metrics, connection_factory=self.get_sg_instance)
+        
+        if event.get('entity'):
+            
+            with event_metrics.timed('entity_fetch'):
+                entity = self.fetch_event_entity(sg, event)
+                
+            if not self.accepts(entity):
+                logger.debug("Skipping event {}".format(event['id']))
+                return 'skipped'
+        
+        job = None
+        
+        if self.DURABLE_JOBS:
+            job = self.get_job_queue(logger).start(type(self).__name__, event)
+            
+            if job is None:
+                logger.info("Skipping event {}, it's being or has been processed".format(event['id']))
+                return 'skipped'
+            
+            if job['attempts'] > 1:
+                logger.info("Resuming event {} after phase {} (attempt {})".format(event['id'], job['phase'], job['attempts']))
+                event_metrics.add('job_retries')
+        
+        self.start_event(sg, logger, event, event_metrics, job)
+        status = 'failure'
+        
+        try:
+            self.handle_event(event)
+            status = 'success'
+            
+        except Exception as err:
+            
+            if job is None:
+                raise
+            
+            # The event is retried later by the retry scheduler, the daemon moves on
+            state = self.get_job_queue(logger).fail(job['plugin'], event['id'], str(err), self.JOB_RETRIES + 1, self.JOB_RETRY_DELAY)
+            
+            if state == 'retry':
+                logger.exception("Failed to process event {}, it will be retried".format(event['id']))
+                
+            else:
+                logger.exception("Failed to process event {}, giving up after {} attempts".format(event['id'], job['attempts']))
+            
+        finally:
+            self.end_event(status)
+            
+        if status != 'success':
+            return 'failed'
+        
+        if job is not None:
+            self.get_job_queue(logger).complete(job['plugin'], event['id'])
+            
+        return 'processed'
+            
+    def handle_event(self, event):
+        '''
+        Process the event. Must be re-implemented by the plugins.
+        
+        :param event: The event being processed
+        :type event: dict (EventLogEntry entity)
+        '''
+        
+        raise NotImplementedError()
+        
+    def get_event_entity(self, event):
+        '''
+        Get the entity of the event, shared with the other plugins
+        
+        :rtype: dict
+        '''
+        
+        entity = self.fetch_event_entity(self.sg, event)
+        self.complete_phase('fetched')
+            
+        return entity
+    
+    @classmethod
+    def fetch_event_entity(cls, sg, event):
+        '''
+        Get the entity of the event from the router, with (at least) the fields this plugin needs
+        
+        :rtype: dict
+        '''
+        
+        return cls._router.get_entity(sg, event, cls.PUBLISHED_FILE_FIELDS + cls.COALESCE_FIELDS)
+    
+    @classmethod
+    def accepts(cls, entity):
+        '''
+        Whether the plugin should process the event for the given entity. This must be cheap, it's
+        evaluated before the event is queued.
+        
+        :param entity: The event's entity, with PUBLISHED_FILE_FIELDS
+        :type entity: dict
+        
+        :rtype: bool
+        '''
+        
+        return True
+    
+    @staticmethod
+    def get_extension(entity):
+        '''
+        :returns: The extension of the PublishedFile, without the leading period
+        :rtype: str
+        '''
+        
+        return os.path.splitext(entity['path']['local_path_linux'])[-1][1:]
+        
+    def start_event(self, sg, logger, event, event_metrics=None, job=None):
+        '''
+        Reset the state kept for a single event and create its workspace.
+        
+        :param sg: The Shotgun connection to use for the event
+        :type sg: shotgun_api3.Shotgun
+        
+        :param logger: The logger to use for the event
+        :type logger: logging.Logger
+        
+        :param event: The event being processed
+        :type event: dict (EventLogEntry entity)
+        
+        :param event_metrics: The metrics of the event. New metrics are created if None.
+        :type event_metrics: metrics.EventMetrics
+        
+        :param job: The job of the event in the job queue, None unless DURABLE_JOBS is set
+        :type job: dict
+        '''
+        
+        self.sg = sg
+        self.logger = logger
+        self.event_id = event['id']
+        self.metrics = event_metrics or metrics.EventMetrics(type(self).__name__, event['id'])
+        self.event_entity = None
+        self.published_file_cache = {}
+        self.frame_chunk = None
+        self.upload_manifest = None
+        self.streamed_objects = {}
+        self.streamed_sequences = {}
+        self.pinned_paths = []
+        self.job = job
+        self.job_data = dict(job['data']) if job else {}
+        self.workspace = EventWorkspace(self.WORKSPACE_ROOT, self.event_id, quota_bytes=self.WORKSPACE_QUOTA)
+        self.publish_data_path = self.workspace.get_path("published_file.json")
+        
+    def end_event(self, status='success'):
+        '''
+        Clean-up after the event has been processed and emit its metrics
+        
+        :param status: How processing the event ended, 'success' or 'failure'
+        :type status: str
+        '''
+        
+        # The event's files can now be evicted from the file cache. Its index is saved once per 
+        # event rather than after every copy.
+        if self.pinned_paths:
+            cache = self.get_file_cache()
+            cache.unpin(self.pinned_paths)
+            self.pinned_paths = []
+            
+            try:
+                cache.save()
+                
+            except (IOError, OSError) as err:
+                self.logger.warning("Unable to save the file cache index to {} ({})".format(cache.index_path, err))
+        
+        if self.workspace is not None:
+            self.metrics.add('workspace_bytes', self.workspace.disk_usage())
+            self.workspace.release()
+            self.workspace = None
+            
+        if self.metrics is not None:
+            self.metrics.stop(status)
+            self.emit_metrics(self.metrics)
+            self.metrics = None
+            
+    def is_phase_complete(self, phase):
+        '''
+        :returns: Whether the event completed phase, in this attempt or a previous one
+        :rtype: bool
+        '''
+        
+        return phase in self.job_data.get('phases', [])
+    
+    def complete_phase(self, phase, **data):
+        '''
+        Record that the event completed phase, with the data needed to resume it from there. Only
+        persisted when DURABLE_JOBS is set.
+        
+        :param phase: The name of the phase
+        :type phase: str
+        
+        :param data: The values to keep in the job's data. Must be json serializable.
+        '''
+        
+        phases = self.job_data.setdefault('phases', [])
+        
+        if phase not in phases:
+            phases.append(phase)
+            
+        self.save_job_data(**data)
+        
+    def save_job_data(self, **data):
+        '''
+        Update the data the event can be resumed with
+        '''
+        
+        self.job_data.update(data)
+        
+        if self.job is not None:
+            phases = self.job_data.get('phases')
+            self.get_job_queue(self.logger).set_phase(self.job['plugin'], self.event_id, phases[-1] if phases else None, self.job_data)
+            
+    def emit_metrics(self, event_metrics):
+        '''
+        Write the metrics of a completed event to stdout, in METRICS_FORMAT, and add them to the
+        metrics served to Prometheus
+        
+        :param event_metrics: The metrics of the event
+        :type event_metrics: metrics.EventMetrics
+        '''
+        
+        self._metrics.record(event_metrics)
+        
+        if self.METRICS_FORMAT == 'json':
+            metrics.get_metrics_logger().info(event_metrics.to_json())
+            
+        elif self.METRICS_FORMAT == 'emf':
+            metrics.get_metrics_logger().info(event_metrics.to_emf(self.METRICS_NAMESPACE))
+        
+    def get_downloader(self):
+        '''
+        Get the downloader shared by all the plugins. It's created on first use so that the
+        connection pool is kept for the life of the daemon.
+        
+        :returns: The downloader for S3_BUCKET
+        :rtype: s3_transfer.S3Downloader
+        '''
+        
+        cls = SubmitToConductorSGDaemonPlugin
+        
+        with cls._lock:
+            if cls._downloader is None:
+                max_concurrency = 4
+                client = client_registry.get_s3_client(max_pool_connections=self.DOWNLOAD_CONCURRENCY * max_concurrency)
+                cls._downloader = s3_transfer.S3Downloader(self.S3_BUCKET,
+                                                           max_workers=self.DOWNLOAD_CONCURRENCY,
+                                                           multipart_chunksize=self.DOWNLOAD_CHUNK_SIZE,
+                                                           max_concurrency=max_concurrency,
+                                                           max_retries=self.DOWNLOAD_RETRIES,
+                                                           client=client,
+                                                           logger=self.logger)
+            
+        return cls._downloader
+        
+    def get_file_cache(self):
+        '''
+        Get the cache of files downloaded from S3, shared by all the plugins.
+        
+        :returns: The file cache
+        :rtype: file_cache.LocalFileCache
+        '''
+        
+        cls = SubmitToConductorSGDaemonPlugin
+        
+        with cls._lock:
+            if cls._file_cache is None:
+                cls._file_cache = file_cache.LocalFileCache(self.FILE_CACHE_INDEX_PATH,
+                                                            max_bytes=self.FILE_CACHE_MAX_BYTES,
+                                                            logger=self.logger)
+            
+        return cls._file_cache
+        
+    def get_catalogue_cache(self):
+        '''
+        Get the cache of catalogue lookups, shared by all the plugins. Call invalidate() on it to
+        force the values to be fetched again.
+        
+        :returns: The catalogue cache
+        :rtype: ttl_cache.TTLCache
+        '''
+        
+        cls = SubmitToConductorSGDaemonPlugin
+        
+        with cls._lock:
+            if cls._catalogue_cache is None:
+                cls._catalogue_cache = ttl_cache.TTLCache(self.CATALOGUE_CACHE_TTL,
+                                                          snapshot_path=self.CATALOGUE_CACHE_SNAPSHOT_PATH,
+                                                          logger=self.logger)
+                
+        return cls._catalogue_cache
+        
+    def get_upload_index(self):
+        '''
+        Get the index of the md5s of the uploaded files, shared by all the plugins.
+        
+        :rtype: upload_index.UploadIndex
+        '''
+        
+        cls = SubmitToConductorSGDaemonPlugin
+        
+        with cls._lock:
+            if cls._upload_index is None:
+                cls._upload_index = upload_index.UploadIndex(self.UPLOAD_INDEX_PATH, logger=self.logger)
+                
+        return cls._upload_index
+    
+    def get_conductor_uploader(self):
+        '''
+        Get the uploader streaming files from S3 to Conductor, shared by all the plugins.
+        
+        :rtype: conductor_transfer.S3ToConductorUploader
+        '''
+        
+        cls = SubmitToConductorSGDaemonPlugin
+        index = self.get_upload_index()
+        
+        with cls._lock:
+            if cls._conductor_uploader is None:
+                client = client_registry.get_s3_client(max_pool_connections=self.DOWNLOAD_CONCURRENCY * 4)
+                cls._conductor_uploader = conductor_transfer.S3ToConductorUploader(self.S3_BUCKET,
+                                                                                   client,
+                                                                                   index,
+                                                                                   max_workers=self.DOWNLOAD_CONCURRENCY,
+                                                                                   max_retries=self.DOWNLOAD_RETRIES,
+                                                                                   logger=self.logger)
+                
+        return cls._conductor_uploader
+    
+    @classmethod
+    def get_job_queue(cls, logger=None):
+        '''
+        Get the job queue shared by all the plugins
+        
+        :rtype: job_queue.JobQueue
+        '''
+        
+        with cls._lock:
+            if SubmitToConductorSGDaemonPlugin._job_queue is None:
+                SubmitToConductorSGDaemonPlugin._job_queue = job_queue.JobQueue(cls.JOB_QUEUE_PATH, logger=logger)
+                
+        return SubmitToConductorSGDaemonPlugin._job_queue
+    
+    def get_io_executor(self):
+        '''
+        Get the executor running the I/O of every plugin in ASYNC_IO mode. Its size bounds the 
+        number of I/O operations in flight across all the events.
+        
+        :rtype: concurrent.futures.ThreadPoolExecutor
+        '''
+        
+        cls = SubmitToConductorSGDaemonPlugin
+        
+        with cls._lock:
+            if cls._io_executor is None:
+                cls._io_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.IO_WORKERS)
+                
+                # One for every thread, taken by a call from its submission until it completes
+                cls._io_slots = threading.Semaphore(self.IO_WORKERS)
+                
+        return cls._io_executor
+    
+    def run_concurrently(self, *calls):
+        '''
+        Run independent I/O bound calls and wait for all of them to complete. In ASYNC_IO mode the
+        calls run concurrently on the I/O executor, otherwise they run one after the other.
+        
+        Nested calls, made from an I/O thread, only go to the executor when one of its threads is
+        free and otherwise run inline. A call is therefore never queued behind the calls waiting 
+        for it, however deeply they're nested.
+        
+        :param calls: The calls to make. They take no arguments.
+        :type calls: list of callable
+        
+        :returns: The results of the calls, in order
+        :rtype: list
+        
+        :raises: The exception of the first call that failed, once every call has completed
+        '''
+        
+        if not self.ASYNC_IO or len(calls) < 2:
+            return [ call() for call in calls ]
+        
+        io_thread_data = SubmitToConductorSGDaemonPlugin._io_thread_data
+        executor = self.get_io_executor()
+        slots = SubmitToConductorSGDaemonPlugin._io_slots
+        
+        # An event's thread waits for a free I/O thread, an I/O thread never does
+        is_nested = getattr(io_thread_data, 'active', False)
+        
+        def run(call):
+            io_thread_data.active = True
+            
+            try:
+                return call()
+            
+            finally:
+                io_thread_data.active = False
+                slots.release()
+                
+        futures = []
+        inline_calls = []
+        
+        for call in calls:
+            
+            if slots.acquire(not is_nested):
+                futures.append(executor.submit(run, call))
+                
+            else:
+                future = concurrent.futures.Future()
+                futures.append(future)
+                inline_calls.append((future, call))
+                
+        # Every call completes before the first error is raised, like the submitted ones
+        for future, call in inline_calls:
+            
+            try:
+                future.set_result(call())
+                
+            except Exception as err:
+                future.set_exception(err)
+        
+        concurrent.futures.wait(futures)
+        
+        return [ future.result() for future in futures ]
+    
+    def prefetch_catalogue(self):
+        '''
+        Fetch the catalogue entries (packages, instance types and PublishedFileTypes) needed to
+        build the Conductor job, so that building it doesn't wait on them
+        '''
+        
+        self.run_concurrently(self.get_package_ids,
+                              lambda: self.get_instance_type(self.TARGET_INSTANCE),
+                              self.get_image_published_file_type)
+    
+    def get_upload_manifest(self, paths):
+        '''
+        Get the md5 of the files to upload, hashing files that changed since they were last
+        hashed in parallel. Files are only hashed with SKIP_STORED_UPLOADS, nothing else uses 
+        their md5.
+        
+        :param paths: The paths to upload. Duplicates are dropped.
+        :type paths: list of str
+        
+        :returns: The md5 of every path. None for paths that can't be hashed (ie. sequences), 
+                  that are streamed from S3 or when SKIP_STORED_UPLOADS is off.
+        :rtype: collections.OrderedDict
+        '''
+        
+        manifest = collections.OrderedDict( (path, None) for path in paths )
+        
+        if not self.SKIP_STORED_UPLOADS:
+            return manifest
+        
+        index = self.get_upload_index()
+        hashable_paths = [ path for path in manifest if path not in self.streamed_objects and os.path.isfile(path) ]
+        
+        with self.metrics.timed('upload_hash'), concurrent.futures.ThreadPoolExecutor(max_workers=self.DOWNLOAD_CONCURRENCY) as executor:
+            for path, md5 in zip(hashable_paths, executor.map(index.get_md5, hashable_paths)):
+                manifest[path] = md5
+                
+        return manifest
+        
+    def get_s3_objects(self, file_path, start_frame=None, end_frame=None, list_objects=True):
+        '''
+        List the S3 objects for file_path
+        
+        Only the frames of a sequence that match its pattern and fall inside the frame range (if
+        given) are returned. Frames of the range that are missing on S3 are logged.
+        
+        :param file_path: The path on S3. A sequence using '%[0-9]d' notation is accepted.
+        :type file_path: str
+        
+        :param start_frame: The first frame of a sequence. None for every frame.
+        :type start_frame: int
+        
+        :param end_frame: The last frame of a sequence. None for every frame.
+        :type end_frame: int
+        
+        :param list_objects: When False and the frame range is known, the keys of the sequence are
+                             built from the range instead of listing the bucket. The objects then
+                             only have a Key.
+        :type list_objects: bool
+        
+        :returns: The objects (Key, ETag, Size, ...), sorted by frame
+        :rtype: list of dict
+        '''
+        
+        downloader = self.get_downloader()
         
-        self.s3_dest_path = None
-        self.file_pattern = None
-        self.render_extension = "exr"        
+        # Deal with file sequences
+        if s3_transfer.S3Sequence.is_sequence(file_path):
+            
+            # Strip out the leading forward-slash
+            sequence = s3_transfer.S3Sequence(file_path[1:])
+            
+            if not list_objects and start_frame is not None and end_frame is not None:
+                self.logger.debug("Building sequence {} [{}-{}]".format(file_path, start_frame, end_frame))
+                return downloader.build_sequence(sequence, start_frame, end_frame)
+            
+            self.logger.debug("Querying sequence {}".format(file_path))
+            
+            with self.metrics.timed('s3_list'):
+                s3_objects, missing_frames = downloader.list_sequence(sequence, start_frame, end_frame)
+            
+            if missing_frames:
+                self.metrics.add('missing_frames', len(missing_frames))
+                self.logger.warning("{} is missing {} frames: {}".format(file_path, len(missing_frames), missing_frames))
+            
+            return s3_objects
+            
+        with self.metrics.timed('s3_list'):
+            s3_object = downloader.get_object_info(file_path[1:])
         
-    def copy_from_s3(self, file_path):
+        if s3_object is None:
+            raise Exception("Unable to find {} in the s3 bucket {}".format(file_path, self.S3_BUCKET))
+        
+        return [s3_object]
+        
+    def copy_from_s3(self, file_path, start_frame=None, end_frame=None):
         '''
         Copies file_path from an S3 bucket to local storage, using the same path.
         
+        Files that have already been downloaded are re-used if their ETag and size still match
+        the object on S3.
+        
         :param file_path: The path on S3. A sequence using '%[0-9]d' notation is accepted.
         :type file_path: str
         
+        :param start_frame: The first frame of a sequence to copy. None for every frame.
+        :type start_frame: int
+        
+        :param end_frame: The last frame of a sequence to copy. None for every frame.
+        :type end_frame: int
+        
         :returns: The file paths on the local storage
         :rtype: list of str
         '''
         
         self.logger.debug("Copy from S3 {}".format(file_path))
         
-        local_file_paths = []
-                
-        # Deal with file sequences
-        match = re.search('%0[\d]d', file_path)
-        
-        if match:
-            self.logger.debug("Querying sequence")
-            s3 = boto3.resource('s3')
-            bucket = s3.Bucket(self.S3_BUCKET)
-            prefix = file_path.split(match.group())[0]
-
-            for file_obj in bucket.objects.filter(Prefix=prefix[1:]):
-                local_file_paths.extend(self.copy_from_s3("/{}".format(file_obj.key)))
-                
-        # Don't download if the file already exists. The check is only being peformed based on the
-        # filename. A more rigourous check is suggested.
-        elif os.path.exists(file_path):
-            filesize = os.path.getsize(file_path)
-            self.logger.info("File {} exists ({}). Skipping".format(file_path, filesize))
-            local_file_paths = [file_path]
+        downloader = self.get_downloader()
+        cache = self.get_file_cache()
+        s3_objects = self.get_s3_objects(file_path, start_frame, end_frame)
             
-        else:
+        local_file_paths = [ "/{}".format(s3_object['Key']) for s3_object in s3_objects ]
         
-            self.logger.info("Downloading {}".format(file_path))
+        if self.TRANSFER_MODE == 'stream':
             
-            parent_dir = os.path.dirname(file_path)
-            
-            if not os.path.exists(parent_dir):
-                os.makedirs(parent_dir)
-            
-            s3 = boto3.client('s3')
+            # Nothing is downloaded, the objects are streamed to Conductor when the job is built
+            for local_file_path, s3_object in zip(local_file_paths, s3_objects):
+                self.streamed_objects[local_file_path] = s3_object
+                
+            if s3_transfer.S3Sequence.is_sequence(file_path):
+                self.streamed_sequences[file_path] = local_file_paths
+                
+            return local_file_paths
+        
+        # The files must stay on disk until the job has uploaded them, whatever other events evict
+        cache.pin(local_file_paths)
+        self.pinned_paths.extend(local_file_paths)
+        
+        missing_objects = []
+        
+        for local_file_path, s3_object in zip(local_file_paths, s3_objects):
             
-            # Strip out the leading forward-slash
-            s3.download_file(self.S3_BUCKET, file_path[1:], file_path)
+            if cache.lookup(local_file_path, s3_object['ETag'], s3_object['Size']):
+                self.logger.debug("File {} is cached. Skipping".format(local_file_path))
+                
+            else:
+                missing_objects.append(s3_object)
+        
+        self.logger.info("{} of {} files are cached".format(len(s3_objects) - len(missing_objects), len(s3_objects)))
+        
+        self.metrics.add('file_cache_hits', len(s3_objects) - len(missing_objects))
+        self.metrics.add('file_cache_misses', len(missing_objects))
+        
+        with self.metrics.timed('download'):
+            downloader.download([ (s3_object['Key'], "/{}".format(s3_object['Key'])) for s3_object in missing_objects ])
             
-            local_file_paths = [file_path]
+        self.metrics.add('files_downloaded', len(missing_objects))
+        self.metrics.add('bytes_downloaded', sum( s3_object['Size'] for s3_object in missing_objects ))
+        
+        for s3_object in missing_objects:
+            cache.add("/{}".format(s3_object['Key']), s3_object['Key'], s3_object['ETag'], s3_object['Size'])
+        
+        cache.evict()
         
         return local_file_paths
     
@@ -95,17 +1415,185 @@ class SubmitToConductorSGDaemonPlugin(object):
         :type end_frame: int       
         '''
         
-        # Dump the data needed to publish the render into a json file to be uploaded
-        self.dump_render_publish_data(self.event_entity)
+        if self.is_phase_complete('submitted'):
+            self.logger.info("The jobs of event {} were submitted by a previous attempt".format(self.event_id))
+            return
         
-        # Copy the scene file from cloud storage
-        file_path = self.event_entity['path']['local_path_linux']
-        self.copy_from_s3(file_path)
+        # Dump the data needed to publish the render into a json file to be uploaded, copy the 
+        # scene file and its dependencies from cloud storage (download_dependencies copies the 
+        # scene) and warm-up the catalogue. These are independent and overlap in ASYNC_IO mode.
+        self.run_concurrently(lambda: self.dump_render_publish_data(self.event_entity),
+                              self.download_dependencies,
+                              self.prefetch_catalogue)
         
-        self.download_dependencies()
-
-        conductor_job = self.build_conductor_job(start_frame, end_frame)
-        conductor_job.submit_job()
+        # Downloads are re-run when the event is resumed as the local disk may not have survived,
+        # the file cache makes it cheap when it did
+        self.complete_phase('downloaded')
+        
+        chunks = plan_frame_chunks(start_frame, end_frame, self.FRAME_CHUNK_SIZE, self.PREVIEW_PASS)
+        
+        # The Conductor jobs submitted for every chunk, including by previous attempts
+        submitted_chunks = dict(self.job_data.get('submitted_chunks', {}))
+        
+        for chunk in chunks:
+            chunk_key = "{}-{}x{}{}".format(chunk.start, chunk.end, chunk.step, " (preview)" if chunk.preview else "")
+            
+            if chunk_key in submitted_chunks:
+                self.logger.info("Frames {} were submitted by a previous attempt".format(chunk_key))
+                self.record_submitted_job({'jobid': submitted_chunks[chunk_key]})
+                continue
+            
+            if chunk.frames:
+                self.logger.info("Submitting frames {}{}".format(", ".join(str(frame) for frame in chunk.frames), " (preview)" if chunk.preview else ""))
+                
+            else:
+                self.logger.info("Submitting frames {}-{}x{}{}".format(chunk.start, chunk.end, chunk.step, " (preview)" if chunk.preview else ""))
+            
+            self.frame_chunk = chunk
+            
+            with self.metrics.timed('job_build'):
+                conductor_job = self.build_conductor_job(chunk.start, chunk.end)
+            
+            # The job's files are uploaded as part of the submission
+            with self.metrics.timed('job_submit'):
+                response = conductor_job.submit_job()
+                
+            self.metrics.add('jobs_submitted')
+            self.metrics.add('files_uploaded', len(conductor_job.upload_paths))
+            self.record_submitted_job(response)
+            
+            # The files are now in Conductor's storage. The index only speeds-up later submissions.
+            if self.SKIP_STORED_UPLOADS:
+                try:
+                    self.get_upload_index().mark_stored([ md5 for md5 in self.upload_manifest.values() if md5 ])
+                    
+                except (OSError, sqlite3.Error) as err:
+                    self.logger.warning("Unable to record the uploaded files in {} ({})".format(self.UPLOAD_INDEX_PATH, err))
+            
+            submitted_chunks[chunk_key] = response.get('jobid') if isinstance(response, dict) else None
+            self.save_job_data(submitted_chunks=submitted_chunks)
+            
+        self.complete_phase('submitted')
+            
+    def record_submitted_job(self, response):
+        '''
+        Keep track of the submitted Conductor job with CANCEL_SUPERSEDED_JOBS, so that it can be 
+        cancelled if the event is superseded.
+        
+        :param response: The response from submitting the job
+        :type response: dict
+        '''
+        
+        if not self.CANCEL_SUPERSEDED_JOBS:
+            return
+        
+        key = self.get_coalesce_key(self.event_entity)
+        job_id = response.get('jobid') if isinstance(response, dict) else None
+        
+        if key is None or job_id is None:
+            return
+        
+        self.logger.info("Submitted Conductor job {}".format(job_id))
+        
+        with self._lock:
+            
+            # Moved to the end, the chunks of an event all expire with its last one
+            _, job_ids = self._submitted_jobs.pop(key, (None, []))
+            self._submitted_jobs[key] = (time.time(), job_ids + [job_id])
+            
+            self.expire_submitted_jobs()
+            
+    @classmethod
+    def expire_submitted_jobs(cls):
+        '''
+        Forget the jobs submitted more than SUBMITTED_JOBS_TTL seconds ago and the oldest ones 
+        beyond SUBMITTED_JOBS_MAX keys. Must be called with the lock held.
+        '''
+        
+        expiry_time = time.time() - cls.SUBMITTED_JOBS_TTL
+        
+        while cls._submitted_jobs:
+            
+            key, (submitted_time, _) = next(iter(cls._submitted_jobs.items()))
+            
+            if submitted_time > expiry_time and len(cls._submitted_jobs) <= cls.SUBMITTED_JOBS_MAX:
+                break
+            
+            del cls._submitted_jobs[key]
+            
+    def apply_frame_chunk(self, conductor_job):
+        '''
+        Configure the job for the frame chunk being submitted. Must be called by 
+        build_conductor_job before the job's environment is resolved.
+        
+        All the chunks share the same, deduplicated, upload paths. The render is published by the
+        first chunk to complete once every frame of the range is on S3 (see register_publish.py).
+        The preview chunk doesn't publish.
+        
+        Files streamed from S3 (TRANSFER_MODE 'stream') are uploaded here, for all the chunks.
+        
+        :param conductor_job: The job to configure
+        :type conductor_job: conductor.__beta__.job.Job
+        '''
+        
+        chunk = self.frame_chunk
+        
+        if self.upload_manifest is None:
+            
+            # Sequences streamed from S3 are uploaded frame by frame
+            upload_paths = []
+            
+            for path in conductor_job.upload_paths:
+                upload_paths.extend(self.streamed_sequences.get(path, [path]))
+                
+            self.upload_manifest = self.get_upload_manifest(upload_paths)
+            streamed_files = dict( (path, self.streamed_objects[path]) for path in self.upload_manifest if path in self.streamed_objects )
+            
+            if streamed_files:
+                with self.metrics.timed('stream_upload'):
+                    self.upload_manifest.update(self.get_conductor_uploader().upload(streamed_files, getattr(conductor_job, 'project', None)))
+                    
+                self.metrics.add('files_streamed', len(streamed_files))
+                self.metrics.add('bytes_streamed', sum( s3_object['Size'] for s3_object in streamed_files.values() ))
+            
+        conductor_job.upload_paths = list(self.upload_manifest)
+        
+        # Files that are already in Conductor's storage are given with their md5 instead of being
+        # uploaded by the job
+        uploaded_files = dict( (path, self.upload_manifest[path]) for path in self.upload_manifest if path in self.streamed_objects )
+        
+        if self.SKIP_STORED_UPLOADS:
+            index = self.get_upload_index()
+            stored_files = dict( (path, md5) for path, md5 in self.upload_manifest.items() if md5 and index.is_stored(md5) )
+            
+            self.logger.info("Skipping the upload of {} files that are already stored".format(len(stored_files)))
+            self.metrics.add('uploads_skipped', len(stored_files))
+            
+            uploaded_files.update(stored_files)
+            
+        if uploaded_files or self.SKIP_STORED_UPLOADS:
+            conductor_job.upload_paths = [ path for path in self.upload_manifest if path not in uploaded_files ]
+            conductor_job.upload_files = uploaded_files
+        
+        if chunk is None:
+            return
+        
+        start_frame = self.event_entity['entity.Shot.sg_cut_in']
+        end_frame = self.event_entity['entity.Shot.sg_cut_out']
+        
+        conductor_job.frame_step = chunk.step
+        
+        if chunk.preview:
+            conductor_job.job_title = "{} [preview]".format(conductor_job.job_title)
+            conductor_job.frames = chunk.frames
+            conductor_job.post_job_cmd = None
+            
+        elif (chunk.start, chunk.end) != (start_frame, end_frame):
+            conductor_job.job_title = "{} [{}-{}]".format(conductor_job.job_title, chunk.start, chunk.end)
+            
+            # Every chunk runs register_publish.py, the render is published by the first chunk to
+            # find every frame of the range on S3
+            conductor_job.environment['PUBLISH_FRAME_RANGE'] = "{}-{}".format(start_frame, end_frame)
     
     def dump_render_publish_data(self, src_publish_file):
         '''
@@ -126,7 +1614,7 @@ class SubmitToConductorSGDaemonPlugin(object):
                                'entity': src_publish_file['entity'],
                                }
         
-        with open("/tmp/published_file.json", 'w') as fh:
+        with open(self.publish_data_path, 'w') as fh:
             json.dump(published_file_data, fh)
             
     def get_image_published_file_type(self):
@@ -137,9 +1625,11 @@ class SubmitToConductorSGDaemonPlugin(object):
         :rtype: dict (PublishedFileType entity)        
         '''
 
-        published_file_type = self.sg.find_one("PublishedFileType",
-                                               filters=[ [ 'code', 'is', "Image" ]]
-                                              )
+        published_file_type = self.get_catalogue_cache().get_or_load(
+            "PublishedFileType:Image",
+            lambda: self.sg.find_one("PublishedFileType",
+                                     filters=[ [ 'code', 'is', "Image" ]]
+                                    ))
         
         if not published_file_type:
             raise Exception("Unable to find an 'Image' PublishedFileType for the project {}".format(self.event_entity['project']))
@@ -148,33 +1638,110 @@ class SubmitToConductorSGDaemonPlugin(object):
             
     def get_dependency_entities(self, published_files):
         '''
-        Recursively get all the dependencies entities for the given dependencies
+        Get all the dependencies entities for the given dependencies
         
         :param published_files: the list of published_files to search for dependents
         :type published_files: list of dict (PublishedFile entities)
         
-        :return: All the dependencies of the given published_files
+        :return: All the dependencies of the given published_files, without duplicates
         :rtype: list of dicts (PublishedFile entities)
         '''
         
-        if not published_files:
-            return []
+        return [ entity for level_entities in self.iter_dependency_levels(published_files) for entity in level_entities ]
+    
+    def iter_dependency_levels(self, published_files):
+        '''
+        Walk the dependency graph of the given dependencies breadth-first, with a single Shotgun 
+        query per level. Every level is yielded as soon as it's been queried.
+        
+        PublishedFiles are only queried once per event so subsequent walks that share part of the
+        graph are (mostly) free. Cycles in the graph are ignored.
+        
+        :param published_files: the list of published_files to search for dependents
+        :type published_files: list of dict (PublishedFile entities)
+        
+        :return: The dependencies of every level, without duplicates
+        :rtype: generator of list of dicts (PublishedFile entities)
+        '''
         
         fields = ['id', 'path', 'downstream_published_files']
         
-        self.logger.debug("Finding dependencies for {}".format(published_files))
+        visited_ids = set()
+        level_ids = [ int(published_file['id']) for published_file in published_files or [] ]
         
-        ids = [ int(published_file['id']) for published_file in published_files ]
-
-        dependency_entities = self.sg.find( "PublishedFile",
-                                           [[ 'id', 'in', ids ]],
-                                           fields)
+        while level_ids:
+            
+            # Deduplicate while preserving the order
+            unvisited_ids = []
+            
+            for id_ in level_ids:
+                if id_ not in visited_ids:
+                    visited_ids.add(id_)
+                    unvisited_ids.append(id_)
+                    
+            level_ids = unvisited_ids
+            
+            query_ids = [ id_ for id_ in level_ids if id_ not in self.published_file_cache ]
+            
+            if query_ids:
+                self.logger.debug("Finding dependencies for {}".format(query_ids))
+                
+                with self.metrics.timed('dependency_resolution'):
+                    entities = self.sg.find( "PublishedFile",
+                                             [[ 'id', 'in', query_ids ]],
+                                             fields)
+                
+                # Every PublishedFile is only fetched once per event, this adds up to the size of
+                # the dependency graph
+                self.metrics.add('dependency_levels')
+                self.metrics.add('dependencies_fetched', len(entities))
+                
+                for entity in entities:
+                    self.published_file_cache[entity['id']] = entity
+            
+            level_entities = [ self.published_file_cache[id_] for id_ in level_ids if id_ in self.published_file_cache ]
+            
+            if level_entities:
+                yield level_entities
+            
+            # The next level is made up of the dependencies of this level
+            level_ids = [ int(dependency['id']) 
+                          for entity in level_entities 
+                          for dependency in entity['downstream_published_files'] or []
+                          if int(dependency['id']) not in visited_ids ]
+    
+    def copy_dependencies_from_s3(self, published_files):
+        '''
+        Copy all the dependencies of the given dependencies from S3 while their graph is walked.
+        The files of every level are queued for download as soon as the level has been queried, so
+        they download while the next levels are queried. Returns once every file is on disk.
+        
+        The threads here only look the files up on S3 and in the file cache, the files themselves
+        are downloaded by the threads of the shared downloader.
+        
+        :param published_files: the list of published_files to search for dependents
+        :type published_files: list of dict (PublishedFile entities)
+        
+        :return: All the dependencies of the given published_files, without duplicates
+        :rtype: list of dicts (PublishedFile entities)
+        '''
         
-        # For each dependency, get its dependencies and build a flat list
-        for dependency in dependency_entities:
-            if dependency['downstream_published_files']:
-                dependency_entities.extend(self.get_dependency_entities(dependency['downstream_published_files']))
+        dependency_entities = []
+        futures = []
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.DOWNLOAD_CONCURRENCY))
+        
+        try:
+            for level_entities in self.iter_dependency_levels(published_files):
+                dependency_entities.extend(level_entities)
+                futures.extend( executor.submit(self.copy_from_s3, entity['path']['local_path_linux']) for entity in level_entities )
                 
+        finally:
+            executor.shutdown(wait=True)
+            
+        # Raise the first download that failed
+        for future in futures:
+            future.result()
+            
         return dependency_entities
     
     def get_package_ids(self):
@@ -188,6 +1755,24 @@ class SubmitToConductorSGDaemonPlugin(object):
         
         return []
     
+    def get_host_package(self, product, version):
+        '''
+        Get a Conductor host package. See conductor.lib.package_utils.get_host_package
+        
+        :param product: The name of the host product (ie. maya-io)
+        :type product: str
+        
+        :param version: The version of the host product
+        :type version: str
+        
+        :return: The host package and its plugins
+        :rtype: dict
+        '''
+        
+        return self.get_catalogue_cache().get_or_load(
+            "host_package:{}:{}".format(product, version),
+            lambda: conductor.lib.package_utils.get_host_package(product, version, strict=False))
+    
     def get_instance_type(self, target_instance):
         '''
         Get the required instance type necessary for the job
@@ -200,7 +1785,9 @@ class SubmitToConductorSGDaemonPlugin(object):
         :rtype: str        
         '''
         
-        instances = conductor.lib.api_client.request_instance_types(as_dict=True)
+        instances = self.get_catalogue_cache().get_or_load(
+            "instance_types",
+            lambda: conductor.lib.api_client.request_instance_types(as_dict=True))
         
         instance = instances.get(target_instance)
         
@@ -213,30 +1800,302 @@ class SubmitToConductorSGDaemonPlugin(object):
     def get_event(cls, event_id):
                 
         sg = cls.get_sg_instance()
-        event_fields = ['attribute_name', 'event_type', 'created_at', 'entity', 'project', 'meta', 'type', 'user', 'session_uuid', 'user.HumanUser.login']
         
         return sg.find_one( "EventLogEntry", 
                             [[ 'id', 'is', int(event_id) ]],
-                            event_fields)
+                            cls.EVENT_FIELDS)
         
     @classmethod
     def get_sg_instance(cls):
+        '''
+        Get the Shotgun connection for the current thread. The connection is re-used across events.
+        
+        :rtype: shotgun_api3.Shotgun
+        '''
+        
+        return client_registry.get_shotgun(cls.SERVER,
+                                           cls.SCRIPT_NAME,
+                                           cls.SCRIPT_KEY)           
+        
+    @classmethod
+    def get_watermark_path(cls):
+        '''
+        :returns: The file the id of the last event processed by this plugin class is saved to
+        :rtype: str
+        '''
+        
+        return os.path.join(cls.EVENT_WATERMARK_DIR, "{}.last_event_id".format(cls.__name__))
+        
+    @classmethod
+    def get_watermark(cls, logger=None):
+        '''
+        Get the id of the last event processed by this plugin class, whether the events are 
+        processed synchronously, on worker threads or held
+        
+        :rtype: EventWatermark
+        '''
+        
+        with cls._lock:
+            
+            if cls not in cls._watermarks:
+                cls._watermarks[cls] = EventWatermark(cls.get_watermark_path(), logger=logger)
+                
+            return cls._watermarks[cls]
+        
+    @classmethod
+    def get_executor(cls, logger=None):
+        '''
+        Get the executor that processes the events for this plugin class
+        
+        :rtype: EventExecutor
+        '''
+        
+        with cls._lock:
+            
+            if cls not in cls._executors:
+                cls._executors[cls] = EventExecutor(cls.EVENT_WORKERS,
+                                                    cls.EVENT_QUEUE_SIZE,
+                                                    logger=logger)
+                
+            return cls._executors[cls]
+        
+    @classmethod
+    def dispatch_event(cls, sg, logger, event, args=None):
+        '''
+        Daemon callback that queues the event to be processed by a worker thread.
+        
+        The daemon's Shotgun connection isn't thread-safe, each worker uses its own.
+        '''
+        
+        entity = event.get('entity') or {'type': 'EventLogEntry', 'id': event['id']}
+        ordering_key = (entity['type'], entity['id'])
+        
+        # Don't tie up a worker with events the plugin will skip
+        if event.get('entity') and not cls.accepts(cls.fetch_event_entity(sg, event)):
+            logger.debug("Skipping event {}".format(event['id']))
+            cls.get_watermark(logger).finish(event['id'])
+            return
+        
+        # Started before it's queued so that the events after it can't move the watermark past it
+        cls.get_watermark(logger).start(event['id'])
+        
+        logger.debug("Queuing event {}".format(event['id']))
+        cls.get_executor(logger).submit(ordering_key, event['id'], cls.process_daemon_event, logger, event, args)
+        
+    @classmethod
+    def process_event(cls, logger, event, args=None):
+        '''
+        Process the event on the current thread with a new plugin instance
+        
+        :returns: How the event ended, see main
+        :rtype: str
+        '''
+        
+        return cls().main(cls.get_sg_instance(), logger, event, args)
+        
+    @classmethod
+    def process_daemon_event(cls, logger, event, args=None):
+        '''
+        Process an event received by the daemon on the current thread and move the watermark once
+        it's done, even if it failed
+        '''
+        
+        watermark = cls.get_watermark(logger)
+        watermark.start(event['id'])
+        
+        try:
+            cls.process_event(logger, event, args)
+            
+        finally:
+            watermark.finish(event['id'])
+        
+    @classmethod
+    def get_coalesce_key(cls, entity):
+        '''
+        Get the key of the events that supersede each other. Plugins that want their events to be
+        coalesced must re-implement it.
+        
+        :param entity: The event's entity, with at least COALESCE_FIELDS
+        :type entity: dict (PublishedFile entity)
+        
+        :returns: The key, or None if the event must not be coalesced
+        :rtype: hashable
+        '''
+        
+        return None
+    
+    @classmethod
+    def coalesce_event(cls, sg, logger, event, args=None):
+        '''
+        Daemon callback that holds the event for COALESCE_WINDOW seconds before processing it,
+        unless it's superseded by a newer event in the meantime.
+        
+        :returns: False if the plugin skips the event
+        :rtype: bool
+        '''
+        
+        entity = cls.fetch_event_entity(sg, event) if event.get('entity') else None
+        
+        if entity is not None and not cls.accepts(entity):
+            logger.debug("Skipping event {}".format(event['id']))
+            cls.get_watermark(logger).finish(event['id'])
+            return False
+        
+        key = cls.get_coalesce_key(entity) if entity else None
+        
+        if key is None:
+            cls.dispatch(sg, logger, event, args)
+            return True
+        
+        with cls._lock:
+            
+            if cls not in cls._coalescers:
+                cls._coalescers[cls] = EventCoalescer(cls.COALESCE_WINDOW, cls.dispatch, max_workers=cls.COALESCE_WORKERS, logger=logger)
+                
+            coalescer = cls._coalescers[cls]
+            
+        # Recorded before it's held so that it can't be released first. The watermark doesn't 
+        # move past it until it has been released and processed, or superseded.
+        cls.get_watermark(logger).start(event['id'])
+        
+        if cls.DURABLE_JOBS:
+            cls.get_job_queue(logger).hold(cls.__name__, event)
+            
+        logger.debug("Holding event {} for {}s".format(event['id'], cls.COALESCE_WINDOW))
+        superseded_id = coalescer.add(key, event['id'], sg, logger, event, args)
+        
+        if superseded_id is not None:
+            cls.get_watermark(logger).finish(superseded_id)
+        
+        if cls.DURABLE_JOBS and superseded_id is not None:
+            cls.get_job_queue(logger).supersede(cls.__name__, superseded_id)
+        
+        if cls.CANCEL_SUPERSEDED_JOBS:
+            
+            with cls._lock:
+                _, job_ids = cls._submitted_jobs.pop(key, (None, []))
+                
+            for job_id in job_ids:
+                cls.cancel_conductor_job(job_id, logger)
+                
+        return True
+                
+    @classmethod
+    def hold_events_again(cls, logger):
+        '''
+        Hold the events of this plugin class that were held when the daemon stopped. Their window
+        starts again.
+        '''
+        
+        queue = cls.get_job_queue(logger)
+        events = queue.get_held(cls.__name__)
+        
+        if events:
+            logger.info("Holding {} events held before a restart".format(len(events)))
+            
+        sg = cls.get_sg_instance()
+        
+        for event in events:
+            
+            try:
+                if not cls.coalesce_event(sg, logger, event):
+                    queue.supersede(cls.__name__, event['id'])
+                    
+            # The event stays held in the queue and is held again on the next restart
+            except Exception:
+                logger.exception("Failed to hold event {} again".format(event['id']))
+                
+    @classmethod
+    def cancel_conductor_job(cls, job_id, logger):
+        '''
+        Kill a Conductor job
+        
+        :param job_id: The id of the job
+        :type job_id: str
+        '''
+        
+        logger.info("Killing superseded Conductor job {}".format(job_id))
+        
+        try:
+            conductor.lib.api_client.ApiClient().make_request("api/v1/jobs/{}/kill".format(job_id),
+                                                              verb="PUT",
+                                                              use_api_key=True)
+            
+        except Exception:
+            logger.exception("Unable to kill Conductor job {}".format(job_id))
+                
+    @classmethod
+    def dispatch(cls, sg, logger, event, args=None):
+        '''
+        Process the event, on a worker thread if EVENT_WORKERS is set
+        '''
+        
+        if cls.EVENT_WORKERS > 0:
+            cls.dispatch_event(sg, logger, event, args)
+            
+        else:
+            cls.process_daemon_event(logger, event, args)
+    
+    @classmethod
+    def start_retry_scheduler(cls, logger):
+        '''
+        Resume the events of this plugin class that were interrupted by a restart and start 
+        retrying its failed events in the background
+        '''
         
-        return shotgun_api3.Shotgun(cls.SERVER,
-                                    cls.SCRIPT_NAME,
-                                    cls.SCRIPT_KEY)           
+        queue = cls.get_job_queue(logger)
         
+        with cls._lock:
+            
+            if cls in cls._retry_schedulers:
+                return
+            
+            recovered = queue.recover(cls.__name__)
+            
+            if recovered:
+                logger.info("Resuming {} events interrupted by a restart".format(recovered))
+                
+            scheduler = job_queue.RetryScheduler(queue,
+                                                 cls.__name__,
+                                                 lambda event: cls.dispatch(cls.get_sg_instance(), logger, event),
+                                                 logger=logger)
+            scheduler.start()
+            
+            cls._retry_schedulers[cls] = scheduler
+    
     @classmethod
     def registerCallbacks(cls, reg):
         """
         Register our callbacks.
         :param reg: A Registrar instance provided by the event loop handler.
         """
+        
+        cls._router.register_fields(cls.PUBLISHED_FILE_FIELDS + cls.COALESCE_FIELDS)
+        
+        # A single endpoint serves the metrics of every plugin
+        with cls._lock:
+            if cls.METRICS_PORT and SubmitToConductorSGDaemonPlugin._metrics_server is None:
+                SubmitToConductorSGDaemonPlugin._metrics_server = metrics.start_http_server(cls.METRICS_PORT, cls._metrics, logger=reg.logger)
+        
+        if cls.DURABLE_JOBS:
+            cls.start_retry_scheduler(reg.logger)
+            
+            if cls.COALESCE_WINDOW > 0:
+                cls.hold_events_again(reg.logger)
+        
+        if cls.COALESCE_WINDOW > 0:
+            callback = cls.coalesce_event
+            
+        elif cls.EVENT_WORKERS > 0:
+            callback = cls.dispatch_event
+            
+        else:
+            callback = cls.dispatch
 
         reg.registerCallback(
             cls.SCRIPT_NAME,
             cls.SCRIPT_KEY,
-            cls().main,
+            callback,
             cls.EVENT
         )
         reg.logger.debug("Registered callback")            
@@ -0,0 +1,141 @@
+import json
+import logging
+import os
+import threading
+import time
+
+
+class TTLCache(object):
+    '''
+    A thread-safe cache whose entries expire after a fixed time.
+
+    The cache can optionally be snapshotted to a json file so that a restarted process comes up
+    with the values it had before (entries that have expired in the meantime are ignored). Values
+    must therefore be json serializable.
+    '''
+
+    def __init__(self, ttl, snapshot_path=None, logger=None):
+        '''
+        :param ttl: The time (in seconds) an entry is valid for
+        :type ttl: float
+
+        :param snapshot_path: The json file the cache is saved to. None to keep it in memory only.
+        :type snapshot_path: str
+        '''
+
+        self.ttl = ttl
+        self.snapshot_path = snapshot_path
+        self.logger = logger or logging.getLogger(__name__)
+
+        self._lock = threading.RLock()
+        self._entries = {}
+
+        if self.snapshot_path:
+            self.load_snapshot()
+
+    def get(self, key, default=None):
+        '''
+        :returns: The value for key or default if it isn't cached or has expired
+        '''
+
+        with self._lock:
+
+            entry = self._entries.get(key)
+
+            if entry is None:
+                return default
+
+            if time.time() - entry['time'] > self.ttl:
+                del self._entries[key]
+                return default
+
+            return entry['value']
+
+    def set(self, key, value):
+
+        with self._lock:
+            self._entries[key] = {'time': time.time(), 'value': value}
+
+        self.save_snapshot()
+
+    def get_or_load(self, key, loader):
+        '''
+        Get the value for key, calling loader to get a fresh value when it isn't cached. None is
+        never cached.
+
+        :param key: The key of the value
+        :type key: str
+
+        :param loader: Called with no arguments to get the value
+        :type loader: callable
+
+        :returns: The value for key
+        '''
+
+        value = self.get(key)
+
+        if value is None:
+            value = loader()
+
+            if value is not None:
+                self.set(key, value)
+
+        return value
+
+    def invalidate(self, key=None):
+        '''
+        Drop the given key from the cache.
+
+        :param key: The key to drop. None to drop every key.
+        :type key: str
+        '''
+
+        with self._lock:
+
+            if key is None:
+                self._entries.clear()
+
+            else:
+                self._entries.pop(key, None)
+
+        self.save_snapshot()
+
+    def load_snapshot(self):
+
+        if not os.path.exists(self.snapshot_path):
+            return
+
+        try:
+            with open(self.snapshot_path) as fh:
+                entries = json.load(fh)
+
+        except (IOError, ValueError) as err:
+            self.logger.warning("Unable to read cache snapshot {} ({})".format(self.snapshot_path, err))
+            return
+
+        with self._lock:
+            self._entries.update(entries)
+
+    def save_snapshot(self):
+
+        if not self.snapshot_path:
+            return
+
+        with self._lock:
+
+            try:
+                parent_dir = os.path.dirname(self.snapshot_path)
+
+                if parent_dir and not os.path.exists(parent_dir):
+                    os.makedirs(parent_dir)
+
+                tmp_path = "{}.tmp".format(self.snapshot_path)
+
+                with open(tmp_path, 'w') as fh:
+                    json.dump(self._entries, fh)
+
+                os.rename(tmp_path, self.snapshot_path)
+
+            # The snapshot is only an optimization
+            except (IOError, OSError, TypeError) as err:
+                self.logger.warning("Unable to write cache snapshot {} ({})".format(self.snapshot_path, err))
@@ -0,0 +1,148 @@
+import base64
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+
+class UploadIndex(object):
+    '''
+    A persistent index of the md5 of the files uploaded to Conductor.
+
+    The md5 of a file is only computed again when its path, modification time or size changes.
+    The index also records which md5s have been uploaded to Conductor by a successful submission
+    so that those files don't need to be uploaded again.
+
+    md5s are base64 encoded, as used by Conductor.
+    '''
+
+    SCHEMA = ['CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime REAL, size INTEGER, md5 TEXT)',
+              'CREATE TABLE IF NOT EXISTS stored (md5 TEXT PRIMARY KEY, stored_at REAL)',
+              'CREATE TABLE IF NOT EXISTS s3_objects (key TEXT PRIMARY KEY, etag TEXT, md5 TEXT)']
+
+    def __init__(self, db_path, logger=None):
+        '''
+        :param db_path: The path of the sqlite database
+        :type db_path: str
+        '''
+
+        self.db_path = db_path
+        self.logger = logger or logging.getLogger(__name__)
+
+        self._thread_data = threading.local()
+
+        parent_dir = os.path.dirname(db_path)
+
+        if parent_dir and not os.path.exists(parent_dir):
+            os.makedirs(parent_dir)
+
+        connection = self.get_connection()
+
+        # WAL lets readers carry on while another process or thread is writing
+        connection.execute('PRAGMA journal_mode=WAL')
+
+        for statement in self.SCHEMA:
+            connection.execute(statement)
+
+        connection.commit()
+
+    def get_connection(self):
+        '''
+        sqlite connections can't be shared between threads so every thread gets its own.
+
+        :rtype: sqlite3.Connection
+        '''
+
+        connection = getattr(self._thread_data, 'connection', None)
+
+        if connection is None:
+            connection = self._thread_data.connection = sqlite3.connect(self.db_path, timeout=30)
+
+        return connection
+
+    def get_md5(self, path):
+        '''
+        Get the md5 of the given file, from the index if the file hasn't changed since it was
+        last hashed.
+
+        :param path: The path of the file
+        :type path: str
+
+        :returns: The base64 encoded md5
+        :rtype: str
+        '''
+
+        stat = os.stat(path)
+        connection = self.get_connection()
+
+        row = connection.execute('SELECT md5 FROM files WHERE path=? AND mtime=? AND size=?',
+                                 (path, stat.st_mtime, stat.st_size)).fetchone()
+
+        if row is not None:
+            return row[0]
+
+        self.logger.debug("Hashing {}".format(path))
+        md5 = self.hash_file(path)
+
+        with connection:
+            connection.execute('INSERT OR REPLACE INTO files (path, mtime, size, md5) VALUES (?, ?, ?, ?)',
+                               (path, stat.st_mtime, stat.st_size, md5))
+
+        return md5
+
+    def get_s3_md5(self, key, etag):
+        '''
+        Get the md5 of an S3 object, as recorded by set_s3_md5
+
+        :returns: The base64 encoded md5 or None if the object (or that version of it) isn't known
+        :rtype: str
+        '''
+
+        row = self.get_connection().execute('SELECT md5 FROM s3_objects WHERE key=? AND etag=?', (key, etag)).fetchone()
+
+        return row[0] if row is not None else None
+
+    def set_s3_md5(self, key, etag, md5):
+        '''
+        Record the md5 of an S3 object whose ETag isn't its md5 (i.e. multipart uploads)
+        '''
+
+        connection = self.get_connection()
+
+        with connection:
+            connection.execute('INSERT OR REPLACE INTO s3_objects (key, etag, md5) VALUES (?, ?, ?)', (key, etag, md5))
+
+    def is_stored(self, md5):
+        '''
+        :returns: True if a file with the given md5 has been uploaded to Conductor
+        :rtype: bool
+        '''
+
+        row = self.get_connection().execute('SELECT 1 FROM stored WHERE md5=?', (md5,)).fetchone()
+
+        return row is not None
+
+    def mark_stored(self, md5s):
+        '''
+        Record that the files with the given md5s have been uploaded to Conductor
+        '''
+
+        now = time.time()
+        connection = self.get_connection()
+
+        with connection:
+            connection.executemany('INSERT OR REPLACE INTO stored (md5, stored_at) VALUES (?, ?)',
+                                   [ (md5, now) for md5 in md5s ])
+
+    @staticmethod
+    def hash_file(path, block_size=1024*1024):
+
+        md5 = hashlib.md5()
+
+        with open(path, 'rb') as fh:
+            for block in iter(lambda: fh.read(block_size), b''):
+                md5.update(block)
+
+        return base64.b64encode(md5.digest())
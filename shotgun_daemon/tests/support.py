@@ -0,0 +1,26 @@
+'''
+Sets up the daemon modules to run against the stand-ins of the benchmark (see 
+benchmark/fake_services.py). Must be imported by every test module before any daemon module.
+
+    python -m unittest discover -s shotgun_daemon/tests
+'''
+
+import os
+import sys
+import tempfile
+
+DAEMON_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, os.path.join(DAEMON_DIR, 'benchmark'))
+
+import fake_services
+import run_benchmark
+
+# The caches and workspaces of the tests are kept out of the EFS paths
+run_benchmark.setup_environment(tempfile.mkdtemp(prefix="sg_daemon_tests_"))
+
+database = fake_services.FakeShotgunDatabase()
+conductor_stub = fake_services.ConductorStub()
+
+fake_services.install_shotgun_stub(database)
+fake_services.install_conductor_stub(conductor_stub)
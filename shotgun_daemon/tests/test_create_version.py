@@ -0,0 +1,54 @@
+import logging
+import unittest
+
+import support
+
+import fake_services
+
+import create_version
+
+
+class CreateVersionTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.task = support.database.add('Task', {'sg_status_list': 'ip'})
+        self.published_file = support.database.add('PublishedFile', {'code': 'sh0010_light_v001',
+                                                                     'project': {'type': 'Project', 'id': 1},
+                                                                     'entity': {'type': 'Shot', 'id': 1},
+                                                                     'task': {'type': 'Task', 'id': self.task['id']},
+                                                                     'created_by': {'type': 'HumanUser', 'id': 1},
+                                                                     'path': {'local_path': '/renders/sh0010.%04d.exr'}})
+
+        self.plugin = create_version.CreateVersionPlugin()
+        self.plugin.start_event(create_version.CreateVersionPlugin.get_sg_instance(), logging.getLogger(__name__), {'id': 1})
+        self.plugin.event_entity = self.published_file
+        self.addCleanup(self.plugin.end_event, 'success')
+
+        support.database.stats = fake_services.ServiceStats()
+
+    def test_single_request(self):
+        '''
+        The Version is created and its Task updated in one request
+        '''
+
+        self.plugin.VERSION_TASK_STATUS = 'rev'
+
+        version = self.plugin.create_version()
+
+        self.assertEqual(support.database.stats.as_dict(), {'batch': 1})
+        self.assertEqual(support.database.get('Version', version['id'])['published_files'], [self.published_file])
+        self.assertEqual(support.database.get('Task', self.task['id'])['sg_status_list'], 'rev')
+
+    def test_task_status_disabled(self):
+
+        self.plugin.VERSION_TASK_STATUS = ''
+
+        self.plugin.create_version()
+
+        self.assertEqual(support.database.stats.as_dict(), {'batch': 1})
+        self.assertEqual(support.database.get('Task', self.task['id'])['sg_status_list'], 'ip')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import support
+
+import submit_to_conductor_base
+
+
+class OutcomePlugin(submit_to_conductor_base.SubmitToConductorSGDaemonPlugin):
+
+    def handle_event(self, event):
+
+        if event.get('fail'):
+            raise Exception("Failed to process event {}".format(event['id']))
+
+
+class EventOutcomeTest(unittest.TestCase):
+    '''
+    The outcome of an event as reported to replay.py
+    '''
+
+    def setUp(self):
+
+        self.logger = logging.getLogger(__name__)
+
+    def use_job_queue(self):
+
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, True)
+
+        base_cls = submit_to_conductor_base.SubmitToConductorSGDaemonPlugin
+        base_cls._job_queue = None
+        self.addCleanup(setattr, base_cls, '_job_queue', None)
+
+        OutcomePlugin.DURABLE_JOBS = True
+        OutcomePlugin.JOB_QUEUE_PATH = os.path.join(root, 'job_queue.db')
+        self.addCleanup(setattr, OutcomePlugin, 'DURABLE_JOBS', False)
+
+    def test_processed(self):
+
+        self.assertEqual(OutcomePlugin.process_event(self.logger, {'id': 1}), 'processed')
+
+    def test_failed(self):
+
+        with self.assertRaises(Exception):
+            OutcomePlugin.process_event(self.logger, {'id': 2, 'fail': True})
+
+    def test_durable_failed(self):
+        '''
+        The failure is left in the job queue rather than raised
+        '''
+
+        self.use_job_queue()
+
+        self.assertEqual(OutcomePlugin.process_event(self.logger, {'id': 3, 'fail': True}), 'failed')
+
+    def test_durable_skipped(self):
+        '''
+        An event that has already been processed is skipped
+        '''
+
+        self.use_job_queue()
+
+        self.assertEqual(OutcomePlugin.process_event(self.logger, {'id': 4}), 'processed')
+        self.assertEqual(OutcomePlugin.process_event(self.logger, {'id': 4}), 'skipped')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import support
+
+import submit_to_conductor_base
+
+
+class RecordingPlugin(submit_to_conductor_base.SubmitToConductorSGDaemonPlugin):
+
+    EVENT_WORKERS = 0
+    processed_ids = []
+
+    @classmethod
+    def process_event(cls, logger, event, args=None):
+
+        cls.processed_ids.append(event['id'])
+
+        if event.get('fail'):
+            raise Exception("Failed to process event {}".format(event['id']))
+
+
+class EventWatermarkTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, True)
+
+        self.watermark_path = os.path.join(self.root, 'plugin.last_event_id')
+
+    def test_in_order(self):
+
+        watermark = submit_to_conductor_base.EventWatermark(self.watermark_path)
+
+        for event_id in (1, 2, 3):
+            watermark.start(event_id)
+
+        watermark.finish(2)
+        watermark.finish(3)
+
+        self.assertIsNone(submit_to_conductor_base.read_watermark(self.watermark_path))
+
+        watermark.finish(1)
+
+        self.assertEqual(submit_to_conductor_base.read_watermark(self.watermark_path), 3)
+
+    def test_held_event(self):
+        '''
+        A held event keeps the watermark back until it's processed
+        '''
+
+        watermark = submit_to_conductor_base.EventWatermark(self.watermark_path)
+
+        watermark.start(1)
+        watermark.start(2)
+        watermark.finish(2)
+
+        self.assertIsNone(watermark.last_event_id)
+
+        watermark.finish(1)
+
+        self.assertEqual(watermark.last_event_id, 2)
+
+    def test_retry(self):
+        '''
+        Retrying an event from before the watermark doesn't move it back
+        '''
+
+        watermark = submit_to_conductor_base.EventWatermark(self.watermark_path)
+
+        watermark.start(5)
+        watermark.finish(5)
+        watermark.start(3)
+        watermark.finish(3)
+
+        self.assertEqual(submit_to_conductor_base.read_watermark(self.watermark_path), 5)
+
+    def test_synchronous_dispatch(self):
+        '''
+        Events processed on the daemon's thread are saved to the watermark, even if they fail
+        '''
+
+        RecordingPlugin.EVENT_WATERMARK_DIR = self.root
+        RecordingPlugin._watermarks.pop(RecordingPlugin, None)
+        self.addCleanup(RecordingPlugin._watermarks.pop, RecordingPlugin, None)
+
+        logger = logging.getLogger(__name__)
+
+        RecordingPlugin.dispatch(None, logger, {'id': 7})
+
+        with self.assertRaises(Exception):
+            RecordingPlugin.dispatch(None, logger, {'id': 8, 'fail': True})
+
+        self.assertEqual(RecordingPlugin.processed_ids, [7, 8])
+        self.assertEqual(submit_to_conductor_base.read_watermark(RecordingPlugin.get_watermark_path()), 8)
+
+
+if __name__ == "__main__":
+    unittest.main()
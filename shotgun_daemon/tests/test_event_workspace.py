@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import support
+
+import concurrent.futures
+
+import submit_to_conductor_base
+
+
+class EventWorkspaceTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, True)
+
+    def test_concurrent_downloads(self):
+        '''
+        Frames written, renamed and deleted on several threads, as stream_frames does, while the
+        quota is enforced and the workspace is walked
+        '''
+
+        frame_size = 4096
+        workspace = submit_to_conductor_base.EventWorkspace(self.root, 1, quota_bytes=frame_size * 8)
+        stop_event = threading.Event()
+
+        def download(index):
+
+            frame_path = workspace.get_path("frame.{:04d}.exr".format(index))
+
+            with workspace.reserve(frame_size):
+                with open(frame_path + ".part", 'wb') as fh:
+                    fh.write(os.urandom(frame_size))
+
+                os.rename(frame_path + ".part", frame_path)
+
+            os.remove(frame_path)
+            workspace.free(frame_size)
+
+        def walk():
+
+            while not stop_event.is_set():
+                workspace.disk_usage()
+
+        walker = threading.Thread(target=walk)
+        walker.start()
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+                list(executor.map(download, range(400)))
+
+        finally:
+            stop_event.set()
+            walker.join()
+
+        self.assertEqual(workspace.disk_usage(), 0)
+        self.assertEqual(workspace._reserved_bytes, 0)
+
+    def test_quota(self):
+
+        workspace = submit_to_conductor_base.EventWorkspace(self.root, 1, quota_bytes=100)
+
+        with workspace.reserve(60):
+            pass
+
+        with self.assertRaises(Exception):
+            with workspace.reserve(60):
+                pass
+
+        # A reservation is cancelled when the file couldn't be written
+        with self.assertRaises(IOError):
+            with workspace.reserve(40):
+                raise IOError("Download failed")
+
+        workspace.free(60)
+
+        with workspace.reserve(100):
+            pass
+
+
+if __name__ == "__main__":
+    unittest.main()
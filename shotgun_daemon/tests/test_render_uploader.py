@@ -0,0 +1,68 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import support
+
+import render_uploader
+
+
+class KillPreviousWatcherTest(unittest.TestCase):
+
+    def setUp(self):
+
+        state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, state_dir, True)
+
+        self.original_pid_path = render_uploader.pid_path
+        render_uploader.pid_path = os.path.join(state_dir, "uploader.pid")
+        self.addCleanup(setattr, render_uploader, 'pid_path', self.original_pid_path)
+
+    def spawn(self, *argv):
+        '''
+        Start a process that sleeps, with the given extra arguments, as the uploader of a previous
+        task would be
+        '''
+
+        process = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"] + list(argv),
+                                   preexec_fn=os.setsid)
+        self.addCleanup(self.kill, process)
+
+        with open(render_uploader.pid_path, 'w') as fh:
+            fh.write(str(process.pid))
+
+        return process
+
+    @staticmethod
+    def kill(process):
+
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+
+    def test_leftover_watcher(self):
+
+        script_path = os.path.splitext(render_uploader.__file__)[0] + ".py"
+        process = self.spawn(script_path, "watch")
+
+        render_uploader.kill_previous_watcher()
+
+        self.assertFalse(render_uploader.is_running(process.pid))
+
+    def test_reused_pid(self):
+        '''
+        A process that isn't an uploader is left alone
+        '''
+
+        process = self.spawn("other")
+
+        render_uploader.kill_previous_watcher()
+
+        self.assertTrue(render_uploader.is_running(process.pid))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+import threading
+import unittest
+
+import support
+
+import submit_to_conductor_base
+
+
+class RunConcurrentlyTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.plugin = submit_to_conductor_base.SubmitToConductorSGDaemonPlugin()
+        self.plugin.ASYNC_IO = True
+
+        self.addCleanup(self.reset_io_executor)
+
+    def reset_io_executor(self):
+
+        base_cls = submit_to_conductor_base.SubmitToConductorSGDaemonPlugin
+
+        if base_cls._io_executor is not None:
+            base_cls._io_executor.shutdown(wait=True)
+
+        base_cls._io_executor = None
+        base_cls._io_slots = None
+
+    def use_io_workers(self, io_workers):
+
+        self.reset_io_executor()
+        self.plugin.IO_WORKERS = io_workers
+
+    def test_nested_calls_overlap(self):
+        '''
+        Nested calls run on the free I/O threads, as the copies of download_dependencies do
+        '''
+
+        self.use_io_workers(4)
+
+        first_started = threading.Event()
+        second_started = threading.Event()
+
+        # Only returns True when the other call runs at the same time
+        def rendezvous(started, other_started):
+            started.set()
+            return other_started.wait(5)
+
+        def nested():
+            return self.plugin.run_concurrently(lambda: rendezvous(first_started, second_started),
+                                                lambda: rendezvous(second_started, first_started))
+
+        results = self.plugin.run_concurrently(nested, lambda: 'other')
+
+        self.assertEqual(results, [[True, True], 'other'])
+
+    def test_nested_calls_without_free_threads(self):
+        '''
+        Nested calls run inline when every I/O thread is busy rather than waiting for one
+        '''
+
+        self.use_io_workers(2)
+
+        def nested(depth):
+            if depth == 0:
+                return threading.current_thread().name
+
+            return self.plugin.run_concurrently(lambda: nested(depth - 1), lambda: nested(depth - 1))
+
+        results = self.plugin.run_concurrently(lambda: nested(3), lambda: nested(3))
+
+        self.assertEqual(len(results), 2)
+
+    def test_errors(self):
+
+        self.use_io_workers(1)
+
+        def fail():
+            raise ValueError("Failed")
+
+        def nested():
+            return self.plugin.run_concurrently(fail, lambda: 1)
+
+        with self.assertRaises(ValueError):
+            self.plugin.run_concurrently(nested, lambda: 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
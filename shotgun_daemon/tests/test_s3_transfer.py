@@ -0,0 +1,58 @@
+import threading
+import time
+import unittest
+
+import support
+
+import concurrent.futures
+
+import s3_transfer
+
+
+class CountingDownloader(s3_transfer.S3Downloader):
+    '''
+    Records the largest number of files downloaded at once
+    '''
+
+    def __init__(self, *args, **kwargs):
+
+        super(CountingDownloader, self).__init__(*args, **kwargs)
+
+        self.lock = threading.Lock()
+        self.active = 0
+        self.peak = 0
+
+    def download_file(self, key, file_path):
+
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+
+        time.sleep(0.01)
+
+        with self.lock:
+            self.active -= 1
+
+        return file_path
+
+
+class S3DownloaderTest(unittest.TestCase):
+
+    def test_shared_workers(self):
+        '''
+        Downloads started from several threads, as copy_dependencies_from_s3 does, share the
+        downloader's workers
+        '''
+
+        downloader = CountingDownloader('bucket', max_workers=4, client=object())
+        transfers = [ ("key{}".format(index), "/tmp/key{}".format(index)) for index in range(8) ]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(downloader.download, [transfers] * 4))
+
+        self.assertEqual(results, [[ file_path for _, file_path in transfers ]] * 4)
+        self.assertEqual(downloader.peak, 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
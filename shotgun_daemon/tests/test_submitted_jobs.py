@@ -0,0 +1,74 @@
+import logging
+import time
+import unittest
+
+import support
+
+import submit_to_conductor_base
+
+
+class ShotPlugin(submit_to_conductor_base.SubmitToConductorSGDaemonPlugin):
+
+    CANCEL_SUPERSEDED_JOBS = True
+    SUBMITTED_JOBS_MAX = 2
+    SUBMITTED_JOBS_TTL = 60
+
+    @classmethod
+    def get_coalesce_key(cls, entity):
+
+        return entity['entity']['id']
+
+
+class SubmittedJobsTest(unittest.TestCase):
+
+    def setUp(self):
+
+        self.plugin = ShotPlugin()
+        self.plugin.logger = logging.getLogger(__name__)
+
+        submit_to_conductor_base.SubmitToConductorSGDaemonPlugin._submitted_jobs.clear()
+        self.addCleanup(submit_to_conductor_base.SubmitToConductorSGDaemonPlugin._submitted_jobs.clear)
+
+    def submit(self, shot_id, job_id):
+
+        self.plugin.event_entity = {'entity': {'type': 'Shot', 'id': shot_id}}
+        self.plugin.record_submitted_job({'jobid': job_id})
+
+    def test_disabled(self):
+
+        self.plugin.CANCEL_SUPERSEDED_JOBS = False
+
+        self.submit(1, '00001')
+
+        self.assertEqual(dict(ShotPlugin._submitted_jobs), {})
+
+    def test_chunks(self):
+
+        self.submit(1, '00001')
+        self.submit(1, '00002')
+
+        self.assertEqual(ShotPlugin._submitted_jobs[1][1], ['00001', '00002'])
+
+    def test_max_keys(self):
+        '''
+        The least recently submitted keys are forgotten first
+        '''
+
+        self.submit(1, '00001')
+        self.submit(2, '00002')
+        self.submit(1, '00003')
+        self.submit(3, '00004')
+
+        self.assertEqual(list(ShotPlugin._submitted_jobs), [1, 3])
+
+    def test_ttl(self):
+
+        self.submit(1, '00001')
+        ShotPlugin._submitted_jobs[1] = (time.time() - 120, ['00001'])
+        self.submit(2, '00002')
+
+        self.assertEqual(list(ShotPlugin._submitted_jobs), [2])
+
+
+if __name__ == "__main__":
+    unittest.main()